@@ -1,7 +1,14 @@
 import os
+import json
+import time
+from multiprocessing import Pool
+import numpy as np
 
-from ..snakeutils.files import find_files_or_folders_at_depth, extract_snakes
-from ..snakeutils.snakejson import save_json_snakes
+from ..snakeutils.files import find_files_or_folders_at_depth, extract_snake_set_and_graph
+from ..snakeutils.snakeformats import save_snakes, snake_output_formats, snake_filename_with_format, snake_index_path
+from ..snakeutils.progress import ProgressTracker
+from ..snakeutils.spatialindex import spatial_index_path
+from ..snakeutils.geometry import clip_to_box
 
 def infer_snakes_dims_and_offset_pixels(snake_filename):
     # remove "sec_" and ".txt"
@@ -27,33 +34,68 @@ def infer_snakes_dims_and_offset_pixels(snake_filename):
 
     return dims, offset
 
-def crop_snakes(orig_snake_list, lower_xyz, upper_xyz):
-    new_snake_list = []
-    for orig_snake in orig_snake_list:
-        new_snake = []
-        for orig_pt in orig_snake:
-            orig_pos = orig_pt["pos"]
-            fg = orig_pt["fg"]
-            bg = orig_pt["bg"]
-
-            new_pos = []
-            # iterate over x,y,z
-            for i in range(3):
-                coord = orig_pos[i]
-                if coord < lower_xyz[i]:
-                    coord = lower_xyz[i]
-                if coord > upper_xyz[i]:
-                    coord = upper_xyz[i]
-                new_pos.append(coord)
-
-            new_pt = {
-                "pos": new_pos,
-                "fg": fg,
-                "bg": bg,
-            }
-            new_snake.append(new_pt)
-        new_snake_list.append(new_snake)
-    return new_snake_list
+def crop_snakes(snakes, lower_xyz, upper_xyz):
+    """ Returns SnakeSet with the coordinates of every point limited to lower_xyz and upper_xyz """
+    return clip_to_box(snakes, lower_xyz, upper_xyz)
+
+convert_manifest_filename = ".convert_snakes_manifest.json"
+
+def source_file_fingerprint(fp):
+    stat = os.stat(fp)
+    return "{}-{}".format(stat.st_size, stat.st_mtime_ns)
+
+class ConvertManifest:
+    """ Sidecar file in the target directory, recording for every converted file the source
+    snake file it came from, that file's size and modification time, and the settings it was
+    converted with. Incremental runs use it to skip outputs that are up to date and to find
+    outputs whose source is gone. Keys are target paths relative to the target directory """
+    def __init__(self, target_json_dir):
+        self.manifest_fp = os.path.join(target_json_dir, convert_manifest_filename)
+        self.entries = {}
+        if os.path.isfile(self.manifest_fp):
+            try:
+                with open(self.manifest_fp, "r") as f:
+                    self.entries = json.load(f)["files"]
+            except (ValueError, KeyError):
+                # A broken manifest only means everything is converted again
+                self.entries = {}
+
+    def is_up_to_date(self, target_key, entry, target_fp):
+        return self.entries.get(target_key) == entry and os.path.isfile(target_fp)
+
+    def save(self):
+        tmp_fp = self.manifest_fp + ".tmp"
+        with open(tmp_fp, "w") as f:
+            json.dump({"files": self.entries}, f, indent=1, sort_keys=True)
+        os.replace(tmp_fp, self.manifest_fp)
+
+def convert_snake_file(arg_dict):
+    """ Converts one SOAX snake file. Runs in a worker process, so it gets no logger and
+    returns what it did for the main process to log """
+    start_time = time.perf_counter()
+    with open(arg_dict["snakes_fp"]) as f:
+        snakes, graph = extract_snake_set_and_graph(f, junction_tolerance_pixels=arg_dict["junction_tolerance_pixels"])
+    # Occasionally SOAX may output snakes that leave the frame of the original image,
+    # so we can limit the x,y,z coords of snake points to the dimensions of
+    # the image section.
+    snakes = crop_snakes(snakes, [0,0,0], arg_dict["dims_pixels_xyz"])
+    graph = graph.with_junction_positions(np.clip(graph.junction_positions, [0,0,0], arg_dict["dims_pixels_xyz"]))
+    read_seconds = time.perf_counter() - start_time
+
+    save_snakes(arg_dict["json_fp"], snakes, arg_dict["offset_pixels_xyz"], arg_dict["dims_pixels_xyz"], arg_dict["pixel_spacing_um_xyz"], graph)
+
+    return {
+        "snakes_fp": arg_dict["snakes_fp"],
+        "json_fp": arg_dict["json_fp"],
+        "progress_group": arg_dict["progress_group"],
+        "manifest_key": arg_dict["manifest_key"],
+        "manifest_entry": arg_dict["manifest_entry"],
+        "snake_count": len(snakes),
+        "point_count": snakes.point_count,
+        "junction_count": len(graph),
+        "read_seconds": read_seconds,
+        "write_seconds": time.perf_counter() - start_time - read_seconds,
+    }
 
 def convert_snakes_to_json(
     source_snakes_dir,
@@ -62,10 +104,28 @@ def convert_snakes_to_json(
     offset_pixels, # {"type": "infer"} or {"type": "int_coords", "value": [x,y,z]}
     dims_pixels, # {"type": "infer"} or {"type": "int_coords", "value": [0,0,0]}
     pixel_spacing_um_xyz, # [dx,dy,dz] pixel spacing in micrometers
-    logger):
+    logger,
+    progress_fp=None,
+    output_format="json", # "json" or "binary", see snakeformats.snake_output_formats
+    workers=1,
+    incremental=False,
+    junction_tolerance_pixels=1.0):
+    """ Reading snake files is mostly pure Python, so with more than one worker files are
+    converted in a pool of processes instead of threads. Files are still logged in order.
+
+    Every run records what it converted in a manifest in target_json_dir. With incremental,
+    files whose source, settings and output haven't changed since the last run are skipped,
+    and outputs of earlier runs whose source file is gone are deleted.
+
+    The junction section of each snake file is saved with the snakes as a SnakeGraph, with
+    each junction joined to the snakes that end within junction_tolerance_pixels of it.
+    """
+    if output_format not in snake_output_formats:
+        logger.FAIL("Unknown snake output format '{}', expected one of {}".format(output_format, list(snake_output_formats.keys())))
     snakes_ext = ".txt"
     snake_folders_and_filenames = find_files_or_folders_at_depth(source_snakes_dir,source_snakes_depth,snakes_ext)
 
+    convert_arg_dicts = []
     for folder_path, snake_filename in snake_folders_and_filenames:
         folder_relative_path = os.path.relpath(folder_path, source_snakes_dir)
         target_folder_path = os.path.join(target_json_dir, folder_relative_path)
@@ -75,9 +135,8 @@ def convert_snakes_to_json(
             else:
                 os.makedirs(target_folder_path)
         snakes_fp = os.path.join(folder_path,snake_filename)
-        logger.log("Reading snakes from {}".format(snakes_fp))
 
-        json_fn = os.path.splitext(snake_filename)[0] + ".json"
+        json_fn = snake_filename_with_format(snake_filename, output_format)
         json_fp = os.path.join(target_folder_path, json_fn)
 
         if offset_pixels["type"] == "int_coords":
@@ -94,12 +153,92 @@ def convert_snakes_to_json(
         else:
             raise Exception("Invalid type attribute in {}".format(dims_pixels))
 
-        with open(snakes_fp) as f:
-            snake_list = extract_snakes(f)
-        # Occasionally SOAX may output snakes that leave the frame of the original image,
-        # so we can limit the x,y,z coords of snake points to the dimensions of
-        # the image section.
-        snake_list = crop_snakes(snake_list, [0,0,0], dims_pixels_xyz)
-
-        logger.log("  Writing JSON snakes to {}".format(json_fp))
-        save_json_snakes(json_fp, snake_list, offset_pixels_xyz, dims_pixels_xyz, pixel_spacing_um_xyz)
+        convert_arg_dicts.append({
+            "snakes_fp": snakes_fp,
+            "json_fp": json_fp,
+            "offset_pixels_xyz": offset_pixels_xyz,
+            "dims_pixels_xyz": dims_pixels_xyz,
+            "pixel_spacing_um_xyz": pixel_spacing_um_xyz,
+            "junction_tolerance_pixels": junction_tolerance_pixels,
+            "progress_group": folder_relative_path,
+            "manifest_key": os.path.relpath(json_fp, target_json_dir),
+            "manifest_entry": {
+                "source": os.path.relpath(snakes_fp, source_snakes_dir),
+                "source_fingerprint": source_file_fingerprint(snakes_fp),
+                "offset_pixels_xyz": offset_pixels_xyz,
+                "dims_pixels_xyz": dims_pixels_xyz,
+                "pixel_spacing_um_xyz": pixel_spacing_um_xyz,
+                "junction_tolerance_pixels": junction_tolerance_pixels,
+            },
+        })
+
+    manifest = ConvertManifest(target_json_dir)
+    skipped_count = 0
+    removed_count = 0
+    if incremental:
+        all_arg_dicts = convert_arg_dicts
+        convert_arg_dicts = [
+            arg_dict for arg_dict in all_arg_dicts
+            if not manifest.is_up_to_date(arg_dict["manifest_key"], arg_dict["manifest_entry"], arg_dict["json_fp"])
+        ]
+        skipped_count = len(all_arg_dicts) - len(convert_arg_dicts)
+
+        # Outputs from earlier runs whose source is gone, or that were saved in another format
+        current_keys = set(arg_dict["manifest_key"] for arg_dict in all_arg_dicts)
+        for stale_key in sorted(set(manifest.entries) - current_keys):
+            stale_fp = os.path.join(target_json_dir, stale_key)
+            if os.path.isfile(stale_fp):
+                logger.log("Removing stale output {} of {}".format(stale_fp, manifest.entries[stale_key]["source"]))
+                os.remove(stale_fp)
+                removed_count += 1
+            for sidecar_fp in [snake_index_path(stale_fp), spatial_index_path(stale_fp)]:
+                if os.path.isfile(sidecar_fp):
+                    os.remove(sidecar_fp)
+            del manifest.entries[stale_key]
+
+    group_totals = {}
+    for arg_dict in convert_arg_dicts:
+        group_totals[arg_dict["progress_group"]] = group_totals.get(arg_dict["progress_group"], 0) + 1
+    progress = ProgressTracker("convert_snakes_to_json", len(convert_arg_dicts), logger, progress_fp=progress_fp, group_totals=group_totals)
+
+    def log_converted(result):
+        logger.log("Converted {} ({} snakes, {} points, {} junctions) to {} in {:.2f}s read + {:.2f}s write".format(
+            result["snakes_fp"],
+            result["snake_count"],
+            result["point_count"],
+            result["junction_count"],
+            result["json_fp"],
+            result["read_seconds"],
+            result["write_seconds"],
+        ))
+        progress.job_done(result["progress_group"])
+        manifest.entries[result["manifest_key"]] = result["manifest_entry"]
+
+    start_time = time.perf_counter()
+    file_seconds = 0
+    if workers == 1:
+        for arg_dict in convert_arg_dicts:
+            result = convert_snake_file(arg_dict)
+            file_seconds += result["read_seconds"] + result["write_seconds"]
+            log_converted(result)
+    else:
+        with Pool(workers) as pool:
+            # imap gives results in the order of the files, whichever process finishes first
+            for result in pool.imap(convert_snake_file, convert_arg_dicts, chunksize=1):
+                file_seconds += result["read_seconds"] + result["write_seconds"]
+                log_converted(result)
+    progress.close()
+    manifest.save()
+
+    logger.log("Converted {} snake files in {:.1f}s with {} workers ({:.1f}s of converting)".format(
+        len(convert_arg_dicts),
+        time.perf_counter() - start_time,
+        workers,
+        file_seconds,
+    ))
+    if incremental:
+        logger.log("Incremental convert: {} converted, {} skipped as up to date, {} stale outputs removed".format(
+            len(convert_arg_dicts),
+            skipped_count,
+            removed_count,
+        ))
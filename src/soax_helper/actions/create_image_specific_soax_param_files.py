@@ -1,22 +1,25 @@
 import os
+import json
 import copy
 from PIL import Image
 import numpy as np
 import decimal
 
 from ..snakeutils.files import find_tiffs_in_dir
-from ..snakeutils.tifimage import open_tiff_as_np_arr
-from .create_regular_soax_param_files import create_regular_soax_param_files
+from ..snakeutils.intensitystats import find_image_intensity_stats, intensity_stats_percentile, default_intensity_stats_cache_path
+from .create_regular_soax_param_files import create_regular_soax_param_files, check_param_file_count
 
-def get_image_intensity_scaling(img_arr, logger):
-    original_max_intensity = img_arr.max()
+# Written in each image's parameter folder when intensity scaling is set for each image
+intensity_scaling_info_filename = "intensity_scaling.json"
 
-    if original_max_intensity == 0:
-        logger.FAIL("TIFF has zero brightness everywhere, cannot intensity scale")
+intensity_scaling_modes = ["max", "percentile"]
 
-    # Is one divided by the
-    # For example, an 8 bit tiff would have a max possible value of 255
-    intensity_scaling_factor = 1.0 / float(original_max_intensity)
+def get_image_intensity_scaling(reference_intensity, logger):
+    if reference_intensity == 0:
+        logger.FAIL("TIFF brightness used for intensity scaling is zero, cannot intensity scale")
+
+    # Scaling that makes the reference intensity (the image's max or a percentile of it) 1
+    intensity_scaling_factor = 1.0 / float(reference_intensity)
 
     return intensity_scaling_factor
 
@@ -26,9 +29,49 @@ def create_image_specific_soax_param_files(
     set_intensity_scaling_for_each_image,
     general_param_settings,
     logger,
+    sampling_mode="grid",
+    sample_count=None,
+    sampling_seed=0,
+    max_param_files=None,
+    write_param_files=True,
+    workers=1,
+    intensity_stats_cache_fp=None,
+    intensity_scaling_mode="max",
+    intensity_scaling_percentile=99.99,
 ):
+    """ Makes a folder of parameter files for each TIFF in original_tiff_dir.
+
+    With set_intensity_scaling_for_each_image, each image's intensity scaling is set so its
+    brightest voxel (intensity_scaling_mode 'max') or its intensity_scaling_percentile
+    percentile (intensity_scaling_mode 'percentile') becomes 1. The percentile mode keeps a
+    few very bright pixels from squashing the rest of the image into a small range.
+    """
+    if intensity_scaling_mode not in intensity_scaling_modes:
+        logger.FAIL("Unknown intensity scaling mode '{}', expected one of {}".format(intensity_scaling_mode, intensity_scaling_modes))
+
     orig_tiffs = find_tiffs_in_dir(original_tiff_dir)
 
+    # Check the total for all images before making any files. Intensity scaling is counted
+    # as one value if it is going to be set for each image
+    count_param_settings = copy.deepcopy(general_param_settings)
+    if set_intensity_scaling_for_each_image:
+        count_param_settings["intensity_scaling"] = {"start": 0, "stop": 0, "step": 0}
+    check_param_file_count(count_param_settings, sampling_mode, sample_count, max_param_files, logger, copies=len(orig_tiffs))
+
+    if set_intensity_scaling_for_each_image:
+        # Stats are reused by every parameter sweep on the same images, without writing in
+        # the image folder
+        if intensity_stats_cache_fp is None:
+            intensity_stats_cache_fp = default_intensity_stats_cache_path()
+        logger.log("Finding intensity stats for {} images with {} workers".format(len(orig_tiffs), workers))
+        intensity_stats_by_fp = find_image_intensity_stats(
+            [os.path.join(original_tiff_dir, orig_tiff_fn) for orig_tiff_fn in orig_tiffs],
+            workers,
+            logger,
+            cache_fp=intensity_stats_cache_fp,
+            percentiles=[intensity_scaling_percentile] if intensity_scaling_mode == "percentile" else [],
+        )
+
     for orig_tiff_fn in orig_tiffs:
         tiff_path = os.path.join(original_tiff_dir, orig_tiff_fn)
         image_name_without_extension = os.path.splitext(orig_tiff_fn)[0]
@@ -39,12 +82,13 @@ def create_image_specific_soax_param_files(
 
         image_param_settings = copy.deepcopy(general_param_settings)
 
-
-        image_arr = open_tiff_as_np_arr(tiff_path)
-
         if set_intensity_scaling_for_each_image:
-            logger.log("Finding intensity scaling for {}".format(tiff_path))
-            float_intensity_scaling = get_image_intensity_scaling(image_arr, logger)
+            intensity_stats = intensity_stats_by_fp[tiff_path]
+            if intensity_scaling_mode == "percentile":
+                reference_intensity = intensity_stats_percentile(intensity_stats, intensity_scaling_percentile)
+            else:
+                reference_intensity = intensity_stats["max"]
+            float_intensity_scaling = get_image_intensity_scaling(reference_intensity, logger)
             # Convert to string with 12 significant digits - so decimal doesn't have way too many
             # unnecessary digits
             str_intensity_scaling = "{0:.12g}".format(float_intensity_scaling)
@@ -56,8 +100,23 @@ def create_image_specific_soax_param_files(
                 "step": decimal.Decimal(0),
             }
 
+            with open(os.path.join(image_params_dirpath, intensity_scaling_info_filename), "w") as f:
+                json.dump({
+                    "image": tiff_path,
+                    "mode": intensity_scaling_mode,
+                    "percentile": intensity_scaling_percentile if intensity_scaling_mode == "percentile" else None,
+                    "reference_intensity": reference_intensity,
+                    "max_intensity": intensity_stats["max"],
+                    "intensity_scaling": str(intensity_scaling),
+                }, f, indent=4)
+
         create_regular_soax_param_files(
             image_params_dirpath,
             image_param_settings,
             logger=logger,
+            sampling_mode=sampling_mode,
+            sample_count=sample_count,
+            sampling_seed=sampling_seed,
+            max_param_files=max_param_files,
+            write_param_files=write_param_files,
         )
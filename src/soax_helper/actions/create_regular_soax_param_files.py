@@ -1,8 +1,10 @@
 import os
+import json
 import itertools
 import decimal
+import numpy as np
 
-from ..snakeutils.params import create_params, param_filename_tags
+from ..snakeutils.params import create_params, param_filename_tags, param_manifest_filename, param_manifest_record
 
 def create_range(start,stop,step):
     start = decimal.Decimal(start)
@@ -24,6 +26,72 @@ def create_range(start,stop,step):
             break
     return vals
 
+def range_length(start,stop,step):
+    """ Number of values create_range would return, without making them """
+    start = decimal.Decimal(start)
+    stop = decimal.Decimal(stop)
+    step = decimal.Decimal(step)
+
+    if step == 0:
+        if start < stop:
+            raise Exception("Step of 0 from {} to {} would never reach the stop value".format(start, stop))
+        return 1
+    if step < 0:
+        raise Exception("Negative step {} from {} to {}".format(step, start, stop))
+    if stop < start:
+        return 1
+    return int((stop - start) // step) + 1
+
+def param_combination_counts(param_settings):
+    """ Returns {param name: number of values} for every parameter with a start-stop-step range """
+    return {param_name: range_length(**param_settings[param_name]) for param_name in param_filename_tags}
+
+def check_sample_count(sampling_mode, sample_count, logger):
+    """ Sampling modes other than grid need the number of parameter files to make """
+    if sampling_mode == "grid":
+        return
+    if isinstance(sample_count, bool) or not isinstance(sample_count, (int, np.integer)) or sample_count <= 0:
+        logger.FAIL("Sampling mode '{}' needs a positive whole number of samples, got {}".format(sampling_mode, sample_count))
+
+def check_param_file_count(param_settings, sampling_mode, sample_count, max_param_files, logger, copies=1):
+    """ Counts the parameter files the settings would make (times copies, for example once
+    per image), and fails with the size of each varied range if it is over max_param_files.
+    max_param_files of 0 or None means no limit. Returns the count """
+    try:
+        value_counts = param_combination_counts(param_settings)
+    except Exception as e:
+        logger.FAIL("Invalid parameter range: {}".format(e))
+    check_sample_count(sampling_mode, sample_count, logger)
+
+    if sampling_mode == "grid":
+        file_count = 1
+        for value_count in value_counts.values():
+            file_count *= value_count
+    else:
+        file_count = sample_count
+    file_count *= copies
+
+    if max_param_files is not None and max_param_files > 0 and file_count > max_param_files:
+        range_descriptions = [
+            "{} ({} values from {} to {} step {})".format(
+                param_name,
+                value_count,
+                param_settings[param_name]["start"],
+                param_settings[param_name]["stop"],
+                param_settings[param_name]["step"],
+            )
+            for param_name, value_count in value_counts.items() if value_count > 1
+        ]
+        logger.FAIL(
+            "These settings would create {} parameter files, more than the limit of {}. Check the step values of the varied parameters: {}. To make this many files, raise the maximum number of parameter files".format(
+                file_count,
+                max_param_files,
+                ", ".join(range_descriptions),
+            )
+        )
+
+    return file_count
+
 def param_filename_string_format_settings(start,stop,step):
     start = decimal.Decimal(start)
     stop = decimal.Decimal(stop)
@@ -45,11 +113,90 @@ def param_filename_string_format_settings(start,stop,step):
 
     return str_length, decimal_places
 
+sampling_modes = ["grid", "random", "latin_hypercube", "sobol"]
+
+def unit_samples(sampling_mode, sample_count, dims, rng, logger):
+    """ Returns sample_count x dims array of points in [0, 1) """
+    if sampling_mode == "random":
+        return rng.random((sample_count, dims))
+    elif sampling_mode == "latin_hypercube":
+        # Each dimension is split into sample_count equal strata, and every stratum
+        # gets exactly one point
+        strata = np.stack([rng.permutation(sample_count) for dim in range(dims)], axis=1)
+        return (strata + rng.random((sample_count, dims))) / sample_count
+    elif sampling_mode == "sobol":
+        try:
+            from scipy.stats import qmc
+        except ImportError:
+            logger.FAIL("Sobol sampling needs scipy 1.7 or newer (scipy.stats.qmc)")
+        sampler = qmc.Sobol(d=dims, scramble=True, seed=rng)
+        # Sobol sequences are balanced at powers of two, extra points are just not used
+        return sampler.random_base2(int(np.ceil(np.log2(max(sample_count, 2)))))[:sample_count]
+    else:
+        raise Exception("Unknown sampling mode '{}', expected one of {}".format(sampling_mode, sampling_modes))
+
+def sample_param_combinations(vary_param_values, sampling_mode, sample_count, sampling_seed, logger):
+    """ Picks sample_count different combinations of the parameter values.
+
+    Samples are drawn in the unit hypercube of the parameters that have more than one value
+    and snapped to the nearest value in each parameter's range, so values and filenames
+    look the same as in the full grid. If two samples snap to the same combination, more
+    samples are drawn until there are sample_count different ones.
+    """
+    check_sample_count(sampling_mode, sample_count, logger)
+
+    combo_count = 1
+    for param_values in vary_param_values:
+        combo_count *= len(param_values)
+    if sample_count > combo_count:
+        logger.FAIL("Cannot sample {} parameter files, there are only {} possible combinations".format(sample_count, combo_count))
+
+    varied_idxs = [i for i, param_values in enumerate(vary_param_values) if len(param_values) > 1]
+    rng = np.random.default_rng(sampling_seed)
+
+    combos = []
+    seen_combos = set()
+    while len(combos) < sample_count:
+        points = unit_samples(sampling_mode, sample_count, len(varied_idxs), rng, logger)
+        for point in points:
+            value_idxs = [0] * len(vary_param_values)
+            for dim, param_idx in enumerate(varied_idxs):
+                value_count = len(vary_param_values[param_idx])
+                value_idxs[param_idx] = min(int(point[dim] * value_count), value_count - 1)
+            value_idxs = tuple(value_idxs)
+
+            if value_idxs in seen_combos:
+                continue
+            seen_combos.add(value_idxs)
+            combos.append(tuple(vary_param_values[i][value_idx] for i, value_idx in enumerate(value_idxs)))
+            if len(combos) == sample_count:
+                break
+
+    return combos
+
 def create_regular_soax_param_files(
     params_save_dir,
     param_settings,
     logger,
+    sampling_mode="grid",
+    sample_count=None,
+    sampling_seed=0,
+    max_param_files=None,
+    write_param_files=True,
+    write_batch_size=1000,
     ):
+    """ Creates parameter files in params_save_dir for combinations of the parameter ranges.
+
+    With sampling_mode 'grid' a file is made for every combination. With 'random',
+    'latin_hypercube' or 'sobol', exactly sample_count combinations are picked with the given
+    seed, so the same settings always give the same files.
+
+    Fails before writing anything if more than max_param_files files would be made. Every
+    parameter set, with its values and parameter file text, is listed in params_manifest.jsonl
+    in params_save_dir. With write_param_files False only the manifest is written, and
+    run_soax makes each parameter file when its job starts.
+    """
+    file_count = check_param_file_count(param_settings, sampling_mode, sample_count, max_param_files, logger)
 
     init_z = param_settings["init_z"]
     damp_z = param_settings["damp_z"]
@@ -205,8 +352,32 @@ def create_regular_soax_param_files(
 
     logger.log("Using param filename template {}".format(filename_template))
 
-    # all possible combinations of these parameters
-    param_combinations = itertools.product( *  vary_param_values)
+    if sampling_mode == "grid":
+        # all possible combinations of these parameters
+        param_combinations = itertools.product( *  vary_param_values)
+    else:
+        param_combinations = sample_param_combinations(vary_param_values, sampling_mode, sample_count, sampling_seed, logger)
+        logger.log("Sampled {} parameter combinations with {} sampling (seed {})".format(len(param_combinations), sampling_mode, sampling_seed))
+
+    if write_param_files:
+        logger.log("Writing {} parameter files to {}".format(file_count, params_save_dir))
+    else:
+        logger.log("Writing {} parameter sets to {}".format(file_count, os.path.join(params_save_dir, param_manifest_filename)))
+
+    manifest_file = open(os.path.join(params_save_dir, param_manifest_filename), "w")
+    written_count = 0
+    batch = []
+
+    def write_batch():
+        manifest_lines = []
+        for params_filename, params_text, manifest_record in batch:
+            if write_param_files:
+                with open(os.path.join(params_save_dir, params_filename), "w") as file:
+                    file.write(params_text)
+            manifest_lines.append(json.dumps(manifest_record) + "\n")
+        manifest_file.write("".join(manifest_lines))
+        manifest_file.flush()
+        batch.clear()
 
     for param_combo in param_combinations:
         param_combo_dict = {}
@@ -216,13 +387,29 @@ def create_regular_soax_param_files(
 
         params_filename = filename_template.format(**param_combo_dict)
 
-        fp = os.path.join(params_save_dir, params_filename)
-
         params_text = create_params(
             init_z=init_z,
             damp_z=damp_z,
             **param_combo_dict,
         )
 
-        with open(fp,"w") as file:
-            file.write(params_text)
+        manifest_record = param_manifest_record(params_filename, {
+            "init_z": init_z,
+            "damp_z": damp_z,
+            **param_combo_dict,
+        }, params_text)
+        batch.append((params_filename, params_text, manifest_record))
+
+        if len(batch) >= write_batch_size:
+            written_count += len(batch)
+            write_batch()
+            logger.log("Wrote {}/{} parameter sets".format(written_count, file_count))
+
+    written_count += len(batch)
+    write_batch()
+    manifest_file.close()
+
+    if write_param_files:
+        logger.success("Wrote {} parameter files and manifest {}".format(written_count, param_manifest_filename))
+    else:
+        logger.success("Wrote {} parameter sets to manifest {}".format(written_count, param_manifest_filename))
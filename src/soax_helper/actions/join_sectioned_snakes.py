@@ -1,8 +1,13 @@
 import os
 from multiprocessing.pool import ThreadPool
+import numpy as np
 
 from ..snakeutils.files import find_files_or_folders_at_depth, has_one_of_extensions
-from ..snakeutils.snakejson import load_json_snakes, save_json_snakes
+from ..snakeutils.snakeformats import load_snakes, save_snakes, snake_output_formats
+from ..snakeutils.progress import ProgressTracker
+from ..snakeutils.snakeset import SnakeSet
+from ..snakeutils.snakegraph import SnakeGraph
+from ..snakeutils.geometry import translate
 
 def join_snake_sections_folder_and_save(arg_dict):
     source_dir = arg_dict["source_dir"]
@@ -10,18 +15,17 @@ def join_snake_sections_folder_and_save(arg_dict):
     target_json_fp = arg_dict["target_json_fp"]
     logger = arg_dict["logger"]
 
-    new_snakes = []
-
-    shifted_snakes = []
+    shifted_snake_sets = []
+    shifted_graphs = []
 
     if len(source_filenames) == 0:
-        logger.FAIL("Cannot join snake files, source dir '{}' contains no snake jsons.".format(source_dir))
+        logger.FAIL("Cannot join snake files, source dir '{}' contains no snake files.".format(source_dir))
 
     logger.log("Loading snakes to join from {}".format(source_dir))
     # Make sure all sections have same units,
     # also keep track of size of the region that all of the sections cover
     first_sec_fp =  os.path.join(source_dir, source_filenames[0])
-    __, first_sec_metadata = load_json_snakes(first_sec_fp)
+    __, first_sec_metadata = load_snakes(first_sec_fp)
     pixel_spacing_um_xyz = first_sec_metadata["pixel_spacing_um_xyz"]
     first_sec_dims_xyz = first_sec_metadata["dims_pixels_xyz"]
     first_sec_offset_pixels_xyz = first_sec_metadata["offset_pixels_xyz"]
@@ -32,7 +36,7 @@ def join_snake_sections_folder_and_save(arg_dict):
     for snakes_fn in source_filenames:
         snakes_fp = os.path.join(source_dir, snakes_fn)
 
-        section_snakes, sec_metadata = load_json_snakes(snakes_fp)
+        section_snakes, sec_metadata, section_graph = load_snakes(snakes_fp, with_graph=True)
         if sec_metadata["pixel_spacing_um_xyz"] != pixel_spacing_um_xyz:
             logger.FAIL("Pixel spacing ")
 
@@ -48,39 +52,38 @@ def join_snake_sections_folder_and_save(arg_dict):
         if sec_z_upper > max_z:
             max_z = sec_z_upper
 
-        for snake in section_snakes:
-            shifted_snake = []
-            for snake_part in snake:
-                orig_pos = snake_part["pos"]
-
-                shifted_pos = [
-                    orig_pos[0] + sec_x_lower,
-                    orig_pos[1] + sec_y_lower,
-                    orig_pos[2] + sec_z_lower,
-                ]
-
-                shifted_snake.append({
-                    "pos": shifted_pos,
-                    "fg": snake_part["fg"],
-                    "bg": snake_part["bg"],
-                })
-            shifted_snakes.append(shifted_snake)
+        shifted_snake_sets.append(translate(section_snakes, [sec_x_lower, sec_y_lower, sec_z_lower]))
+        if section_graph is None:
+            shifted_graphs.append(None)
+        else:
+            shifted_graphs.append(section_graph.with_junction_positions(section_graph.junction_positions.astype(np.float64) + [sec_x_lower, sec_y_lower, sec_z_lower]))
     # We correct for the offset of all snake points, so the origin for snake coords is now
     # the origin of the original image
     pixels_offset = [0,0,0]
     dims_pixels_xyz = [max_x,max_y,max_z]
 
     logger.log(" Saving joined snakes as {}".format(target_json_fp))
-    save_json_snakes(target_json_fp, shifted_snakes, pixels_offset, dims_pixels_xyz, pixel_spacing_um_xyz)
+    # Junctions are only kept if every section has them
+    joined_graph = None
+    if all(graph is not None for graph in shifted_graphs):
+        joined_graph = SnakeGraph.concatenate(shifted_graphs, [len(snake_set) for snake_set in shifted_snake_sets])
+
+    save_snakes(target_json_fp, SnakeSet.concatenate(shifted_snake_sets), pixels_offset, dims_pixels_xyz, pixel_spacing_um_xyz, joined_graph)
+
+    return arg_dict["progress_group"]
 
 def join_sectioned_snakes(
     source_json_dir,
     target_json_dir,
     source_jsons_depth,
     workers,
-    logger):
+    logger,
+    progress_fp=None,
+    output_format="json"):
     if source_jsons_depth < 1:
         raise Exception("Cannot join sectioned snakes if subdir depth is less than 1. Need a subdirectory full of sectioned snake jsons to produce one joined snake json in the target dir.")
+    if output_format not in snake_output_formats:
+        logger.FAIL("Unknown snake output format '{}', expected one of {}".format(output_format, list(snake_output_formats.keys())))
     # The folders containing the source json files to be joined are one level less deep
     section_folder_depth = source_jsons_depth - 1
     source_folder_info = find_files_or_folders_at_depth(source_json_dir, section_folder_depth, folders_not_files=True)
@@ -97,20 +100,28 @@ def join_sectioned_snakes(
 
         source_folder_path = os.path.join(containing_folder, source_folder_name)
         source_files = [name for name in os.listdir(source_folder_path) if os.path.isfile(os.path.join(source_folder_path, name))]
-        source_jsons = [fn for fn in source_files if has_one_of_extensions(fn,[".json"])]
+        source_jsons = [fn for fn in source_files if has_one_of_extensions(fn, list(snake_output_formats.values()))]
         source_jsons.sort()
         if len(source_jsons) == 0:
-            logger.FAIL("No snake .json sections found in {}".format(source_folder_path))
+            logger.FAIL("No JSON or binary snake sections found in {}".format(source_folder_path))
 
-        target_json_fn = source_folder_name + ".json"
+        target_json_fn = source_folder_name + snake_output_formats[output_format]
         target_json_fp = os.path.join(target_dir_path, target_json_fn)
 
         join_sections_arg_dicts.append({
             "source_dir": source_folder_path,
             "source_filenames": source_jsons,
             "target_json_fp": target_json_fp,
+            "progress_group": relative_dir_path,
             "logger": logger,
         })
 
+    group_totals = {}
+    for arg_dict in join_sections_arg_dicts:
+        group_totals[arg_dict["progress_group"]] = group_totals.get(arg_dict["progress_group"], 0) + 1
+    progress = ProgressTracker("join_sectioned_snakes", len(join_sections_arg_dicts), logger, progress_fp=progress_fp, group_totals=group_totals)
+
     with ThreadPool(workers) as pool:
-        future = pool.map(join_snake_sections_folder_and_save, join_sections_arg_dicts, chunksize=1)
+        for progress_group in pool.imap_unordered(join_snake_sections_folder_and_save, join_sections_arg_dicts, chunksize=1):
+            progress.job_done(progress_group)
+    progress.close()
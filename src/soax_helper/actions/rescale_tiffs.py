@@ -9,6 +9,7 @@ from scipy.ndimage import zoom
 
 from ..snakeutils.files import find_files_or_folders_at_depth
 from ..snakeutils.tifimage import save_3d_tif, open_tiff_as_np_arr
+from ..snakeutils.progress import ProgressTracker
 
 def resize_frame(frame_arr, new_dims):
     data_type_max =  np.iinfo(frame_arr.dtype).max
@@ -99,6 +100,7 @@ def rescale_tiffs(
     output_dims,
     workers_num,
     logger,
+    progress_fp=None,
     ):
 
     source_tiffs_info = find_files_or_folders_at_depth(source_tiff_dir, 0, file_extensions=[".tif", ".tiff"])
@@ -125,5 +127,8 @@ def rescale_tiffs(
             "logger": logger,
         })
 
+    progress = ProgressTracker("rescale_tiffs", len(rescale_tiffs_arg_dicts), logger, progress_fp=progress_fp)
     with ThreadPool(workers_num) as pool:
-        future = pool.map(rescale_single_tiff, rescale_tiffs_arg_dicts, chunksize=1)
+        for __ in pool.imap_unordered(rescale_single_tiff, rescale_tiffs_arg_dicts, chunksize=1):
+            progress.job_done()
+    progress.close()
@@ -1,80 +1,395 @@
 import os
+import json
+import threading
 from multiprocessing.pool import ThreadPool
 import subprocess
-import tqdm
+import functools
+import shutil
 from ctypes import c_int32
 import time
 
-from ..snakeutils.files import find_files_or_folders_at_depth, find_tiffs_in_dir, has_one_of_extensions
+from ..snakeutils.files import find_files_or_folders_at_depth, find_tiffs_in_dir, has_one_of_extensions, count_snakes
+from ..snakeutils.tifimage import get_tiff_voxel_count
+from ..snakeutils.telemetry import run_command_with_rusage, run_command_capturing_output, TelemetryWriter, load_telemetry_records, log_telemetry_summary
+from ..snakeutils.progress import ProgressTracker
+from ..snakeutils.params import params_file_hash, open_param_store
+from ..snakeutils.resultcache import SnakeResultCache
+from ..snakeutils.runlog import RunLogWriter
+from ..snakeutils.threadbudget import available_cpus, partition_cpus, thread_limit_env, CpuSlots
 
 def soax_instance(soax_instance_args):
+    """ Runs one batch_soax process for a group of jobs that share an image.
+
+    A group of one job is run with the parameter file itself. Bigger groups are run with a
+    directory of their parameter files, so batch_soax only loads and preprocesses the
+    image once. batch_soax names those snake files '<image name>--<param name>.txt', and
+    they are moved to the same output folders that separate runs would have used.
+
+    Returns list with whether each job in the group succeeded.
+    """
     batch_soax_path = soax_instance_args["batch_soax_path"]
-    tiff_fp = soax_instance_args["tiff_fp"]
-    params_fp = soax_instance_args["params_fp"]
-    snakes_output_dir = soax_instance_args["snakes_output_dir"]
-    logging_dir = soax_instance_args["logging_dir"]
+    jobs = soax_instance_args["jobs"]
     delete_soax_logs_for_finished_runs = soax_instance_args["delete_soax_logs_for_finished_runs"]
+    base_logging_dir = soax_instance_args["base_logging_dir"]
+    result_cache = soax_instance_args["result_cache"]
+    cpu_slots = soax_instance_args["cpu_slots"]
+    pin_cpus = soax_instance_args["pin_cpus"]
+    telemetry_writer = soax_instance_args["telemetry_writer"]
+    run_log = soax_instance_args["run_log"]
+    param_stores = soax_instance_args["param_stores"]
     logger = soax_instance_args["logger"]
 
-    make_dir_if_not_exist(snakes_output_dir, logger)
-    make_dir_if_not_exist(logging_dir, logger)
-
-    stdout_fp = os.path.join(logging_dir, "stdout.txt")
-    stderr_fp = os.path.join(logging_dir, "stderr.txt")
-    runtime_fp = os.path.join(logging_dir, "runtime.txt")
-
-    success = None
-    start = time.time()
-    with open(stdout_fp,"w") as stdout_file, open(stderr_fp,"w") as error_file, open(runtime_fp, "w") as runtime_file:
-        command = "{batch_soax_path} --image {tiff_fp} --parameter {params_fp} --snake {snakes_output_dir}".format(
-            batch_soax_path = batch_soax_path,
-            tiff_fp=tiff_fp,
-            params_fp=params_fp,
-            snakes_output_dir=snakes_output_dir,
+    tiff_fp = jobs[0]["tiff_fp"]
+    # batch_soax names the snake file after the image
+    image_name_extensionless = os.path.splitext(os.path.basename(tiff_fp))[0]
+    snakes_fps = [os.path.join(job["snakes_output_dir"], image_name_extensionless + ".txt") for job in jobs]
+
+    successes = [None] * len(jobs)
+    cache_keys = [None] * len(jobs)
+    job_idxs_to_run = []
+    for job_idx, job in enumerate(jobs):
+        cache_keys[job_idx], found_in_cache = prepare_soax_job(
+            job,
+            snakes_fps[job_idx],
+            batch_soax_path,
+            result_cache,
+            param_stores,
+            logger,
+        )
+        if found_in_cache:
+            successes[job_idx] = True
+        else:
+            job_idxs_to_run.append(job_idx)
+
+    if len(job_idxs_to_run) == 0:
+        remove_stored_params_files(jobs, successes, base_logging_dir)
+        return successes
+
+    jobs_to_run = [jobs[job_idx] for job_idx in job_idxs_to_run]
+    is_grouped = len(jobs_to_run) > 1
+    logging_dir, params_arg, snakes_arg = soax_group_paths(jobs_to_run, logger)
+    command_args = [
+        batch_soax_path,
+        "--image", tiff_fp,
+        "--parameter", params_arg,
+        "--snake", snakes_arg,
+    ]
+    run = run_batch_soax(command_args, logging_dir, jobs_to_run, cpu_slots, pin_cpus, run_log, logger)
+
+    try:
+        input_voxels = get_tiff_voxel_count(tiff_fp)
+    except Exception:
+        input_voxels = None
+
+    for job_idx in job_idxs_to_run:
+        job = jobs[job_idx]
+        success = run["exit_code"] == 0
+
+        if success and is_grouped:
+            grouped_snakes_fp = os.path.join(snakes_arg, "{}--{}.txt".format(image_name_extensionless, job["param_name"]))
+            if os.path.isfile(grouped_snakes_fp):
+                os.replace(grouped_snakes_fp, snakes_fps[job_idx])
+            else:
+                logger.error("batch_soax did not write {} for parameters {}".format(grouped_snakes_fp, job["param_name"]))
+                success = False
+
+        finish_soax_job(
+            job,
+            snakes_fps[job_idx],
+            success,
+            cache_keys[job_idx],
+            run,
+            len(jobs_to_run),
+            input_voxels,
+            batch_soax_path,
+            result_cache,
+            telemetry_writer,
+            logger,
+        )
+        successes[job_idx] = success
+
+    if run_log is not None:
+        run_log.write(
+            run["run_log_job_ids"],
+            {
+                "command": run["command"],
+                "image": tiff_fp,
+                "params": params_arg,
+                "exit_code": run["exit_code"],
+                "runtime_s": run["elapsed_seconds"],
+            },
+            run["stdout_bytes"],
+            run["stderr_bytes"],
+            keep_full_output=not all(successes),
         )
 
-        logger.log("Executing '{}'\n    (stdout in '{}' and stderr in '{}')".format(command, stdout_fp, stderr_fp))
+    # With a run log there are no log files, only the scratch files of a group to clean up
+    if all(successes) and (delete_soax_logs_for_finished_runs or run_log is not None):
         try:
-            code = subprocess.run(command,shell=True,stdout=stdout_file,stderr=error_file,check=True).returncode
-            logger.success("Completed {}".format(command))
-
-            end = time.time()
-            elapsed_seconds = end - start
-            runtime_file.write("process runtime (seconds):" + str(elapsed_seconds))
-            success = True
-        except subprocess.CalledProcessError as e:
+            if is_grouped:
+                shutil.rmtree(logging_dir)
+            elif run_log is None:
+                os.remove(run["stderr_fp"])
+                os.remove(run["stdout_fp"])
+                os.remove(run["runtime_fp"])
+            remove_empty_log_dirs(jobs_to_run[0]["logging_dir"], base_logging_dir)
+        except:
+            pass
+
+    remove_stored_params_files(jobs, successes, base_logging_dir)
+
+    return successes
+
+def prepare_soax_job(job, snakes_fp, batch_soax_path, result_cache, param_stores, logger):
+    """ Gets a job ready to be run, whether on its own or in a group.
+
+    Returns (cache_key, found_in_cache). If the result cache already has snakes for the
+    job, they are saved in snakes_fp and shared with the job's duplicates, and the job
+    doesn't need to run.
+    """
+    # Parameter sets from a manifest only get a parameter file now that their job is starting
+    if job["params_store"] is not None:
+        make_dir_if_not_exist(os.path.dirname(job["params_fp"]), logger)
+        param_stores[job["params_store"]].write_params_file(job["param_name"], job["params_fp"])
+
+    make_dir_if_not_exist(job["snakes_output_dir"], logger)
+
+    if result_cache is None:
+        return None, False
+
+    cache_key = result_cache.result_key(batch_soax_path, job["tiff_fp"], job["params_fp"])
+    if not result_cache.get(cache_key, snakes_fp):
+        return cache_key, False
+
+    logger.log("Reused cached snakes for {} with {} in {}".format(job["tiff_fp"], job["params_fp"], snakes_fp))
+    copy_snakes_to_duplicates(job, snakes_fp, logger)
+    return cache_key, True
+
+def soax_group_paths(jobs_to_run, logger):
+    """ Returns (logging_dir, params_arg, snakes_arg) for the batch_soax process running
+    jobs_to_run. A single job is run with its own parameter file and output folder """
+    if len(jobs_to_run) == 1:
+        return jobs_to_run[0]["logging_dir"], jobs_to_run[0]["params_fp"], jobs_to_run[0]["snakes_output_dir"]
+
+    # Logs and scratch files of the group are kept with the logs of its first job
+    logging_dir = os.path.join(jobs_to_run[0]["logging_dir"], "param_group")
+    params_arg = os.path.join(logging_dir, "params")
+    snakes_arg = os.path.join(logging_dir, "snakes")
+    make_dir_if_not_exist(params_arg, logger)
+    make_dir_if_not_exist(snakes_arg, logger)
+    for job in jobs_to_run:
+        shutil.copyfile(job["params_fp"], os.path.join(params_arg, job["param_name"] + ".txt"))
+
+    return logging_dir, params_arg, snakes_arg
+
+def run_batch_soax(command_args, logging_dir, jobs_to_run, cpu_slots, pin_cpus, run_log, logger):
+    """ Runs batch_soax and logs how it went. Output goes to files in logging_dir, or to
+    run_log if there is one.
+
+    Returns dict with the command, its exit code (None if it couldn't be started), resource
+    usage, start time, elapsed seconds and thread limit, the captured output and where the
+    output was saved.
+    """
+    command = " ".join(command_args)
+    run = {
+        "command": command,
+        "exit_code": None,
+        "resource_usage": None,
+        "stdout_bytes": b"",
+        "stderr_bytes": b"",
+        "stdout_fp": None,
+        "stderr_fp": None,
+        "runtime_fp": None,
+        "run_log_job_ids": None,
+    }
+
+    if run_log is None:
+        make_dir_if_not_exist(logging_dir, logger)
+        run["stdout_fp"] = os.path.join(logging_dir, "stdout.txt")
+        run["stderr_fp"] = os.path.join(logging_dir, "stderr.txt")
+        run["runtime_fp"] = os.path.join(logging_dir, "runtime.txt")
+        logger.log("Executing '{}'\n    (stdout in '{}' and stderr in '{}')".format(command, run["stdout_fp"], run["stderr_fp"]))
+    else:
+        # Every job of a group gets an entry in the run log, so each can be looked up by its own name
+        run["run_log_job_ids"] = [run_log.job_id(job["logging_dir"]) for job in jobs_to_run]
+        logger.log("Executing '{}'\n    (output saved in run log {} as {})".format(command, run_log.log_fp, ", ".join(run["run_log_job_ids"])))
+
+    # With a thread budget, each running job gets its own share of the CPUs and batch_soax
+    # is told to only start that many threads
+    cpu_set = None
+    env = None
+    if cpu_slots is not None:
+        cpu_set = cpu_slots.acquire()
+        env = thread_limit_env(len(cpu_set))
+    run["thread_limit"] = None if cpu_set is None else len(cpu_set)
+
+    run["start_time"] = time.time()
+    try:
+        if run_log is None:
+            with open(run["stdout_fp"],"w") as stdout_file, open(run["stderr_fp"],"w") as error_file:
+                run["exit_code"], run["resource_usage"] = run_command_with_rusage(
+                    command_args,
+                    stdout=stdout_file,
+                    stderr=error_file,
+                    env=env,
+                    cpu_affinity=cpu_set if pin_cpus else None,
+                )
+        else:
+            run["exit_code"], run["resource_usage"], run["stdout_bytes"], run["stderr_bytes"] = run_command_capturing_output(
+                command_args,
+                env=env,
+                cpu_affinity=cpu_set if pin_cpus else None,
+            )
+    except OSError as e:
+        logger.error("ERROR: ")
+        logger.error("  Failed to start '{}': {}".format(command, repr(e)))
+        run["stderr_bytes"] = repr(e).encode()
+    finally:
+        if cpu_set is not None:
+            cpu_slots.release(cpu_set)
+
+    run["elapsed_seconds"] = time.time() - run["start_time"]
+
+    if run["exit_code"] == 0:
+        logger.success("Completed {}".format(command))
+        if run_log is None:
+            with open(run["runtime_fp"], "w") as runtime_file:
+                runtime_file.write("process runtime (seconds):" + str(run["elapsed_seconds"]))
+    else:
+        if run["exit_code"] is not None:
             logger.error("ERROR: ")
-            logger.error("  Failed to run '{}' - return code {}".format(command,e.returncode))
-            logger.error("    STDERR saved in {}".format(stderr_fp))
-            logger.error("    STDOUT saved in {}".format(stdout_fp))
-            success = False
+            logger.error("  Failed to run '{}' - return code {}".format(command, run["exit_code"]))
+        if run_log is None:
+            logger.error("    STDERR saved in {}".format(run["stderr_fp"]))
+            logger.error("    STDOUT saved in {}".format(run["stdout_fp"]))
+        else:
+            logger.error("    Output saved in run log {} as {}".format(run_log.log_fp, ", ".join(run["run_log_job_ids"])))
+
+    return run
+
+def finish_soax_job(
+    job,
+    snakes_fp,
+    success,
+    cache_key,
+    run,
+    group_size,
+    input_voxels,
+    batch_soax_path,
+    result_cache,
+    telemetry_writer,
+    logger,
+):
+    """ Records the telemetry of a job that was run, and if it succeeded saves its snakes
+    in the result cache and shares them with the job's duplicates """
+    snake_count = None
+    if success and os.path.isfile(snakes_fp):
+        with open(snakes_fp, "r") as snakes_file:
+            snake_count = count_snakes(snakes_file)
+
+    telemetry_writer.write(soax_job_telemetry_record(job, run, group_size, input_voxels, snake_count))
+
+    if not success or not os.path.isfile(snakes_fp):
+        return
+
+    if result_cache is not None:
+        result_cache.put(cache_key, snakes_fp, {
+            "image": job["tiff_fp"],
+            "param_file": job["params_fp"],
+            "batch_soax_path": batch_soax_path,
+        })
+    copy_snakes_to_duplicates(job, snakes_fp, logger)
+
+def soax_job_telemetry_record(job, run, group_size, input_voxels, snake_count):
+    resource_usage = run["resource_usage"]
+    # Jobs run together share the time of the process, so the times are split evenly
+    # between them to keep totals per parameter set comparable to separate runs
+    return {
+        "image": job["tiff_fp"],
+        "image_name": job["image_name"],
+        "param_file": os.path.basename(job["params_fp"]),
+        "param_name": job["param_name"],
+        "start_time": run["start_time"],
+        "wall_time_s": run["elapsed_seconds"] / group_size,
+        "user_time_s": None if resource_usage is None else resource_usage["user_time_s"] / group_size,
+        "system_time_s": None if resource_usage is None else resource_usage["system_time_s"] / group_size,
+        "peak_rss_bytes": None if resource_usage is None else resource_usage["peak_rss_bytes"],
+        "input_voxels": input_voxels,
+        "exit_code": run["exit_code"],
+        "snake_count": snake_count,
+        "thread_limit": run["thread_limit"],
+        "group_size": group_size,
+    }
 
-    if success and delete_soax_logs_for_finished_runs:
+def remove_stored_params_files(jobs, successes, base_logging_dir):
+    """ Deletes parameter files made from a manifest for jobs that succeeded. Files of failed
+    jobs are kept next to their logs """
+    for job, success in zip(jobs, successes):
+        if job["params_store"] is None or not success:
+            continue
         try:
-            os.remove(stderr_fp)
-            os.remove(stdout_fp)
-            os.remove(runtime_fp)
-            if len(os.listdir(logging_dir)) == 0:
-                os.rmdir(logging_dir)
-        except:
+            os.remove(job["params_fp"])
+        except OSError:
             pass
-
-def soax_args_for_tiff_and_param_file(
+        remove_empty_log_dirs(job["logging_dir"], base_logging_dir)
+
+def remove_empty_log_dirs(logging_dir, base_logging_dir):
+    """ Removes logging_dir if it is empty, then each folder above it up to base_logging_dir
+    that is left empty, so finished jobs don't leave behind a folder per parameter file """
+    base_logging_dir = os.path.abspath(base_logging_dir)
+    dirpath = os.path.abspath(logging_dir)
+    while dirpath.startswith(base_logging_dir + os.sep):
+        try:
+            os.rmdir(dirpath)
+        except OSError:
+            # Not empty, or already removed by another job
+            if os.path.isdir(dirpath):
+                return
+        dirpath = os.path.dirname(dirpath)
+
+def link_or_copy_file(source_fp, target_fp):
+    """ Hard links target_fp to source_fp so it doesn't take up more disk space, or copies it
+    if the filesystem doesn't support that. An existing target_fp is replaced """
+    if os.path.lexists(target_fp):
+        os.remove(target_fp)
+    try:
+        os.link(source_fp, target_fp)
+    except OSError:
+        shutil.copy2(source_fp, target_fp)
+
+def copy_snakes_to_duplicates(job, snakes_fp, logger):
+    """ Duplicate jobs have equivalent parameters, so they get the snakes of the job that
+    was actually run """
+    for duplicate in job["duplicates"]:
+        make_dir_if_not_exist(duplicate["snakes_output_dir"], logger)
+        duplicate_snakes_fp = os.path.join(duplicate["snakes_output_dir"], os.path.basename(snakes_fp))
+        link_or_copy_file(snakes_fp, duplicate_snakes_fp)
+        logger.log("Linked {} to {} (equivalent parameters)".format(duplicate_snakes_fp, snakes_fp))
+
+def soax_args_for_job_group(
     batch_soax_path,
-    tiff_fp,
-    params_fp,
-    snakes_dir,
-    logging_dir,
+    jobs,
     delete_soax_logs_for_finished_runs,
+    base_logging_dir,
+    result_cache,
+    cpu_slots,
+    pin_cpus,
+    telemetry_writer,
+    run_log,
+    param_stores,
     logger,
 ):
     return {
         "batch_soax_path": batch_soax_path,
-        "tiff_fp":  tiff_fp,
-        "params_fp":  params_fp,
-        "snakes_output_dir": snakes_dir,
-        "logging_dir": logging_dir,
+        "jobs": jobs,
         "delete_soax_logs_for_finished_runs": delete_soax_logs_for_finished_runs,
+        "base_logging_dir": base_logging_dir,
+        "result_cache": result_cache,
+        "cpu_slots": cpu_slots,
+        "pin_cpus": pin_cpus,
+        "telemetry_writer": telemetry_writer,
+        "run_log": run_log,
+        "param_stores": param_stores,
         "logger": logger,
     }
 
@@ -89,173 +404,414 @@ def make_dir_if_not_exist(dirpath, logger):
     if not os.path.isdir(dirpath):
         logger.FAIL("Failed to create directory {}".format(dirpath))
 
-def run_soax(
-    batch_soax_path,
+def find_soax_job_sources(
     base_image_dir,
     base_params_dir,
-    base_output_dir,
-    base_logging_dir,
     use_sectioned_images,
     use_image_specific_params,
-    delete_soax_logs_for_finished_runs,
-    workers_num,
     logger,
 ):
-    soax_instance_arg_dicts = []
+    """ Lists the images (or image sections) and parameter files that run_soax will combine.
+
+    Returns a list with one entry per image:
+    {
+        "image_name": name of the image, or of the folder of sections for sectioned images,
+        "sections": [(section name, tiff path), ...] - just the image itself if not sectioned,
+        "param_files": [(param name, param file path), ...],
+        "unique_param_files": [(param name, param file path, [names of params with identical content]), ...],
+        "param_store": ParamSetStore if the parameters come from a manifest, or None,
+    }
+    Each parameter directory is only listed once, entries that use the same parameter directory
+    share the same param_files lists.
+
+    A parameter directory without parameter files but with a params_manifest.jsonl is run
+    with the parameter sets in the manifest. Their param file paths are None, the files are
+    only made when each job starts.
+
+    Param files whose contents are the same except for formatting would make batch_soax give the
+    same snakes for an image, so only the first of them is in unique_param_files.
+    """
+    if use_sectioned_images:
+        sectioned_image_folders_info = find_files_or_folders_at_depth(base_image_dir, 0, folders_not_files=True)
+        image_names = [dirname for containing_path, dirname in sectioned_image_folders_info]
+        image_kind = "sectioned image directories"
+    else:
+        tiff_filenames = find_tiffs_in_dir(base_image_dir)
+        image_names = [os.path.splitext(tiff_fn)[0] for tiff_fn in tiff_filenames]
+        tiff_fps = [os.path.join(base_image_dir, tiff_fn) for tiff_fn in tiff_filenames]
+        image_kind = "images"
 
     if use_image_specific_params:
         param_dirs_info = find_files_or_folders_at_depth(base_params_dir, 0, folders_not_files=True)
         param_dirnames = [dirname for containing_path, dirname in param_dirs_info]
 
-        if not use_sectioned_images:
-            tiff_filenames = find_tiffs_in_dir(base_image_dir)
-
-            # Check that there is exactly one param dir for each tiff
-            if len(param_dirnames) != len(tiff_filenames):
-                logger.FAIL(("Expected same number of images as param directories, "
-                    "but found {} images in {} and {} param directories in {}").format(
-                        len(tiff_filenames), base_image_dir,len(param_dirnames), base_params_dir,
-                ))
-
-            # Match image files and param directories together
-            for image_num, (param_dirname_for_tiff, tiff_fn) in enumerate(zip(param_dirnames, tiff_filenames), start=1):
-                image_name_extensionless = os.path.splitext(tiff_fn)[0]
-                # Check that image name matches with param dir name
-                if image_name_extensionless != param_dirname_for_tiff:
-                    logger.FAIL(("Parameter folder names in {} and image names in {} don't match: "
-                        "At image # {}, {} doesn't match with {}").format(
-                            base_params_dir, base_image_dir,
-                            image_num, param_dirname_for_tiff, tiff_fn
-                        ))
-                image_path = os.path.join(base_image_dir, tiff_fn)
-                param_folder_path_for_tiff = os.path.join(base_params_dir, param_dirname_for_tiff)
-
-                param_filenames = find_param_files_in_dir(param_folder_path_for_tiff)
-
-                for param_filename in param_filenames:
-                    param_name_extensionless = os.path.splitext(param_filename)[0]
-                    param_filepath = os.path.join(param_folder_path_for_tiff, param_filename)
-
-                    snakes_target_dir = os.path.join(base_output_dir, param_name_extensionless)
-                    logging_target_dir = os.path.join(base_logging_dir, param_name_extensionless, image_name_extensionless)
-
-                    soax_instance_arg_dicts.append(soax_args_for_tiff_and_param_file(
-                        batch_soax_path,
-                        image_path,
-                        param_filepath,
-                        snakes_target_dir,
-                        logging_target_dir,
-                        delete_soax_logs_for_finished_runs,
-                        logger,
+        # Check that there is exactly one param dir for each image
+        if len(param_dirnames) != len(image_names):
+            logger.FAIL(("Expected same number of {} as param directories, "
+                "but found {} {} in {} and {} param directories in {}").format(
+                    image_kind,
+                    len(image_names), image_kind, base_image_dir, len(param_dirnames), base_params_dir,
+            ))
+
+        # Check that image names match with param dir names
+        for image_num, (param_dirname, image_name) in enumerate(zip(param_dirnames, image_names), start=1):
+            if image_name != param_dirname:
+                logger.FAIL(("Parameter folder names in {} and image names in {} don't match: "
+                    "At image # {}, {} doesn't match with {}").format(
+                        base_params_dir, base_image_dir,
+                        image_num, param_dirname, image_name
                     ))
 
-        # Using sectioned images
+    param_files_by_dir = {}
+    def param_files_in(params_dirpath):
+        if params_dirpath not in param_files_by_dir:
+            param_files = [
+                (os.path.splitext(param_fn)[0], os.path.join(params_dirpath, param_fn))
+                for param_fn in find_param_files_in_dir(params_dirpath)
+            ]
+            param_store = None
+            if len(param_files) == 0:
+                param_store = open_param_store(params_dirpath)
+                if param_store is not None:
+                    logger.log("Using {} parameter sets from {}".format(len(param_store), param_store.manifest_fp))
+                    param_files = [(param_id, None) for param_id in param_store.ids]
+            param_files_by_dir[params_dirpath] = (param_files, find_unique_param_files(param_files, param_store), param_store)
+        return param_files_by_dir[params_dirpath]
+
+    job_sources = []
+    for image_idx, image_name in enumerate(image_names):
+        if use_sectioned_images:
+            sectioned_image_dirpath = os.path.join(base_image_dir, image_name)
+            sections = [
+                (os.path.splitext(section_fn)[0], os.path.join(sectioned_image_dirpath, section_fn))
+                for section_fn in find_tiffs_in_dir(sectioned_image_dirpath)
+            ]
         else:
-            sectioned_image_folders_info = find_files_or_folders_at_depth(base_image_dir, 0, folders_not_files=True)
-            sectioned_image_folder_names = [dirname for containing_path, dirname in sectioned_image_folders_info]
-
-            # Check that there is exactly one param dir for each sectioned image dir
-            if len(param_dirnames) != len(sectioned_image_folder_names):
-                logger.FAIL(("Expected same number of sectioned image directories as param directories, "
-                    "but found {} sectioned image directories in {} and {} param directories in {}").format(
-                        len(sectioned_image_folder_names), base_image_dir, len(param_dirnames), base_params_dir,
-                ))
+            sections = [(image_name, tiff_fps[image_idx])]
 
-            # Match sectioned image directories and param directories together
-            for image_num, (param_dirname_for_image, sectioned_image_dirname) in enumerate(zip(param_dirnames, sectioned_image_folder_names)):
-                # Check that image name matches with param dir name
-                if sectioned_image_dirname != param_dirname_for_image:
-                    logger.FAIL(("Parameter folder names in {} and image names in {} don't match: "
-                        "At image # {}, {} doesn't match with {}").format(
-                            base_params_dir, base_image_dir,
-                            image_num, param_dirname_for_image, sectioned_image_dirname
-                        ))
-
-                sectioned_image_dirpath = os.path.join(base_image_dir, sectioned_image_dirname)
-                param_folder_path_for_image = os.path.join(base_params_dir, param_dirname_for_image)
-
-                image_section_tiff_names = find_tiffs_in_dir(sectioned_image_dirpath)
-                param_filenames = find_param_files_in_dir(param_folder_path_for_image)
-
-                for image_section_fn in image_section_tiff_names:
-                    image_section_tiff_path = os.path.join(sectioned_image_dirpath, image_section_fn)
-                    section_name_extensionless = os.path.splitext(image_section_fn)[0]
-
-                    for param_fn in param_filenames:
-                        param_filepath = os.path.join(param_folder_path_for_image, param_fn)
-                        param_name_extensionless = os.path.splitext(param_fn)[0]
-
-                        snakes_target_dir = os.path.join(base_output_dir, param_name_extensionless, sectioned_image_dirname)
-                        logging_target_dir = os.path.join(base_logging_dir, param_name_extensionless, sectioned_image_dirname, section_name_extensionless)
-
-                        soax_instance_arg_dicts.append(soax_args_for_tiff_and_param_file(
-                            batch_soax_path,
-                            image_section_tiff_path,
-                            param_filepath,
-                            snakes_target_dir,
-                            logging_target_dir,
-                            delete_soax_logs_for_finished_runs,
-                            logger,
-                        ))
-    else:
-        if not use_sectioned_images:
-            tiff_filenames = find_tiffs_in_dir(base_image_dir)
-
-            for tiff_fn in tiff_filenames:
-                image_name_extensionless = os.path.splitext(tiff_fn)[0]
-                image_path = os.path.join(base_image_dir, tiff_fn)
-
-                param_filenames = find_param_files_in_dir(base_params_dir)
-
-                for param_fn in param_filenames:
-                    param_name_extensionless = os.path.splitext(param_fn)[0]
-                    param_filepath = os.path.join(base_params_dir, param_fn)
-
-                    snakes_target_dir = os.path.join(base_output_dir, param_name_extensionless)
-                    logging_target_dir = os.path.join(base_logging_dir, param_name_extensionless, image_name_extensionless)
-
-                    soax_instance_arg_dicts.append(soax_args_for_tiff_and_param_file(
-                        batch_soax_path,
-                        image_path,
-                        param_filepath,
-                        snakes_target_dir,
-                        logging_target_dir,
-                        delete_soax_logs_for_finished_runs,
-                        logger,
-                    ))
+        if use_image_specific_params:
+            params_dirpath = os.path.join(base_params_dir, image_name)
         else:
-            sectioned_image_folders_info = find_files_or_folders_at_depth(base_image_dir, 0, folders_not_files=True)
-            sectioned_image_folder_names = [dirname for containing_path, dirname in sectioned_image_folders_info]
-
-            for sectioned_image_dirname in sectioned_image_folder_names:
-                sectioned_image_dirpath = os.path.join(base_image_dir, sectioned_image_dirname)
-
-                image_section_tiff_names = find_tiffs_in_dir(sectioned_image_dirpath)
-                param_filenames = find_param_files_in_dir(base_params_dir)
-
-                for image_section_fn in image_section_tiff_names:
-                    image_section_tiff_path = os.path.join(sectioned_image_dirpath, image_section_fn)
-                    section_name_extensionless = os.path.splitext(image_section_fn)[0]
-
+            params_dirpath = base_params_dir
+        param_files, unique_param_files, param_store = param_files_in(params_dirpath)
+
+        job_sources.append({
+            "image_name": image_name,
+            "sections": sections,
+            "param_files": param_files,
+            "unique_param_files": unique_param_files,
+            "param_store": param_store,
+        })
+
+    return job_sources
+
+def find_unique_param_files(param_files, param_store=None):
+    unique_param_files = []
+    duplicate_names_by_hash = {}
+
+    for param_name, params_fp in param_files:
+        if params_fp is None:
+            params_hash = param_store.params_hash(param_name)
+        else:
+            params_hash = params_file_hash(params_fp)
+        if params_hash in duplicate_names_by_hash:
+            duplicate_names_by_hash[params_hash].append(param_name)
+        else:
+            duplicate_names_by_hash[params_hash] = []
+            unique_param_files.append((param_name, params_fp, duplicate_names_by_hash[params_hash]))
+
+    return unique_param_files
+
+def count_soax_jobs(job_sources):
+    return sum(len(source["sections"]) * len(source["param_files"]) for source in job_sources)
+
+def count_unique_soax_jobs(job_sources):
+    return sum(len(source["sections"]) * len(source["unique_param_files"]) for source in job_sources)
+
+def count_soax_jobs_by_param_name(job_sources):
+    job_counts = {}
+    for source in job_sources:
+        section_count = len(source["sections"])
+        for param_name, params_fp in source["param_files"]:
+            job_counts[param_name] = job_counts.get(param_name, 0) + section_count
+    return job_counts
+
+def iter_soax_jobs(job_sources, base_output_dir, base_logging_dir, use_sectioned_images):
+    """ Yields a dict for each batch_soax job, one at a time, so a big parameter sweep
+    doesn't need the whole list of jobs in memory before the first job can start.
+    Jobs with the same image and equivalent parameters as an earlier job aren't yielded, they
+    are listed in the "duplicates" of the earlier job instead.
+    """
+    for source in job_sources:
+        image_name = source["image_name"]
+        param_store = source["param_store"]
+
+        for section_name, tiff_fp in source["sections"]:
+            def job_dirs(param_name):
+                if use_sectioned_images:
+                    snakes_output_dir = os.path.join(base_output_dir, param_name, image_name)
+                    logging_dir = os.path.join(base_logging_dir, param_name, image_name, section_name)
+                else:
+                    snakes_output_dir = os.path.join(base_output_dir, param_name)
+                    logging_dir = os.path.join(base_logging_dir, param_name, image_name)
+                return snakes_output_dir, logging_dir
+
+            for param_name, params_fp, duplicate_param_names in source["unique_param_files"]:
+                snakes_output_dir, logging_dir = job_dirs(param_name)
+                if param_store is not None:
+                    params_fp = os.path.join(logging_dir, param_name + ".txt")
+
+                duplicates = []
+                for duplicate_param_name in duplicate_param_names:
+                    duplicate_snakes_output_dir, __ = job_dirs(duplicate_param_name)
+                    duplicates.append({
+                        "param_name": duplicate_param_name,
+                        "snakes_output_dir": duplicate_snakes_output_dir,
+                    })
+
+                yield {
+                    "tiff_fp": tiff_fp,
+                    "params_fp": params_fp,
+                    "snakes_output_dir": snakes_output_dir,
+                    "logging_dir": logging_dir,
+                    "param_name": param_name,
+                    "image_name": image_name,
+                    "duplicates": duplicates,
+                    "params_store": None if param_store is None else param_store.manifest_fp,
+                }
+
+def iter_soax_job_groups(jobs, group_size):
+    """ Groups consecutive jobs that use the same image into lists of at most group_size jobs """
+    group = []
+    for job in jobs:
+        if len(group) == group_size or (len(group) > 0 and group[0]["tiff_fp"] != job["tiff_fp"]):
+            yield group
+            group = []
+        group.append(job)
+    if len(group) > 0:
+        yield group
+
+def write_soax_job_plan(
+    plan_file,
+    base_image_dir,
+    base_params_dir,
+    base_output_dir,
+    base_logging_dir,
+    use_sectioned_images,
+    use_image_specific_params,
+    logger,
+):
+    """ Writes the jobs run_soax would run to plan_file as JSON lines, without running anything """
+    job_sources = find_soax_job_sources(
+        base_image_dir,
+        base_params_dir,
+        use_sectioned_images,
+        use_image_specific_params,
+        logger,
+    )
+
+    job_count = 0
+    for job in iter_soax_jobs(job_sources, base_output_dir, base_logging_dir, use_sectioned_images):
+        plan_file.write(json.dumps(job) + "\n")
+        job_count += 1
+
+    section_count = sum(len(source["sections"]) for source in job_sources)
+    param_names = set()
+    for source in job_sources:
+        param_names.update(param_name for param_name, params_fp in source["param_files"])
+
+    logger.log("Planned {} batch_soax jobs".format(job_count))
+    saved_job_count = count_soax_jobs(job_sources) - job_count
+    if saved_job_count > 0:
+        logger.log("    {} more jobs have parameters equivalent to a planned job, and would reuse its snakes".format(saved_job_count))
+    logger.log("    {} images in {}".format(len(job_sources), base_image_dir))
+    if use_sectioned_images:
+        logger.log("    {} image sections".format(section_count))
+    logger.log("    {} distinct parameter sets in {}".format(len(param_names), base_params_dir))
+
+    return job_count
 
-                    for param_fn in param_filenames:
-                        param_filepath = os.path.join(base_params_dir, param_fn)
-                        param_name_extensionless = os.path.splitext(param_fn)[0]
+def run_soax(
+    batch_soax_path,
+    base_image_dir,
+    base_params_dir,
+    base_output_dir,
+    base_logging_dir,
+    use_sectioned_images,
+    use_image_specific_params,
+    delete_soax_logs_for_finished_runs,
+    workers_num,
+    logger,
+    progress_fp=None,
+    result_cache_dir=None,
+    result_cache_max_gb=None,
+    use_thread_budget=False,
+    pin_cpus=False,
+    param_group_size=1,
+    use_run_log=False,
+):
+    """ Runs batch_soax on every combination of image (or image section) and parameter file.
+
+    By default every batch_soax process starts one thread per core, so with several workers
+    there are workers * cores threads competing for the CPUs. With use_thread_budget the
+    available CPUs are split between the workers and each batch_soax process is limited to
+    its share of threads. pin_cpus additionally restricts each process to its CPUs.
+
+    With param_group_size bigger than 1, up to that many parameter files for the same image
+    are given to one batch_soax process as a directory, so the image is only loaded once.
+    This needs a batch_soax that accepts a directory of parameter files.
+
+    With use_run_log, the output of every batch_soax process is kept in one compressed run
+    log in base_logging_dir instead of separate log files for each job.
+    """
+    if pin_cpus and not use_thread_budget:
+        logger.FAIL("Pinning batch_soax processes to CPUs needs the thread budget to be enabled")
+    if pin_cpus and not hasattr(os, "sched_setaffinity"):
+        logger.FAIL("Pinning batch_soax processes to CPUs is not supported on this platform")
+
+    job_sources = find_soax_job_sources(
+        base_image_dir,
+        base_params_dir,
+        use_sectioned_images,
+        use_image_specific_params,
+        logger,
+    )
+    job_count = count_soax_jobs(job_sources)
+    saved_job_count = job_count - count_unique_soax_jobs(job_sources)
+
+    # One telemetry file per run, so it's kept even if logs for finished jobs are deleted.
+    # The process id keeps runs started in the same second from sharing files
+    make_dir_if_not_exist(base_logging_dir, logger)
+    run_id = "{}_{}".format(time.strftime("%Y%m%d_%H%M%S"), os.getpid())
+    telemetry_fp = os.path.join(base_logging_dir, "soax_telemetry_{}.jsonl".format(run_id))
+    telemetry_writer = TelemetryWriter(telemetry_fp)
+
+    if use_run_log:
+        run_log = RunLogWriter(os.path.join(base_logging_dir, "soax_run_log_{}.log.gz".format(run_id)))
+    else:
+        run_log = None
 
-                        snakes_target_dir = os.path.join(base_output_dir, param_name_extensionless, sectioned_image_dirname)
-                        logging_target_dir = os.path.join(base_logging_dir, param_name_extensionless, sectioned_image_dirname, section_name_extensionless)
+    param_stores = {
+        source["param_store"].manifest_fp: source["param_store"]
+        for source in job_sources if source["param_store"] is not None
+    }
 
-                        soax_instance_arg_dicts.append(soax_args_for_tiff_and_param_file(
-                            batch_soax_path,
-                            image_section_tiff_path,
-                            param_filepath,
-                            snakes_target_dir,
-                            logging_target_dir,
-                            delete_soax_logs_for_finished_runs,
-                            logger,
-                        ))
+    if result_cache_dir is not None:
+        result_cache = SnakeResultCache(result_cache_dir)
+        logger.log("Using snake result cache in {}".format(result_cache_dir))
+    else:
+        result_cache = None
+
+    if use_thread_budget:
+        cpu_sets = partition_cpus(available_cpus(), workers_num)
+        cpu_slots = CpuSlots(cpu_sets)
+        logger.log("Thread budget: {} workers with {} threads each{}".format(
+            workers_num,
+            "/".join(sorted(set(str(len(cpu_set)) for cpu_set in cpu_sets))),
+            ", pinned to CPUs" if pin_cpus else "",
+        ))
+    else:
+        cpu_slots = None
+
+    # Jobs are handed to the pool as they're planned, but only a few ahead of the
+    # running workers so the pool's queue doesn't fill up with every job in the sweep
+    job_slots = threading.BoundedSemaphore(workers_num * 2)
+    job_exceptions = []
+
+    progress = ProgressTracker(
+        "run_soax",
+        job_count,
+        logger,
+        progress_fp=progress_fp,
+        group_totals=count_soax_jobs_by_param_name(job_sources),
+    )
+
+    # Duplicate jobs share the result of the job that was actually run. The slot is released
+    # even if reporting progress fails, or the dispatch loop would wait for it forever
+    def group_done(group, successes):
+        try:
+            for job, success in zip(group, successes):
+                for param_name in [job["param_name"]] + [duplicate["param_name"] for duplicate in job["duplicates"]]:
+                    progress.job_done(param_name, failed=not success)
+        except Exception as e:
+            job_exceptions.append(e)
+        finally:
+            job_slots.release()
+
+    def group_failed(group, exception):
+        job_exceptions.append(exception)
+        try:
+            for job in group:
+                for param_name in [job["param_name"]] + [duplicate["param_name"] for duplicate in job["duplicates"]]:
+                    progress.job_done(param_name, failed=True)
+        except Exception:
+            # The group's own exception is already recorded to be raised
+            pass
+        finally:
+            job_slots.release()
 
     with ThreadPool(workers_num) as pool:
-        logger.log("Running {} batch_soax workers on {} jobs".format(workers_num, len(soax_instance_arg_dicts)))
-        future = pool.map(soax_instance, soax_instance_arg_dicts, chunksize=1)
+        logger.log("Running {} batch_soax workers on {} jobs".format(workers_num, job_count))
+        if saved_job_count > 0:
+            logger.log("    {} jobs have parameters equivalent to another job for the same image, and will reuse its snakes instead of running batch_soax".format(saved_job_count))
+        if param_group_size > 1:
+            logger.log("    Up to {} parameter files per image are run in each batch_soax process".format(param_group_size))
+
+        jobs = iter_soax_jobs(job_sources, base_output_dir, base_logging_dir, use_sectioned_images)
+        for group in iter_soax_job_groups(jobs, param_group_size):
+            job_slots.acquire()
+            if len(job_exceptions) > 0:
+                break
+
+            soax_instance_args = soax_args_for_job_group(
+                batch_soax_path,
+                group,
+                delete_soax_logs_for_finished_runs,
+                base_logging_dir,
+                result_cache,
+                cpu_slots,
+                pin_cpus,
+                telemetry_writer,
+                run_log,
+                param_stores,
+                logger,
+            )
+            pool.apply_async(
+                soax_instance,
+                (soax_instance_args,),
+                callback=functools.partial(group_done, group),
+                error_callback=functools.partial(group_failed, group),
+            )
+
+        pool.close()
+        pool.join()
+        progress.close()
         logger.log("Finished running batch_soax workers")
+        if saved_job_count > 0:
+            logger.log("Saved {} batch_soax runs by reusing snakes for equivalent parameters".format(saved_job_count))
+
+    telemetry_writer.close()
+    if run_log is not None:
+        run_log.close()
+        logger.log("Saved batch_soax output in run log {} (read with 'soaxhelper logs')".format(run_log.log_fp))
+
+    if result_cache is not None:
+        logger.log("Snake result cache: {} hits, {} misses, {} new results stored".format(
+            result_cache.hits,
+            result_cache.misses,
+            result_cache.stores,
+        ))
+        if result_cache_max_gb is not None:
+            removed_count, removed_bytes = result_cache.prune(int(result_cache_max_gb * 2**30))
+            if removed_count > 0:
+                logger.log("Removed {} least recently used cache entries ({:.1f} MB) to keep cache under {} GB".format(
+                    removed_count,
+                    removed_bytes / 2**20,
+                    result_cache_max_gb,
+                ))
+
+    logger.log("Saved batch_soax job telemetry in {}".format(telemetry_fp))
+    log_telemetry_summary(load_telemetry_records(telemetry_fp), logger)
+
+    if len(job_exceptions) > 0:
+        raise job_exceptions[0]
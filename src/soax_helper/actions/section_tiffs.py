@@ -6,6 +6,7 @@ from PIL import Image
 import tifffile
 
 from ..snakeutils.tifimage import save_3d_tif, open_tiff_as_np_arr
+from ..snakeutils.progress import ProgressTracker
 
 def section_tiff(arg_dict):
     tiff_filepath = arg_dict["tiff_filepath"]
@@ -79,6 +80,7 @@ def section_tiffs(
     target_dir,
     workers_num,
     logger,
+    progress_fp=None,
     ):
     if section_max_size <= 0:
         logger.FAIL("Section max size must be positive. Invalid value {}".format(section_size))
@@ -107,5 +109,8 @@ def section_tiffs(
             "logger": logger,
         })
 
+    progress = ProgressTracker("section_tiffs", len(section_arg_dicts), logger, progress_fp=progress_fp)
     with ThreadPool(workers_num) as pool:
-        future = pool.map(section_tiff, section_arg_dicts, chunksize=1)
+        for __ in pool.imap_unordered(section_tiff, section_arg_dicts, chunksize=1):
+            progress.job_done()
+    progress.close()
@@ -0,0 +1,289 @@
+import os
+import json
+import math
+import random
+import shutil
+import numpy as np
+
+from ..snakeutils.files import extract_snake_set, find_tiffs_in_dir, find_files_or_folders_at_depth
+from ..snakeutils.tifimage import get_tiff_voxel_count
+from ..snakeutils.snakeindex import snake_arc_lengths
+from ..snakeutils.params import param_manifest_path, param_manifest_filename
+from .run_soax import run_soax, find_param_files_in_dir, make_dir_if_not_exist, link_or_copy_file
+
+def halving_keep_count(param_count, keep_fraction, final_param_count):
+    """ Number of the param_count parameter sets a round keeps. At least one is always dropped
+    while there are more than final_param_count, so every round narrows the sweep even when
+    keep_fraction rounds up to all of them """
+    keep_count = max(final_param_count, int(math.ceil(param_count * keep_fraction)))
+    if param_count > final_param_count:
+        keep_count = min(param_count - 1, keep_count)
+    return keep_count
+
+def snake_count_metric(snakes, image_voxels):
+    return len(snakes)
+
+def total_length_metric(snakes, image_voxels):
+    return float(snake_arc_lengths(snakes).sum())
+
+def coverage_metric(snakes, image_voxels):
+    # Fraction of the image's voxels that have a snake point in them
+    if image_voxels is None or image_voxels == 0:
+        return 0.0
+    covered_voxels = np.unique(np.trunc(snakes.positions).astype(np.int64), axis=0)
+    return len(covered_voxels) / image_voxels
+
+# Metrics take the SnakeSet from a snake file and the number of voxels in the image, and
+# return a score. More metrics can be added here, or a function can be passed to the sweep
+sweep_metrics = {
+    "snake_count": snake_count_metric,
+    "total_length": total_length_metric,
+    "coverage": coverage_metric,
+}
+
+def find_sweep_units(base_image_dir, use_sectioned_images):
+    """ Returns list of (image name, section name, tiff path) for every image, or every section
+    of every image if sectioned """
+    units = []
+    if use_sectioned_images:
+        image_folders_info = find_files_or_folders_at_depth(base_image_dir, 0, folders_not_files=True)
+        for containing_path, image_name in image_folders_info:
+            image_dirpath = os.path.join(base_image_dir, image_name)
+            for section_fn in find_tiffs_in_dir(image_dirpath):
+                units.append((image_name, os.path.splitext(section_fn)[0], os.path.join(image_dirpath, section_fn)))
+    else:
+        for tiff_fn in find_tiffs_in_dir(base_image_dir):
+            image_name = os.path.splitext(tiff_fn)[0]
+            units.append((image_name, image_name, os.path.join(base_image_dir, tiff_fn)))
+    return units
+
+def prepare_round_inputs(round_dir, units, param_names, base_params_dir, use_sectioned_images, use_image_specific_params, logger):
+    """ Makes image and parameter folders for a round, with links to the round's images and
+    the parameter files still in the sweep, in the layout run_soax expects """
+    round_image_dir = os.path.join(round_dir, "images")
+    round_params_dir = os.path.join(round_dir, "params")
+    make_dir_if_not_exist(round_image_dir, logger)
+    make_dir_if_not_exist(round_params_dir, logger)
+
+    for image_name, section_name, tiff_fp in units:
+        if use_sectioned_images:
+            make_dir_if_not_exist(os.path.join(round_image_dir, image_name), logger)
+            link_or_copy_file(tiff_fp, os.path.join(round_image_dir, image_name, os.path.basename(tiff_fp)))
+        else:
+            link_or_copy_file(tiff_fp, os.path.join(round_image_dir, os.path.basename(tiff_fp)))
+
+    if use_image_specific_params:
+        for image_name in sorted(set(image_name for image_name, section_name, tiff_fp in units)):
+            make_dir_if_not_exist(os.path.join(round_params_dir, image_name), logger)
+            for param_name in param_names:
+                link_or_copy_file(
+                    os.path.join(base_params_dir, image_name, param_name + ".txt"),
+                    os.path.join(round_params_dir, image_name, param_name + ".txt"),
+                )
+    else:
+        for param_name in param_names:
+            link_or_copy_file(os.path.join(base_params_dir, param_name + ".txt"), os.path.join(round_params_dir, param_name + ".txt"))
+
+    return round_image_dir, round_params_dir
+
+def score_round(round_snakes_dir, units, param_names, metric_func, use_sectioned_images, logger):
+    """ Returns {param_name: [score for each unit]}, with None for jobs that have no snake file """
+    image_voxels = {}
+    for image_name, section_name, tiff_fp in units:
+        try:
+            image_voxels[tiff_fp] = get_tiff_voxel_count(tiff_fp)
+        except Exception:
+            image_voxels[tiff_fp] = None
+
+    scores = {}
+    for param_name in param_names:
+        scores[param_name] = []
+        for image_name, section_name, tiff_fp in units:
+            if use_sectioned_images:
+                snakes_fp = os.path.join(round_snakes_dir, param_name, image_name, section_name + ".txt")
+            else:
+                snakes_fp = os.path.join(round_snakes_dir, param_name, image_name + ".txt")
+
+            if not os.path.isfile(snakes_fp):
+                logger.warn("No snakes for {} with {}, counting as worst score".format(tiff_fp, param_name))
+                scores[param_name].append(None)
+                continue
+
+            with open(snakes_fp, "r") as snakes_file:
+                snakes = extract_snake_set(snakes_file)
+            scores[param_name].append(metric_func(snakes, image_voxels[tiff_fp]))
+
+    return scores
+
+def mean_score(unit_scores, higher_is_better):
+    # A failed job makes the parameter set's score the worst possible
+    if len(unit_scores) == 0 or any(score is None for score in unit_scores):
+        return -math.inf if higher_is_better else math.inf
+    return float(np.mean(unit_scores))
+
+def successive_halving_sweep(
+    batch_soax_path,
+    base_image_dir,
+    base_params_dir,
+    base_output_dir,
+    base_logging_dir,
+    use_sectioned_images,
+    use_image_specific_params,
+    metric,
+    higher_metric_is_better,
+    keep_percent,
+    initial_image_count,
+    final_param_count,
+    max_jobs,
+    random_seed,
+    workers_num,
+    logger,
+    progress_fp=None,
+):
+    """ Adaptive parameter sweep. All parameter files are run on a few images (or sections),
+    the snakes are scored with a cheap metric, and only the best keep_percent of parameter
+    sets are run on more images in the next round. Scores are averaged over every image a
+    parameter set has been run on. Rounds continue until final_param_count parameter sets
+    are left, the images run out, or max_jobs batch_soax jobs have been run (0 for no limit).
+
+    Each round is an ordinary run_soax run in base_output_dir/round_N, so its snakes can be
+    converted to JSON like any other run_soax output. The scores of every round are saved in
+    base_output_dir/sweep_results.json, and the best parameter files are copied to
+    base_output_dir/best_params.
+    """
+    if callable(metric):
+        metric_func = metric
+        metric_name = getattr(metric, "__name__", "custom")
+    elif metric in sweep_metrics:
+        metric_func = sweep_metrics[metric]
+        metric_name = metric
+    else:
+        logger.FAIL("Unknown sweep metric '{}', expected one of {}".format(metric, list(sweep_metrics.keys())))
+
+    if keep_percent <= 0 or keep_percent >= 100:
+        logger.FAIL("Percent of parameter sets to keep each round must be between 0 and 100, got {}".format(keep_percent))
+
+    units = find_sweep_units(base_image_dir, use_sectioned_images)
+    if len(units) == 0:
+        logger.FAIL("No images found in {}".format(base_image_dir))
+    # Images are taken in a random (but repeatable) order, so early rounds aren't all
+    # sections of the first image
+    random.Random(random_seed).shuffle(units)
+
+    if use_image_specific_params:
+        first_params_dir = os.path.join(base_params_dir, units[0][0])
+    else:
+        first_params_dir = base_params_dir
+    param_names = [os.path.splitext(param_fn)[0] for param_fn in find_param_files_in_dir(first_params_dir)]
+    if len(param_names) == 0:
+        if os.path.isfile(param_manifest_path(first_params_dir)):
+            logger.FAIL(("{} only has a parameter manifest ({}), the sweep needs the parameter files. "
+                "Make them again with write_param_files set to true").format(first_params_dir, param_manifest_filename))
+        logger.FAIL("No parameter files found in {}".format(first_params_dir))
+
+    keep_fraction = keep_percent / 100
+    unit_scores = {param_name: [] for param_name in param_names}
+    rounds = []
+    jobs_run = 0
+    units_used = 0
+
+    while len(param_names) > final_param_count:
+        round_idx = len(rounds)
+        # Each round the parameter sets are cut down by keep_fraction and the images are
+        # grown by the same factor, so every round costs about the same
+        target_unit_count = min(len(units), int(math.ceil(initial_image_count / keep_fraction ** round_idx)))
+        new_units = units[units_used:target_unit_count]
+        if len(new_units) == 0:
+            logger.log("No more images to add, stopping sweep")
+            break
+
+        if max_jobs > 0:
+            units_in_budget = (max_jobs - jobs_run) // len(param_names)
+            if units_in_budget == 0:
+                logger.log("Job budget of {} used up, stopping sweep".format(max_jobs))
+                break
+            new_units = new_units[:units_in_budget]
+
+        logger.log("Sweep round {}: {} parameter sets on {} more images".format(round_idx, len(param_names), len(new_units)))
+
+        round_dir = os.path.join(base_output_dir, "round_{}".format(round_idx))
+        round_image_dir, round_params_dir = prepare_round_inputs(
+            os.path.join(round_dir, "inputs"),
+            new_units,
+            param_names,
+            base_params_dir,
+            use_sectioned_images,
+            use_image_specific_params,
+            logger,
+        )
+        round_snakes_dir = os.path.join(round_dir, "snakes")
+        make_dir_if_not_exist(round_snakes_dir, logger)
+
+        run_soax(
+            batch_soax_path,
+            round_image_dir,
+            round_params_dir,
+            round_snakes_dir,
+            os.path.join(base_logging_dir, "round_{}".format(round_idx)),
+            use_sectioned_images=use_sectioned_images,
+            use_image_specific_params=use_image_specific_params,
+            delete_soax_logs_for_finished_runs=True,
+            workers_num=workers_num,
+            logger=logger,
+            progress_fp=progress_fp,
+        )
+        jobs_run += len(param_names) * len(new_units)
+        units_used += len(new_units)
+
+        round_scores = score_round(round_snakes_dir, new_units, param_names, metric_func, use_sectioned_images, logger)
+        for param_name in param_names:
+            unit_scores[param_name] += round_scores[param_name]
+
+        mean_scores = {param_name: mean_score(unit_scores[param_name], higher_metric_is_better) for param_name in param_names}
+        ranked_param_names = sorted(param_names, key=lambda name: mean_scores[name], reverse=higher_metric_is_better)
+        keep_count = halving_keep_count(len(param_names), keep_fraction, final_param_count)
+        kept_param_names = ranked_param_names[:keep_count]
+
+        rounds.append({
+            "round": round_idx,
+            "images": [tiff_fp for image_name, section_name, tiff_fp in new_units],
+            "params": param_names,
+            "mean_scores": mean_scores,
+            "kept": kept_param_names,
+        })
+        logger.log("Sweep round {}: kept {} of {} parameter sets, best {} = {}".format(
+            round_idx,
+            len(kept_param_names),
+            len(param_names),
+            metric_name,
+            mean_scores[ranked_param_names[0]],
+        ))
+
+        param_names = kept_param_names
+
+    results_fp = os.path.join(base_output_dir, "sweep_results.json")
+    with open(results_fp, "w") as f:
+        json.dump({
+            "metric": metric_name,
+            "higher_metric_is_better": higher_metric_is_better,
+            "keep_percent": keep_percent,
+            "jobs_run": jobs_run,
+            "rounds": rounds,
+            "best_params": param_names,
+        }, f, indent=4)
+
+    best_params_dir = os.path.join(base_output_dir, "best_params")
+    make_dir_if_not_exist(best_params_dir, logger)
+    for param_name in param_names:
+        if use_image_specific_params:
+            for image_name in sorted(set(unit[0] for unit in units)):
+                make_dir_if_not_exist(os.path.join(best_params_dir, image_name), logger)
+                shutil.copyfile(
+                    os.path.join(base_params_dir, image_name, param_name + ".txt"),
+                    os.path.join(best_params_dir, image_name, param_name + ".txt"),
+                )
+        else:
+            shutil.copyfile(os.path.join(base_params_dir, param_name + ".txt"), os.path.join(best_params_dir, param_name + ".txt"))
+
+    logger.log("Sweep finished after {} batch_soax jobs, best parameter sets: {}".format(jobs_run, ", ".join(param_names)))
+    logger.log("Saved sweep scores in {} and best parameter files in {}".format(results_fp, best_params_dir))
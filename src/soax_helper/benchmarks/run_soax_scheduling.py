@@ -0,0 +1,228 @@
+""" Benchmarks run_soax job planning and dispatch, using fake_batch_soax instead of SOAX.
+
+Planner benchmark: time and peak Python memory to list the inputs and generate every job.
+Dispatch benchmark: runs run_soax with fake_batch_soax set to do no work, and reports
+throughput, per-job scheduling overhead and tail latency of the jobs.
+
+Example:
+    python -m soax_helper.benchmarks.run_soax_scheduling --planner-jobs 10000 100000 --dispatch-jobs 10000 --workers 8
+"""
+import os
+import sys
+import json
+import glob
+import time
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+
+from ..snakeutils.logger import ConsoleLogger
+from ..snakeutils.params import create_params
+from ..snakeutils.tifimage import save_3d_tif
+from ..snakeutils.telemetry import load_telemetry_records
+from ..actions.run_soax import run_soax, find_soax_job_sources, iter_soax_jobs
+
+class QuietLogger:
+    """ Only shows errors, so thousands of jobs don't flood the console """
+    def __init__(self):
+        self.child_logger = ConsoleLogger()
+
+    def log(self, text):
+        pass
+
+    def warn(self, text):
+        self.child_logger.warn(text)
+
+    def success(self, text):
+        pass
+
+    def error(self, text):
+        self.child_logger.error(text)
+
+    def FAIL(self, text):
+        self.child_logger.FAIL(text)
+
+def image_and_param_counts(job_count, max_images):
+    image_count = min(max_images, job_count)
+    param_count = int(np.ceil(job_count / image_count))
+    return image_count, param_count
+
+def make_benchmark_inputs(work_dir, image_count, param_count, image_dims_xyz):
+    images_dir = os.path.join(work_dir, "images")
+    params_dir = os.path.join(work_dir, "params")
+    os.makedirs(images_dir)
+    os.makedirs(params_dir)
+
+    width, height, depth = image_dims_xyz
+    img_arr = np.zeros((height, width, depth), dtype=np.uint16)
+    for image_idx in range(image_count):
+        save_3d_tif(os.path.join(images_dir, "image{:05d}.tif".format(image_idx)), img_arr)
+
+    for param_idx in range(param_count):
+        params_fp = os.path.join(params_dir, "params_rt{:07d}.txt".format(param_idx))
+        with open(params_fp, "w") as f:
+            f.write(create_params(ridge_threshold=0.01 + param_idx * 1e-6))
+
+    return images_dir, params_dir
+
+def benchmark_planner(job_count, max_images, logger):
+    image_count, param_count = image_and_param_counts(job_count, max_images)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        images_dir, params_dir = make_benchmark_inputs(work_dir, image_count, param_count, (4, 4, 1))
+
+        tracemalloc.start()
+        start = time.time()
+        job_sources = find_soax_job_sources(images_dir, params_dir, False, False, logger)
+        first_job_seconds = None
+        planned_jobs = 0
+        for job in iter_soax_jobs(job_sources, os.path.join(work_dir, "snakes"), os.path.join(work_dir, "logs"), False):
+            if first_job_seconds is None:
+                first_job_seconds = time.time() - start
+            planned_jobs += 1
+        elapsed = time.time() - start
+        __, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        "benchmark": "planner",
+        "jobs": planned_jobs,
+        "images": image_count,
+        "param_files": param_count,
+        "total_seconds": elapsed,
+        "first_job_seconds": first_job_seconds,
+        "us_per_job": elapsed / planned_jobs * 1e6,
+        "peak_python_memory_mb": peak_bytes / 2**20,
+    }
+
+def write_fake_batch_soax_wrapper(fp):
+    # run_soax needs an executable file, this runs the emulator from this copy of soax_helper
+    package_parent_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    with open(fp, "w") as f:
+        f.write("#!{}\n".format(sys.executable))
+        f.write("import sys\n")
+        f.write("sys.path.insert(0, {})\n".format(repr(package_parent_dir)))
+        f.write("from soax_helper.fake_batch_soax import main\n")
+        f.write("main()\n")
+    os.chmod(fp, 0o755)
+
+def benchmark_dispatch(job_count, max_images, workers, job_seconds, logger, cpu_work_mb=0, use_thread_budget=False, pin_cpus=False, param_group_size=1, load_seconds=0):
+    image_count, param_count = image_and_param_counts(job_count, max_images)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        images_dir, params_dir = make_benchmark_inputs(work_dir, image_count, param_count, (16, 16, 4))
+        fake_batch_soax_fp = os.path.join(work_dir, "fake_batch_soax")
+        write_fake_batch_soax_wrapper(fake_batch_soax_fp)
+        logging_dir = os.path.join(work_dir, "logs")
+
+        os.environ["FAKE_BATCH_SOAX_MODEL"] = json.dumps({
+            "base_seconds": load_seconds,
+            # Images are 16x16x4, so this makes each parameter file take job_seconds
+            "seconds_per_megavoxel": job_seconds / (16 * 16 * 4 / 1e6),
+            "runtime_jitter": 0,
+            "snakes_per_megavoxel": 0,
+            "cpu_work_megabytes": cpu_work_mb,
+        })
+
+        start = time.time()
+        run_soax(
+            fake_batch_soax_fp,
+            images_dir,
+            params_dir,
+            os.path.join(work_dir, "snakes"),
+            logging_dir,
+            use_sectioned_images=False,
+            use_image_specific_params=False,
+            delete_soax_logs_for_finished_runs=True,
+            workers_num=workers,
+            logger=logger,
+            use_thread_budget=use_thread_budget,
+            pin_cpus=pin_cpus,
+            param_group_size=param_group_size,
+        )
+        elapsed = time.time() - start
+
+        telemetry_fp = glob.glob(os.path.join(logging_dir, "soax_telemetry_*.jsonl"))[0]
+        records = load_telemetry_records(telemetry_fp)
+
+    job_wall_times = np.array([record["wall_time_s"] for record in records])
+    failed = len([record for record in records if record["exit_code"] != 0])
+    # Time workers spent outside of batch_soax processes, per job
+    overhead_per_job = (elapsed * workers - job_wall_times.sum()) / len(records)
+
+    return {
+        "benchmark": "dispatch",
+        "jobs": len(records),
+        "failed": failed,
+        "workers": workers,
+        "cpu_work_mb": cpu_work_mb,
+        "thread_budget": "pinned" if pin_cpus else ("on" if use_thread_budget else "off"),
+        "param_group_size": param_group_size,
+        "total_seconds": elapsed,
+        "jobs_per_second": len(records) / elapsed,
+        "overhead_ms_per_job": overhead_per_job * 1e3,
+        "job_p50_ms": np.percentile(job_wall_times, 50) * 1e3,
+        "job_p95_ms": np.percentile(job_wall_times, 95) * 1e3,
+        "job_p99_ms": np.percentile(job_wall_times, 99) * 1e3,
+        "job_max_ms": job_wall_times.max() * 1e3,
+    }
+
+def log_result(result, logger):
+    logger.log(", ".join("{}={}".format(key, "{:.3f}".format(val) if isinstance(val, float) else val) for key, val in result.items()))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark run_soax job planning and dispatch with fake batch_soax")
+    parser.add_argument("--planner-jobs", type=int, nargs="*", default=[10000, 100000], help="Job counts to benchmark the planner with")
+    parser.add_argument("--dispatch-jobs", type=int, nargs="*", default=[10000], help="Job counts to run through run_soax with fake batch_soax")
+    parser.add_argument("--max-images", type=int, default=50, help="Jobs are split into at most this many images, the rest are parameter files")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--job-seconds", type=float, default=0, help="How long each fake batch_soax job sleeps")
+    parser.add_argument("--thread-budget-jobs", type=int, default=0, help="Compare the thread budget modes against oversubscribed batch_soax processes with this many CPU-bound fake jobs")
+    parser.add_argument("--cpu-work-mb", type=float, default=200, help="Megabytes each CPU-bound fake job hashes, split among its threads")
+    parser.add_argument("--group-jobs", type=int, default=0, help="Compare running each parameter file separately against grouping parameter files per image with this many jobs")
+    parser.add_argument("--group-sizes", type=int, nargs="*", default=[1, 4, 16], help="Parameter group sizes to compare")
+    parser.add_argument("--load-seconds", type=float, default=0.2, help="How long each fake batch_soax process takes to load its image, for the grouping comparison")
+    parser.add_argument("--json", default=None, help="Also save results to this JSON file")
+
+    args = parser.parse_args()
+
+    console_logger = ConsoleLogger()
+    results = []
+    for job_count in args.planner_jobs:
+        results.append(benchmark_planner(job_count, args.max_images, console_logger))
+        log_result(results[-1], console_logger)
+    for job_count in args.dispatch_jobs:
+        results.append(benchmark_dispatch(job_count, args.max_images, args.workers, args.job_seconds, QuietLogger()))
+        log_result(results[-1], console_logger)
+    if args.thread_budget_jobs > 0:
+        budget_modes = [(False, False), (True, False)]
+        if hasattr(os, "sched_setaffinity"):
+            budget_modes.append((True, True))
+        for use_thread_budget, pin_cpus in budget_modes:
+            results.append(benchmark_dispatch(
+                args.thread_budget_jobs,
+                args.max_images,
+                args.workers,
+                args.job_seconds,
+                QuietLogger(),
+                cpu_work_mb=args.cpu_work_mb,
+                use_thread_budget=use_thread_budget,
+                pin_cpus=pin_cpus,
+            ))
+            log_result(results[-1], console_logger)
+    for param_group_size in (args.group_sizes if args.group_jobs > 0 else []):
+        results.append(benchmark_dispatch(
+            args.group_jobs,
+            args.max_images,
+            args.workers,
+            args.job_seconds,
+            QuietLogger(),
+            param_group_size=param_group_size,
+            load_seconds=args.load_seconds,
+        ))
+        log_result(results[-1], console_logger)
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=4)
@@ -0,0 +1,129 @@
+""" Benchmarks the vectorized snake coordinate transforms in snakeutils.geometry against
+the same transforms done one point dict at a time.
+
+Makes a random snake set with the requested number of points, runs each transform both
+ways, checks that they give the same points, and reports the time of each.
+
+Example:
+    python -m soax_helper.benchmarks.snake_geometry --points 1000000
+"""
+import json
+import time
+import argparse
+import numpy as np
+
+from ..snakeutils.snakeset import SnakeSet
+from ..snakeutils.geometry import clip_to_box, translate, scale_to_um, filter_snakes_in_box
+
+def make_snake_set(point_count, points_per_snake, seed=0):
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(points_per_snake // 2, points_per_snake * 3 // 2 + 1, point_count // max(points_per_snake // 2, 1) + 1)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    offsets = offsets[offsets < point_count].tolist() + [point_count]
+    positions = rng.uniform(-10, 1010, (point_count, 3)) * [1, 1, 0.1]
+    return SnakeSet(positions, rng.uniform(0, 60000, point_count), rng.uniform(0, 10000, point_count), offsets)
+
+def clip_dicts(snake_dicts, lower_xyz, upper_xyz):
+    return [
+        [{"pos": [min(max(c, lo), up) for c, lo, up in zip(pt["pos"], lower_xyz, upper_xyz)], "fg": pt["fg"], "bg": pt["bg"]} for pt in snake]
+        for snake in snake_dicts
+    ]
+
+def translate_dicts(snake_dicts, offset_xyz):
+    return [
+        [{"pos": [c + o for c, o in zip(pt["pos"], offset_xyz)], "fg": pt["fg"], "bg": pt["bg"]} for pt in snake]
+        for snake in snake_dicts
+    ]
+
+def scale_dicts(snake_dicts, spacing_xyz):
+    return [
+        [{"pos": [c * s for c, s in zip(pt["pos"], spacing_xyz)], "fg": pt["fg"], "bg": pt["bg"]} for pt in snake]
+        for snake in snake_dicts
+    ]
+
+def filter_dicts(snake_dicts, lower_xyz, upper_xyz):
+    return [
+        snake for snake in snake_dicts
+        if any(all(lo <= c <= up for c, lo, up in zip(pt["pos"], lower_xyz, upper_xyz)) for pt in snake)
+    ]
+
+def best_time(func, repeats):
+    best_seconds = None
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        seconds = time.perf_counter() - start
+        if best_seconds is None or seconds < best_seconds:
+            best_seconds = seconds
+    return best_seconds, result
+
+def benchmark_snake_geometry(point_count, points_per_snake, repeats):
+    snakes = make_snake_set(point_count, points_per_snake)
+    # Exact float32 values, so both versions start from the same numbers
+    positions = snakes.positions.astype(np.float64).tolist()
+    fg = snakes.fg.astype(np.float64).tolist()
+    bg = snakes.bg.astype(np.float64).tolist()
+    offsets = snakes.offsets.tolist()
+    snake_dicts = [
+        [{"pos": positions[pt_idx], "fg": fg[pt_idx], "bg": bg[pt_idx]} for pt_idx in range(offsets[i], offsets[i + 1])]
+        for i in range(len(snakes))
+    ]
+
+    lower, upper = [0, 0, 0], [1000, 1000, 100]
+    box_lower, box_upper = [200, 200, 0], [400, 400, 100]
+    offset = [512, 256, 10]
+    spacing = [0.1, 0.1, 0.3]
+
+    transforms = [
+        ("clip", lambda: clip_to_box(snakes, lower, upper), lambda: clip_dicts(snake_dicts, lower, upper)),
+        ("translate", lambda: translate(snakes, offset), lambda: translate_dicts(snake_dicts, offset)),
+        ("scale_to_um", lambda: scale_to_um(snakes, spacing), lambda: scale_dicts(snake_dicts, spacing)),
+        ("filter_box", lambda: filter_snakes_in_box(snakes, box_lower, box_upper), lambda: filter_dicts(snake_dicts, box_lower, box_upper)),
+    ]
+
+    results = []
+    for name, vectorized_func, dicts_func in transforms:
+        vectorized_seconds, vectorized_snakes = best_time(vectorized_func, repeats)
+        dicts_seconds, dicts_snakes = best_time(dicts_func, repeats)
+
+        # Point dicts hold float64, so compare them after rounding to the SnakeSet's float32
+        dicts_snakes = SnakeSet.from_dicts(dicts_snakes)
+        if not (np.array_equal(vectorized_snakes.offsets, dicts_snakes.offsets) and np.array_equal(vectorized_snakes.positions, dicts_snakes.positions)):
+            raise Exception("Vectorized {} gave different snakes than the point dict version".format(name))
+
+        results.append({
+            "transform": name,
+            "points": point_count,
+            "snakes": len(snakes),
+            "point_dicts_s": dicts_seconds,
+            "vectorized_s": vectorized_seconds,
+            "speedup": dicts_seconds / vectorized_seconds,
+        })
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark vectorized snake coordinate transforms")
+    parser.add_argument("--points", type=int, nargs="*", default=[1000000], help="Point counts of the snake sets to transform")
+    parser.add_argument("--points-per-snake", type=int, default=40)
+    parser.add_argument("--repeats", type=int, default=3, help="Each transform is timed this many times, the fastest time is reported")
+    parser.add_argument("--json", default=None, help="Also save results to this JSON file")
+
+    args = parser.parse_args()
+
+    results = []
+    print("{:>12} {:>10} {:>8} {:>14} {:>14} {:>9}".format("transform", "points", "snakes", "point dicts s", "vectorized s", "speedup"))
+    for point_count in args.points:
+        for result in benchmark_snake_geometry(point_count, args.points_per_snake, args.repeats):
+            results.append(result)
+            print("{:>12} {:>10} {:>8} {:>14.3f} {:>14.4f} {:>9.1f}".format(
+                result["transform"],
+                result["points"],
+                result["snakes"],
+                result["point_dicts_s"],
+                result["vectorized_s"],
+                result["speedup"],
+            ))
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=4)
@@ -0,0 +1,98 @@
+""" Benchmarks reading SOAX snake files with extract_snakes against the vectorized reader.
+
+Writes a fake snake file with the requested number of points, reads it with both readers,
+checks that they give the same snakes, and reports the time of each.
+
+Example:
+    python -m soax_helper.benchmarks.snake_parsing --points 200000 --repeats 3
+"""
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+
+from ..fake_batch_soax import write_fake_snake_file
+from ..snakeutils.files import extract_snakes, extract_snakes_vectorized, read_snake_point_arrays
+
+def make_snake_file(snake_fp, point_count, points_per_snake, seed=0):
+    rng = random.Random(seed)
+    snakes = []
+    points_left = point_count
+    while points_left > 0:
+        snake_length = min(points_left, rng.randint(points_per_snake // 2, points_per_snake * 3 // 2))
+        snakes.append([
+            (rng.uniform(0, 1000), rng.uniform(0, 1000), rng.uniform(0, 100), rng.uniform(0, 60000), rng.uniform(0, 10000))
+            for point_idx in range(snake_length)
+        ])
+        points_left -= snake_length
+    junctions = [snake[-1][:3] for snake in snakes[::5]]
+    write_fake_snake_file(snake_fp, "image.tif", (1000, 1000, 100), [], snakes, junctions)
+    return len(snakes)
+
+def time_reader(reader, snake_fp, repeats):
+    best_seconds = None
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        with open(snake_fp, "r") as snake_file:
+            result = reader(snake_file)
+        seconds = time.perf_counter() - start
+        if best_seconds is None or seconds < best_seconds:
+            best_seconds = seconds
+    return best_seconds, result
+
+def benchmark_snake_parsing(point_count, points_per_snake, repeats):
+    with tempfile.TemporaryDirectory() as work_dir:
+        snake_fp = os.path.join(work_dir, "snakes.txt")
+        snake_count = make_snake_file(snake_fp, point_count, points_per_snake)
+        file_bytes = os.path.getsize(snake_fp)
+
+        extract_seconds, extracted_snakes = time_reader(extract_snakes, snake_fp, repeats)
+        vectorized_seconds, vectorized_snakes = time_reader(extract_snakes_vectorized, snake_fp, repeats)
+        arrays_seconds, __ = time_reader(read_snake_point_arrays, snake_fp, repeats)
+
+    if extracted_snakes != vectorized_snakes:
+        raise Exception("Vectorized reader gave different snakes than extract_snakes")
+
+    return {
+        "points": point_count,
+        "snakes": snake_count,
+        "file_megabytes": file_bytes / 2**20,
+        "extract_snakes_s": extract_seconds,
+        "vectorized_dicts_s": vectorized_seconds,
+        "vectorized_arrays_s": arrays_seconds,
+        "speedup_dicts": extract_seconds / vectorized_seconds,
+        "speedup_arrays": extract_seconds / arrays_seconds,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark snake file readers")
+    parser.add_argument("--points", type=int, nargs="*", default=[10000, 200000], help="Point counts of the snake files to read")
+    parser.add_argument("--points-per-snake", type=int, default=40)
+    parser.add_argument("--repeats", type=int, default=3, help="Each reader is timed this many times, the fastest time is reported")
+    parser.add_argument("--json", default=None, help="Also save results to this JSON file")
+
+    args = parser.parse_args()
+
+    results = []
+    print("{:>10} {:>8} {:>8} {:>12} {:>12} {:>12} {:>9} {:>9}".format(
+        "points", "snakes", "MB", "extract s", "vec dicts s", "vec arrays s", "x dicts", "x arrays",
+    ))
+    for point_count in args.points:
+        result = benchmark_snake_parsing(point_count, args.points_per_snake, args.repeats)
+        results.append(result)
+        print("{:>10} {:>8} {:>8.1f} {:>12.3f} {:>12.3f} {:>12.3f} {:>9.1f} {:>9.1f}".format(
+            result["points"],
+            result["snakes"],
+            result["file_megabytes"],
+            result["extract_snakes_s"],
+            result["vectorized_dicts_s"],
+            result["vectorized_arrays_s"],
+            result["speedup_dicts"],
+            result["speedup_arrays"],
+        ))
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=4)
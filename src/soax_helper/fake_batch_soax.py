@@ -0,0 +1,223 @@
+""" Stand-in for SOAX's batch_soax executable, for testing and benchmarking run_soax without
+SOAX or real images. Takes the same --image/--parameter/--snake arguments, sleeps and allocates
+memory according to a simple model of the image size and parameters, and writes a snake file
+in the format that snakeutils.files.extract_snakes reads.
+
+The model can be changed with a JSON object in the FAKE_BATCH_SOAX_MODEL environment variable
+(or a path to a JSON file), since run_soax only passes the image, parameter and snake arguments.
+Ex. FAKE_BATCH_SOAX_MODEL='{"base_seconds": 0, "seconds_per_megavoxel": 0}'
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import hashlib
+import threading
+
+default_model = {
+    # Runtime is base_seconds to load the image, plus
+    # seconds_per_megavoxel * megavoxels * (maximum-iterations / 10000) for each parameter file
+    "base_seconds": 0.05,
+    "seconds_per_megavoxel": 0.5,
+    # Fraction of runtime added or removed at random, so jobs don't all take the same time
+    "runtime_jitter": 0.1,
+    "bytes_per_voxel": 8,
+    # Number of snakes is snakes_per_megavoxel * megavoxels * (0.01 / ridge-threshold)
+    "snakes_per_megavoxel": 200,
+    "max_snakes": 5000,
+    "junctions_per_snake": 0.2,
+    # Fraction of runs that exit with an error, to test failure handling
+    "failure_rate": 0.0,
+    # CPU work per job, in megabytes hashed. Like ITK, the work is split between as many
+    # threads as ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS says, or one per core if it isn't set
+    "cpu_work_megabytes": 0,
+}
+
+def load_model():
+    model = dict(default_model)
+
+    model_str = os.getenv("FAKE_BATCH_SOAX_MODEL", None)
+    if model_str is not None and model_str.strip() != "":
+        if os.path.isfile(model_str):
+            with open(model_str, "r") as f:
+                model_overrides = json.load(f)
+        else:
+            model_overrides = json.loads(model_str)
+
+        for key in model_overrides:
+            if key not in default_model:
+                raise Exception("Unknown fake batch_soax model setting '{}', expected one of {}".format(key, list(default_model.keys())))
+        model.update(model_overrides)
+
+    return model
+
+def read_param_file(params_fp):
+    param_lines = []
+    param_values = {}
+    with open(params_fp, "r") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line.strip() == "":
+                continue
+            param_lines.append(line)
+            split_line = line.split()
+            if len(split_line) == 2:
+                param_values[split_line[0]] = split_line[1]
+
+    return param_lines, param_values
+
+def read_image_dims(image_fp):
+    # Only reads the TIFF header. Imported here so the emulator starts fast.
+    from PIL import Image
+
+    with Image.open(image_fp) as pil_img:
+        width, height = pil_img.size
+        depth = getattr(pil_img, "n_frames", 1)
+
+    return width, height, depth
+
+def param_float(param_values, name, default):
+    try:
+        return float(param_values[name])
+    except (KeyError, ValueError):
+        return default
+
+def itk_thread_count():
+    try:
+        return max(1, int(os.getenv("ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS", "")))
+    except ValueError:
+        return os.cpu_count()
+
+def do_cpu_work(megabytes, thread_count):
+    # hashlib releases the GIL for big buffers, so the threads really run in parallel
+    chunk = bytes(2**20)
+    chunks_per_thread = int(megabytes) // thread_count
+
+    def work():
+        hasher = hashlib.sha256()
+        for chunk_idx in range(chunks_per_thread):
+            hasher.update(chunk)
+
+    threads = [threading.Thread(target=work) for thread_idx in range(thread_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+def make_fake_snakes(rng, image_dims, snake_count, snake_length, point_spacing):
+    width, height, depth = image_dims
+    snakes = []
+    for snake_idx in range(snake_count):
+        point_count = max(2, int(snake_length / point_spacing))
+        x = rng.uniform(0, width)
+        y = rng.uniform(0, height)
+        z = rng.uniform(0, depth)
+        points = []
+        for point_idx in range(point_count):
+            points.append((x, y, z, rng.uniform(1000, 50000), rng.uniform(100, 10000)))
+            x = min(max(x + rng.uniform(-point_spacing, point_spacing), 0), width)
+            y = min(max(y + rng.uniform(-point_spacing, point_spacing), 0), height)
+            z = min(max(z + rng.uniform(-point_spacing, point_spacing) / 4, 0), depth)
+        snakes.append(points)
+    return snakes
+
+def write_fake_snake_file(snake_fp, image_fp, image_dims, param_lines, snakes, junctions):
+    # The snake reader skips 30 lines before the first snake point. The last of those lines
+    # is the open/closed marker of the first snake.
+    header_lines = ["image\t{}".format(image_fp)] + param_lines
+    header_lines.append("dimensions\t{}\t{}\t{}".format(*image_dims))
+    header_lines.append("s\tp\tx\ty\tz\tfg_int\tbg_int")
+    while len(header_lines) < 29:
+        header_lines.append("")
+    header_lines = header_lines[:29]
+
+    with open(snake_fp, "w") as f:
+        for line in header_lines:
+            f.write(line + "\n")
+        for snake_idx, points in enumerate(snakes):
+            f.write("#1\n")
+            for point_idx, (x, y, z, fg, bg) in enumerate(points):
+                f.write("{}{:12d}{:12.6g}{:12.6g}{:12.6g}{:12.6g}{:12.6g}\n".format(snake_idx, point_idx, x, y, z, fg, bg))
+        for x, y, z in junctions:
+            f.write("{:12.6g}{:12.6g}{:12.6g}\n".format(x, y, z))
+
+def run_fake_batch_soax(image_fp, params_path, snake_dir, model):
+    """ params_path can be a parameter file, or a directory of parameter files that are all run
+    on the image after loading it once. Snake files for a parameter directory are named
+    '<image name>--<param name>.txt'
+    """
+    image_dims = read_image_dims(image_fp)
+    voxels = image_dims[0] * image_dims[1] * image_dims[2]
+    megavoxels = voxels / 1e6
+    image_name_extensionless = os.path.splitext(os.path.basename(image_fp))[0]
+
+    if os.path.isdir(params_path):
+        param_fps = [os.path.join(params_path, fn) for fn in sorted(os.listdir(params_path)) if fn.endswith(".txt")]
+        snake_fns = ["{}--{}.txt".format(image_name_extensionless, os.path.splitext(os.path.basename(fp))[0]) for fp in param_fps]
+    else:
+        param_fps = [params_path]
+        snake_fns = [image_name_extensionless + ".txt"]
+
+    # Loading the image happens once per process
+    print("fake batch_soax: {} voxels, loading for {:.3f} seconds".format(voxels, model["base_seconds"]))
+    time.sleep(max(model["base_seconds"], 0))
+
+    # Touch every page so the memory actually counts towards peak RSS
+    memory = bytearray(int(model["bytes_per_voxel"] * voxels))
+    for i in range(0, len(memory), 4096):
+        memory[i] = 1
+
+    os.makedirs(snake_dir, exist_ok=True)
+
+    for params_fp, snake_fn in zip(param_fps, snake_fns):
+        param_lines, param_values = read_param_file(params_fp)
+
+        # Same image and parameters always give the same output
+        with open(params_fp, "rb") as f:
+            seed_bytes = os.path.abspath(image_fp).encode() + f.read()
+        rng = random.Random(hashlib.sha256(seed_bytes).hexdigest())
+
+        if rng.random() < model["failure_rate"]:
+            sys.stderr.write("fake batch_soax: simulated failure for {} with {}\n".format(image_fp, params_fp))
+            return 1
+
+        iterations_factor = param_float(param_values, "maximum-iterations", 10000) / 10000
+
+        runtime = model["seconds_per_megavoxel"] * megavoxels * iterations_factor
+        runtime *= 1 + rng.uniform(-model["runtime_jitter"], model["runtime_jitter"])
+
+        print("fake batch_soax: running {} for {:.3f} seconds".format(params_fp, runtime))
+        time.sleep(max(runtime, 0))
+        if model["cpu_work_megabytes"] > 0:
+            do_cpu_work(model["cpu_work_megabytes"], itk_thread_count())
+
+        ridge_threshold = param_float(param_values, "ridge-threshold", 0.01)
+        snake_count = int(model["snakes_per_megavoxel"] * megavoxels * 0.01 / max(ridge_threshold, 1e-6))
+        snake_count = min(max(snake_count, 1), model["max_snakes"])
+        snake_length = param_float(param_values, "minimum-snake-length", 20) * 2
+        point_spacing = max(param_float(param_values, "snake-point-spacing", 5), 0.1)
+
+        snakes = make_fake_snakes(rng, image_dims, snake_count, snake_length, point_spacing)
+        junction_count = int(snake_count * model["junctions_per_snake"])
+        junctions = [snake[-1][:3] for snake in rng.sample(snakes, min(junction_count, len(snakes)))]
+
+        snake_fp = os.path.join(snake_dir, snake_fn)
+        write_fake_snake_file(snake_fp, image_fp, image_dims, param_lines, snakes, junctions)
+        print("fake batch_soax: wrote {} snakes to {}".format(len(snakes), snake_fp))
+
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake batch_soax for testing and benchmarking soax helper")
+    parser.add_argument("--image", required=True, help="TIFF image")
+    parser.add_argument("--parameter", required=True, help="SOAX parameter file, or directory of parameter files")
+    parser.add_argument("--snake", required=True, help="Directory to write snake file to")
+
+    args = parser.parse_args()
+
+    sys.exit(run_fake_batch_soax(args.image, args.parameter, args.snake, load_model()))
+
+if __name__ == "__main__":
+    main()
@@ -15,6 +15,7 @@ from .setup_app import (
     SoaxParamsSetupPage2Form,
     SoaxParamsSetupPage3Form,
     SoaxRunSetupForm,
+    SuccessiveHalvingSweepSetupForm,
     SnakesToJsonSetupForm,
     JoinSectionedSnakesSetupForm,
     BeadPIVSetupForm,
@@ -23,6 +24,9 @@ from .setup_app import (
 from .utility_actions.tiff_info import tiff_info, tiff_file_or_dir_argparse_type
 from .utility_actions.pad_tiff_numbers import pad_tiff_numbers
 from .utility_actions.split_stacks import split_stacks
+from .utility_actions.result_cache import result_cache_stats, prune_result_cache
+from .utility_actions.run_logs import show_run_log
+from .utility_actions.convert_snake_format import convert_snake_format
 
 from .actions.bead_linking import link_beads
 from .actions.bead_piv import bead_piv
@@ -32,8 +36,9 @@ from .actions.create_image_specific_soax_param_files import create_image_specifi
 from .actions.divide_average_image import divide_average_image
 from .actions.join_sectioned_snakes import join_sectioned_snakes
 from .actions.rescale_tiffs import rescale_tiffs
-from .actions.run_soax import run_soax
+from .actions.run_soax import run_soax, write_soax_job_plan
 from .actions.section_tiffs import section_tiffs
+from .actions.successive_halving_sweep import successive_halving_sweep
 
 def parse_command_line_args_and_run():
     parser = argparse.ArgumentParser(description='Soax Helper')
@@ -53,6 +58,8 @@ def parse_command_line_args_and_run():
     run_parser = subparsers.add_parser("run", help="Run data processing steps, as specified by a JSON config file (generated with soaxhelper configure)")
     run_parser.add_argument("config_file", help="Name of JSON file to load configuration from")
     run_parser.add_argument("--logfile", default=None, help="Log file to record the progress of data processing steps")
+    run_parser.add_argument("--progress-file", default=None, help="JSON file to rewrite periodically with progress of the running step (jobs done, jobs per minute, ETA), to monitor runs without a terminal")
+    run_parser.add_argument("--plan-only", default=None, metavar="PLAN_FILE", help="Don't run any steps, just write the batch_soax jobs that the run_soax step would run to PLAN_FILE as JSON lines, and print job counts. Parameter files must already exist.")
     # run_parser.add_argument('--auto-make-dirs',default=True, action='store_true', help='Automatically create directories if they don\'t exist already. ')
     
 
@@ -68,6 +75,21 @@ def parse_command_line_args_and_run():
     split_stacks_parser = subparsers.add_parser('splitstacks', help='Split 3D Tiffs into it 2D frames')
     split_stacks_parser.add_argument('source_tiff_dir')
     split_stacks_parser.add_argument('target_directory')
+
+    cache_parser = subparsers.add_parser("cache", help="Show stats of or prune a snake result cache directory used by run_soax")
+    cache_parser.add_argument("cache_dir")
+    cache_parser.add_argument("cache_command", choices=["stats", "prune"])
+    cache_parser.add_argument("--max-gb", type=float, default=None, help="For prune: remove least recently used results until cache is at most this size. Default removes everything")
+
+    logs_parser = subparsers.add_parser("logs", help="List the jobs in a run_soax run log, or show the batch_soax output of one job")
+    logs_parser.add_argument("run_log", help="soax_run_log_*.log.gz file in the SOAX log directory")
+    logs_parser.add_argument("job", nargs="?", default=None, help="Job to show output of, ex. params_rt0.01/image1. Lists jobs if not given")
+    logs_parser.add_argument("--failed", default=False, action="store_true", help="Only list failed jobs")
+
+    snake_format_parser = subparsers.add_parser("snakeformat", help="Convert JSON snake files to binary .snakes files or back, for one file or a directory of them")
+    snake_format_parser.add_argument("source", help="Snake file or directory of snake files")
+    snake_format_parser.add_argument("target", help="Converted file, or directory to save converted files in with the same layout as the source directory")
+    snake_format_parser.add_argument("--to", dest="output_format", choices=["json", "binary"], required=True)
     
     args = parser.parse_args()
     
@@ -82,6 +104,8 @@ def parse_command_line_args_and_run():
         run_soax_helper(
             config_filepath=args.config_file,
             logfile=args.logfile,
+            progress_filepath=args.progress_file,
+            plan_only_filepath=args.plan_only,
         )
     elif args.subcommand == 'tiffinfo':
         tiff_info(args.target, logger=ConsoleLogger())
@@ -89,6 +113,15 @@ def parse_command_line_args_and_run():
         pad_tiff_numbers(args.tiff_dir, args.tiff_name_prefix, postfix_length=args.postfixlength, logger=ConsoleLogger())
     elif args.subcommand == 'splitstacks':
         split_stacks(args.source_tiff_dir, args.target_directory,logger=ConsoleLogger())
+    elif args.subcommand == 'cache':
+        if args.cache_command == "stats":
+            result_cache_stats(args.cache_dir, logger=ConsoleLogger())
+        else:
+            prune_result_cache(args.cache_dir, args.max_gb, logger=ConsoleLogger())
+    elif args.subcommand == 'logs':
+        show_run_log(args.run_log, args.job, args.failed, logger=ConsoleLogger())
+    elif args.subcommand == 'snakeformat':
+        convert_snake_format(args.source, args.target, args.output_format, logger=ConsoleLogger())
 
     exit(0)
     
@@ -96,7 +129,7 @@ def parse_command_line_args_and_run():
 # @TODO - make sure to check before running whether ALL directories exist
 # @TODO - move do_not_run functionality outside of this function!
 
-def run_soax_helper(config_filepath, logfile=None):
+def run_soax_helper(config_filepath, logfile=None, progress_filepath=None, plan_only_filepath=None):
     if not config_filepath.endswith(".json"):
         raise Exception("Invalid settings load file '{}': must be json file".format(config_filepath))
 
@@ -111,13 +144,41 @@ def run_soax_helper(config_filepath, logfile=None):
     with open(config_filepath, "r") as f:
         action_configs = json.load(f)
     
+    console_logger = ConsoleLogger()
 
-    if logfile is not None:
-        with open(save_logs_to_file, 'w') as log_file:
+    if plan_only_filepath is not None:
+        write_soax_plans(action_configs, plan_only_filepath, logger=console_logger)
+    elif logfile is not None:
+        with open(logfile, 'w') as log_file:
             file_logger = FileLogger(log_filehandle=log_file, child_logger=console_logger)
-            execute_data_actions(action_configs, True, logger=file_logger)
+            execute_data_actions(action_configs, True, logger=file_logger, progress_fp=progress_filepath)
     else:
-        execute_data_actions(action_configs, True, logger=console_logger)
+        execute_data_actions(action_configs, True, logger=console_logger, progress_fp=progress_filepath)
+
+def write_soax_plans(action_configs, plan_filepath, logger):
+    if os.path.exists(plan_filepath):
+        raise Exception("Cannot write plan to {}, already exists".format(plan_filepath))
+
+    run_soax_settings = [action_conf["settings"] for action_conf in action_configs if action_conf["action"] == "run_soax"]
+    if len(run_soax_settings) == 0:
+        raise Exception("No run_soax step in configuration, nothing to plan")
+
+    with open(plan_filepath, "w") as plan_file:
+        for setting_strings in run_soax_settings:
+            parsed_soax_run_settings = SoaxRunSetupForm.parseSettings(setting_strings, True)
+
+            write_soax_job_plan(
+                plan_file,
+                parsed_soax_run_settings["source_tiff_dir"],
+                parsed_soax_run_settings["param_files_dir"],
+                parsed_soax_run_settings["target_snakes_dir"],
+                parsed_soax_run_settings["soax_log_dir"],
+                use_sectioned_images=parsed_soax_run_settings["use_sectioned_images"],
+                use_image_specific_params=parsed_soax_run_settings["use_image_specific_params"],
+                logger=logger,
+            )
+
+    logger.log("Saved batch_soax job plan in {}".format(plan_filepath))
 
 def configure_soax_helper(config_filepath, create_missing_dirs_by_default=False):
     # Check if environment variable BATCH_SOAX_PATH is set for the path to the compiled
@@ -139,7 +200,7 @@ def configure_soax_helper(config_filepath, create_missing_dirs_by_default=False)
     
     print("Saved configuration in {}".format(config_filepath))
 
-def execute_data_actions(action_configs, make_dirs_if_not_present, logger):
+def execute_data_actions(action_configs, make_dirs_if_not_present, logger, progress_fp=None):
     all_loggers = []
     all_times = []
     all_warnings = []
@@ -154,7 +215,7 @@ def execute_data_actions(action_configs, make_dirs_if_not_present, logger):
         all_loggers.append((action_name, action_logger))
 
         try:
-            perform_action(action_name, action_settings, make_dirs_if_not_present, action_logger)
+            perform_action(action_name, action_settings, make_dirs_if_not_present, action_logger, progress_fp=progress_fp)
         except Exception as e:
             message = str(e)
             logger.error(message)
@@ -187,7 +248,7 @@ def execute_data_actions(action_configs, make_dirs_if_not_present, logger):
             for warning_text in step_warnings:
                 logger.warn("        " + warning_text)
 
-def perform_action(action_name, setting_strings, make_dirs, logger):
+def perform_action(action_name, setting_strings, make_dirs, logger, progress_fp=None):
 
     if action_name == "divide_average_image":
         parsed_divide_average_image_settings = DivideAverageImageSetupForm.parseSettings(setting_strings, make_dirs)
@@ -205,6 +266,7 @@ def perform_action(action_name, setting_strings, make_dirs, logger):
             parsed_rescale_tiffs_settings["output_dims"],
             parsed_rescale_tiffs_settings["workers_num"],
             logger=logger,
+            progress_fp=progress_fp,
         )
     elif action_name == "section_tiffs":
         parsed_sectioning_settings = SectioningSetupForm.parseSettings(setting_strings, make_dirs)
@@ -214,6 +276,7 @@ def perform_action(action_name, setting_strings, make_dirs, logger):
             parsed_sectioning_settings["target_sectioned_tiff_dir"],
             parsed_sectioning_settings["workers_num"],
             logger=logger,
+            progress_fp=progress_fp,
         )
     elif action_name == "create_regular_soax_param_files":
         create_normal_soax_param_files_settings = CreateNormalSoaxParamsSetupForm.parseSettings(setting_strings, make_dirs)
@@ -227,6 +290,11 @@ def perform_action(action_name, setting_strings, make_dirs, logger):
             params_save_dir=create_normal_soax_param_files_settings["params_save_dir"],
             param_settings=parsed_param_settings,
             logger=logger,
+            sampling_mode=create_normal_soax_param_files_settings["sampling_mode"],
+            sample_count=create_normal_soax_param_files_settings["sample_count"],
+            sampling_seed=create_normal_soax_param_files_settings["sampling_seed"],
+            max_param_files=create_normal_soax_param_files_settings["max_param_files"],
+            write_param_files=create_normal_soax_param_files_settings["write_param_files"],
         )
     elif action_name == "create_image_specific_soax_param_files":
         create_image_specific_soax_param_files_settings = CreateImageSpecificSoaxParamsSetupForm.parseSettings(setting_strings, make_dirs)
@@ -242,6 +310,14 @@ def perform_action(action_name, setting_strings, make_dirs, logger):
             set_intensity_scaling_for_each_image=create_image_specific_soax_param_files_settings["set_intensity_scaling_for_each_image"],
             general_param_settings=parsed_general_param_settings,
             logger=logger,
+            sampling_mode=create_image_specific_soax_param_files_settings["sampling_mode"],
+            sample_count=create_image_specific_soax_param_files_settings["sample_count"],
+            sampling_seed=create_image_specific_soax_param_files_settings["sampling_seed"],
+            max_param_files=create_image_specific_soax_param_files_settings["max_param_files"],
+            write_param_files=create_image_specific_soax_param_files_settings["write_param_files"],
+            workers=create_image_specific_soax_param_files_settings["workers"],
+            intensity_scaling_mode=create_image_specific_soax_param_files_settings["intensity_scaling_mode"],
+            intensity_scaling_percentile=create_image_specific_soax_param_files_settings["intensity_scaling_percentile"],
         )
     elif action_name == "run_soax":
         parsed_soax_run_settings = SoaxRunSetupForm.parseSettings(setting_strings, make_dirs)
@@ -257,6 +333,35 @@ def perform_action(action_name, setting_strings, make_dirs, logger):
             delete_soax_logs_for_finished_runs=parsed_soax_run_settings["delete_soax_logs_for_finished_runs"],
             workers_num=parsed_soax_run_settings["workers"],
             logger=logger,
+            progress_fp=progress_fp,
+            result_cache_dir=parsed_soax_run_settings["result_cache_dir"],
+            result_cache_max_gb=parsed_soax_run_settings["result_cache_max_gb"],
+            use_thread_budget=parsed_soax_run_settings["use_thread_budget"],
+            pin_cpus=parsed_soax_run_settings["pin_cpus"],
+            param_group_size=parsed_soax_run_settings["param_group_size"],
+            use_run_log=parsed_soax_run_settings["use_run_log"],
+        )
+    elif action_name == "successive_halving_sweep":
+        parsed_sweep_settings = SuccessiveHalvingSweepSetupForm.parseSettings(setting_strings, make_dirs)
+
+        successive_halving_sweep(
+            parsed_sweep_settings["batch_soax_path"],
+            parsed_sweep_settings["source_tiff_dir"],
+            parsed_sweep_settings["param_files_dir"],
+            parsed_sweep_settings["target_sweep_dir"],
+            parsed_sweep_settings["soax_log_dir"],
+            use_sectioned_images=parsed_sweep_settings["use_sectioned_images"],
+            use_image_specific_params=parsed_sweep_settings["use_image_specific_params"],
+            metric=parsed_sweep_settings["metric"],
+            higher_metric_is_better=parsed_sweep_settings["higher_metric_is_better"],
+            keep_percent=parsed_sweep_settings["keep_percent"],
+            initial_image_count=parsed_sweep_settings["initial_image_count"],
+            final_param_count=parsed_sweep_settings["final_param_count"],
+            max_jobs=parsed_sweep_settings["max_jobs"],
+            random_seed=parsed_sweep_settings["random_seed"],
+            workers_num=parsed_sweep_settings["workers"],
+            logger=logger,
+            progress_fp=progress_fp,
         )
     elif action_name == "convert_snakes_to_json":
         parsed_snakes_to_json_settings = SnakesToJsonSetupForm.parseSettings(setting_strings, make_dirs)
@@ -269,6 +374,10 @@ def perform_action(action_name, setting_strings, make_dirs, logger):
             parsed_snakes_to_json_settings["dims_pixels"],
             parsed_snakes_to_json_settings["pixel_spacing_um_xyz"],
             logger=logger,
+            progress_fp=progress_fp,
+            output_format=parsed_snakes_to_json_settings["output_format"],
+            workers=parsed_snakes_to_json_settings["workers"],
+            incremental=parsed_snakes_to_json_settings["incremental"],
         )
     elif action_name == "join_sectioned_snakes":
         parsed_join_sectioned_snakes_settings = JoinSectionedSnakesSetupForm.parseSettings(setting_strings, make_dirs)
@@ -279,6 +388,8 @@ def perform_action(action_name, setting_strings, make_dirs, logger):
             parsed_join_sectioned_snakes_settings["source_jsons_depth"],
             parsed_join_sectioned_snakes_settings["workers"],
             logger=logger,
+            progress_fp=progress_fp,
+            output_format=parsed_join_sectioned_snakes_settings["output_format"],
         )
     elif action_name == "do_bead_PIV":
         parsed_bead_PIV_settings = BeadPIVSetupForm.parseSettings(setting_strings, make_dirs)
@@ -6,7 +6,7 @@ from PIL import ImageTk, Image
 import tkinter as tk
 
 from .snakeutils.tifimage import pil_img_3d_to_np_arr
-from .snakeutils.snakejson import load_json_snakes
+from .snakeutils.snakeformats import load_snakes
 
 def _image_scale_to_fit_in_box(pil_img, new_width, new_height):
     horizontal_ratio = new_width/pil_img.width
@@ -39,15 +39,10 @@ class AnnotatorGui:
 
 def display_snakes(snakes):
     # plt.clf()
-    for snake_info in snakes:
-        x = []
-        y = []
-        z = []
-        for snake_pt in snake_info:
-            pt_x,pt_y,pt_z = snake_pt["pos"]
-            x.append(pt_x)
-            y.append(pt_y)
-            z.append(pt_z)
+    for snake in snakes:
+        x = snake.positions[:,0]
+        y = snake.positions[:,1]
+        z = snake.positions[:,2]
         if args.flatten:
             ax.plot(x,y, 'b')
         else:
@@ -70,7 +65,7 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    snakes,metadata = load_json_snakes(args.json_path)
+    snakes,metadata = load_snakes(args.json_path)
 
     fig = plt.figure(num=args.json_path, figsize=(10,7))
 
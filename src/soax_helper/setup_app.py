@@ -189,6 +189,7 @@ class SoaxStepsSelectForm(npyscreen.Form):
         {"name": "create_soax_params", "show": "Make SOAX Parameter Files"},
         {"name": "create_image_specific_soax_params", "show": "Make SOAX Parameter Files - With Image-Specific Parameters"},
         {"name": "run_soax", "show": "Run SOAX"},
+        {"name": "successive_halving_sweep", "show": "Adaptive Parameter Sweep - Run SOAX on more images only for the best parameters so far"},
         {"name": "snakes_to_json", "show": "Convert Snake files to JSON"},
         {"name": "join_sectioned_snakes", "show": "Join Sectioned Snakes together (you should do this if input images to soax are sectioned)"},
     ]
@@ -218,6 +219,7 @@ class SoaxStepsSelectForm(npyscreen.Form):
         do_create_soax_params                =  self.step_is_selected("create_soax_params")
         do_create_image_specific_soax_params =  self.step_is_selected("create_image_specific_soax_params")
         do_run_soax                          =  self.step_is_selected("run_soax")
+        do_successive_halving_sweep          =  self.step_is_selected("successive_halving_sweep")
         do_snakes_to_json                    =  self.step_is_selected("snakes_to_json")
         do_join_sectioned_snakes             =  self.step_is_selected("join_sectioned_snakes")
 
@@ -245,6 +247,7 @@ class SoaxStepsSelectForm(npyscreen.Form):
             do_create_soax_params=do_create_soax_params,
             do_create_image_specific_soax_params=do_create_image_specific_soax_params,
             do_run_soax=do_run_soax,
+            do_successive_halving_sweep=do_successive_halving_sweep,
             do_snakes_to_json=do_snakes_to_json,
             do_join_sectioned_snakes=do_join_sectioned_snakes,
         )
@@ -344,6 +347,10 @@ class SetupForm(npyscreen.Form):
             return parse_infer_or_int_coords(field_id, field_str)
         elif field_type == "float_coords":
             return parse_float_coords(field_id, field_str)
+        elif field_type == "choice":
+            if field_str not in field_details:
+                raise ParseException("Invalid field '{}' value '{}': expected one of {}".format(field_id, field_str, ", ".join(field_details)))
+            return field_str
         else:
             raise Exception("Unknown field type '{}'".format(field_type))
 
@@ -354,7 +361,11 @@ class SetupForm(npyscreen.Form):
         for field_info in cls.field_infos:
             field_id = field_info["id"]
             field_type = field_info["type"]
-            field_str = field_strings[field_id]
+            # Fields added after a config was saved are parsed from their default
+            if field_id not in field_strings and "default" in field_info:
+                field_str = field_info["default"]
+            else:
+                field_str = field_strings[field_id]
             field_details = field_info["details"] if "details" in field_info else None
             if cls.field_strings_nullable_to_grey_out_and_ignore and field_str is None:
                 parsed_fields[field_id] = None
@@ -366,7 +377,7 @@ class SetupForm(npyscreen.Form):
     def add_info_text(self, info_str):
         self.add(npyscreen.FixedText, value=info_str)
 
-    def add_field(self, field_id, field_name, field_str, field_type):
+    def add_field(self, field_id, field_name, field_str, field_type, field_details=None):
         if self.field_strings_nullable_to_grey_out_and_ignore and field_str is None:
             self.npy_fields[field_id] = None
             self.add(
@@ -410,6 +421,14 @@ class SetupForm(npyscreen.Form):
                 values=["true", "false"],
                 value=([0] if field_str == "true" else [1]),
                 scroll_exit=True)
+        elif field_type == "choice":
+            self.npy_fields[field_id] = self.add(
+                npyscreen.TitleSelectOne,
+                max_height = len(field_details) + 1,
+                name=field_name,
+                values=field_details,
+                value=[field_details.index(field_str) if field_str in field_details else 0],
+                scroll_exit=True)
         else:
             raise Exception("Unknown type '{}' for field '{}'".format(field_type, field_id))
 
@@ -435,8 +454,9 @@ class SetupForm(npyscreen.Form):
                 self.add_info_text(menu_config["notes"][field_id])
             field_str = field_defaults[field_id]
             field_type = field_info["type"]
+            field_details = field_info["details"] if "details" in field_info else None
 
-            self.add_field(field_id, field_name, field_str, field_type)
+            self.add_field(field_id, field_name, field_str, field_type, field_details)
 
 
     def getFieldString(self, field_type, field_id, field_details):
@@ -463,6 +483,8 @@ class SetupForm(npyscreen.Form):
             return self.npy_fields[field_id].value
         elif field_type in ["true_false"]:
             return "true" if (0 in self.npy_fields[field_id].value) else "false"
+        elif field_type == "choice":
+            return field_details[self.npy_fields[field_id].value[0]]
         else:
             raise Exception("Don't know what to do with field_type {}".format(field_type))
 
@@ -604,6 +626,43 @@ class CreateNormalSoaxParamsSetupForm(SetupForm):
             "id": "params_save_dir",
             "type": "dir",
         },
+        {
+            "help": [
+                "grid makes a parameter file for every combination of the parameter ranges. random, latin_hypercube",
+                "and sobol make exactly sample_count files from the same ranges, chosen with the sampling seed",
+            ],
+            "id": "sampling_mode",
+            "type": "choice",
+            "details": ["grid", "random", "latin_hypercube", "sobol"],
+            "default": "grid",
+        },
+        {
+            "id": "sample_count",
+            "type": "pos_int",
+            "default": "100",
+        },
+        {
+            "id": "sampling_seed",
+            "type": "non_neg_int",
+            "default": "0",
+        },
+        {
+            "help": [
+                "Stop with an error instead of making more than this many parameter files (0 for no limit)",
+            ],
+            "id": "max_param_files",
+            "type": "non_neg_int",
+            "default": "10000",
+        },
+        {
+            "help": [
+                "If false, the parameter sets are only saved in params_manifest.jsonl, and run_soax makes each",
+                "parameter file when its job starts",
+            ],
+            "id": "write_param_files",
+            "type": "true_false",
+            "default": "true",
+        },
     ]
     app_done_func_name = "createNormalSoaxParamsSetupDone"
 
@@ -622,6 +681,64 @@ class CreateImageSpecificSoaxParamsSetupForm(SetupForm):
             "id": "set_intensity_scaling_for_each_image",
             "type": "true_false",
         },
+        {
+            "help": [
+                "max scales each image so its brightest voxel is 1. percentile scales it so the intensity_scaling_percentile",
+                "percentile of its voxels is 1, so a few hot pixels don't shrink the range of the rest of the image",
+            ],
+            "id": "intensity_scaling_mode",
+            "type": "choice",
+            "details": ["max", "percentile"],
+            "default": "max",
+        },
+        {
+            "id": "intensity_scaling_percentile",
+            "type": "percentage",
+            "default": "99.99",
+        },
+        {
+            "help": "Number of images read at the same time when finding intensity scaling",
+            "id": "workers",
+            "type": "pos_int",
+            "default": "1",
+        },
+        {
+            "help": [
+                "grid makes a parameter file for every combination of the parameter ranges. random, latin_hypercube",
+                "and sobol make exactly sample_count files from the same ranges, chosen with the sampling seed",
+            ],
+            "id": "sampling_mode",
+            "type": "choice",
+            "details": ["grid", "random", "latin_hypercube", "sobol"],
+            "default": "grid",
+        },
+        {
+            "id": "sample_count",
+            "type": "pos_int",
+            "default": "100",
+        },
+        {
+            "id": "sampling_seed",
+            "type": "non_neg_int",
+            "default": "0",
+        },
+        {
+            "help": [
+                "Stop with an error instead of making more than this many parameter files (0 for no limit)",
+            ],
+            "id": "max_param_files",
+            "type": "non_neg_int",
+            "default": "10000",
+        },
+        {
+            "help": [
+                "If false, the parameter sets are only saved in params_manifest.jsonl, and run_soax makes each",
+                "parameter file when its job starts",
+            ],
+            "id": "write_param_files",
+            "type": "true_false",
+            "default": "true",
+        },
     ]
 
     app_done_func_name = "createImageSpecificSoaxParamsSetupDone"
@@ -807,10 +924,132 @@ class SoaxRunSetupForm(SetupForm):
             "id": "use_sectioned_images",
             "type": "true_false",
         },
+        {
+            "help": [
+                "Optional directory to keep snake results in, so later runs with the same image,",
+                "parameters and batch_soax can reuse them. Leave empty to not use a cache",
+            ],
+            "id": "result_cache_dir",
+            "type": "optional_dir",
+            "default": "",
+        },
+        {
+            "help": "Size limit of the result cache in GB, least recently used results are removed after the run",
+            "id": "result_cache_max_gb",
+            "type": "optional_pos_float",
+            "default": "",
+        },
+        {
+            "help": [
+                "batch_soax uses all cores by default, so several workers compete for the same cores.",
+                "Set to true to split the cores between the workers and limit batch_soax threads to each share",
+            ],
+            "id": "use_thread_budget",
+            "type": "true_false",
+            "default": "false",
+        },
+        {
+            "help": "With the thread budget, also pin each batch_soax process to its cores (Linux only)",
+            "id": "pin_cpus",
+            "type": "true_false",
+            "default": "false",
+        },
+        {
+            "help": [
+                "Number of parameter files for the same image to give to one batch_soax process as a directory,",
+                "so the image is only loaded once. Needs a batch_soax that accepts a parameter directory. 1 to disable",
+            ],
+            "id": "param_group_size",
+            "type": "pos_int",
+            "default": "1",
+        },
+        {
+            "help": [
+                "Set to true to keep batch_soax output in one compressed run log instead of three files per job.",
+                "Full output is only kept for failed jobs. Read it with 'soaxhelper logs'",
+            ],
+            "id": "use_run_log",
+            "type": "true_false",
+            "default": "false",
+        },
     ]
 
     app_done_func_name = "soaxRunSetupDone"
 
+class SuccessiveHalvingSweepSetupForm(SetupForm):
+    field_infos = [
+        {
+            "help": [
+                "Runs every parameter file on a few images, keeps the parameter sets with the best",
+                "snake metric, and repeats with more images until few parameter sets are left",
+            ],
+            "id": "source_tiff_dir",
+            "type": "dir",
+        },
+        {
+            "id": "param_files_dir",
+            "type": "dir",
+        },
+        {
+            "id": "use_image_specific_params",
+            "type": "true_false",
+        },
+        {
+            "id": "use_sectioned_images",
+            "type": "true_false",
+        },
+        {
+            "id": "target_sweep_dir",
+            "type": "dir",
+        },
+        {
+            "id": "soax_log_dir",
+            "type": "dir",
+        },
+        {
+            "id": "batch_soax_path",
+            "type": "file",
+        },
+        {
+            "id": "metric",
+            "type": "choice",
+            "details": ["snake_count", "total_length", "coverage"],
+        },
+        {
+            "id": "higher_metric_is_better",
+            "type": "true_false",
+        },
+        {
+            "help": "Percent of parameter sets kept after each round",
+            "id": "keep_percent",
+            "type": "percentage",
+        },
+        {
+            "help": "Number of images (or sections) in the first round, later rounds add more",
+            "id": "initial_image_count",
+            "type": "pos_int",
+        },
+        {
+            "id": "final_param_count",
+            "type": "pos_int",
+        },
+        {
+            "help": "Most batch_soax jobs to run in the whole sweep, 0 for no limit",
+            "id": "max_jobs",
+            "type": "non_neg_int",
+        },
+        {
+            "id": "random_seed",
+            "type": "non_neg_int",
+        },
+        {
+            "id": "workers",
+            "type": "pos_int",
+        },
+    ]
+
+    app_done_func_name = "successiveHalvingSweepSetupDone"
+
 class SnakesToJsonSetupForm(SetupForm):
     field_infos = [
         {
@@ -848,6 +1087,25 @@ class SnakesToJsonSetupForm(SetupForm):
             "id": "pixel_spacing_um_xyz",
             "type": "float_coords",
         },
+        {
+            "help": "Save snakes as JSON, or as binary .snakes files that open much faster",
+            "id": "output_format",
+            "type": "choice",
+            "details": ["json", "binary"],
+            "default": "json",
+        },
+        {
+            "help": "Number of processes converting snake files at the same time",
+            "id": "workers",
+            "type": "pos_int",
+            "default": "1",
+        },
+        {
+            "help": "Only convert snake files that are new or changed since the last run into this target directory, and remove outputs whose snake file is gone",
+            "id": "incremental",
+            "type": "true_false",
+            "default": "false",
+        },
     ]
 
     app_done_func_name = "snakesToJsonSetupDone"
@@ -873,7 +1131,14 @@ class JoinSectionedSnakesSetupForm(SetupForm):
         {
             "id": "workers",
             "type": "pos_int",
-        }
+        },
+        {
+            "help": "Save snakes as JSON, or as binary .snakes files that open much faster",
+            "id": "output_format",
+            "type": "choice",
+            "details": ["json", "binary"],
+            "default": "json",
+        },
     ]
 
     app_done_func_name = "joinSectionedSnakesSetupDone"
@@ -1011,6 +1276,11 @@ class SoaxSetupApp(npyscreen.NPSAppManaged):
         self.create_normal_soax_params_config = {
             "fields": {
                 "params_save_dir": "./Params",
+                "sampling_mode": "grid",
+                "sample_count": "100",
+                "sampling_seed": "0",
+                "max_param_files": "10000",
+                "write_param_files": "true",
             },
             "notes": {},
         }
@@ -1020,6 +1290,14 @@ class SoaxSetupApp(npyscreen.NPSAppManaged):
                 "params_save_dir": "./ImageSpecificParams",
                 "original_tiff_dir": "",
                 "set_intensity_scaling_for_each_image": "false",
+                "intensity_scaling_mode": "max",
+                "intensity_scaling_percentile": "99.99",
+                "workers": "1",
+                "sampling_mode": "grid",
+                "sample_count": "100",
+                "sampling_seed": "0",
+                "max_param_files": "10000",
+                "write_param_files": "true",
             },
             "notes": {},
         }
@@ -1083,6 +1361,32 @@ class SoaxSetupApp(npyscreen.NPSAppManaged):
                 "param_files_dir": "",
                 "use_image_specific_params": "false",
                 "soax_log_dir": "./SoaxLogs",
+                "result_cache_dir": "",
+                "result_cache_max_gb": "",
+                "use_thread_budget": "false",
+                "pin_cpus": "false",
+                "param_group_size": "1",
+                "use_run_log": "false",
+            },
+            "notes": {},
+        }
+        self.successive_halving_sweep_config = {
+            "fields": {
+                "source_tiff_dir": "",
+                "param_files_dir": "",
+                "use_image_specific_params": "false",
+                "use_sectioned_images": "false",
+                "target_sweep_dir": "./ParamSweep",
+                "soax_log_dir": "./ParamSweepLogs",
+                "batch_soax_path": ("" if self.batch_soax_path is None else self.batch_soax_path),
+                "metric": "snake_count",
+                "higher_metric_is_better": "true",
+                "keep_percent": "50",
+                "initial_image_count": "2",
+                "final_param_count": "1",
+                "max_jobs": "0",
+                "random_seed": "0",
+                "workers": "1",
             },
             "notes": {},
         }
@@ -1094,6 +1398,9 @@ class SoaxSetupApp(npyscreen.NPSAppManaged):
                 "offset_pixels": "0,0,0",
                 "dims_pixels": "",
                 "pixel_spacing_um_xyz": "",
+                "output_format": "json",
+                "workers": "1",
+                "incremental": "false",
             },
             "notes": {},
         }
@@ -1103,6 +1410,7 @@ class SoaxSetupApp(npyscreen.NPSAppManaged):
                 "target_json_dir": "./JoinedJsonSnakes",
                 "source_jsons_depth": "",
                 "workers": "1",
+                "output_format": "json",
             },
             "notes": {},
         }
@@ -1190,6 +1498,11 @@ class SoaxSetupApp(npyscreen.NPSAppManaged):
                 "action": "run_soax",
                 "settings": self.soax_run_config["fields"],
             })
+        if self.do_successive_halving_sweep:
+            action_configs.append({
+                "action": "successive_halving_sweep",
+                "settings": self.successive_halving_sweep_config["fields"],
+            })
         if self.do_snakes_to_json:
             action_configs.append({
                 "action": "convert_snakes_to_json",
@@ -1255,6 +1568,7 @@ class SoaxSetupApp(npyscreen.NPSAppManaged):
 
     def setSoaxInputTiffDir(self, tiff_dir):
         self.soax_run_config["fields"]["source_tiff_dir"] = tiff_dir
+        self.successive_halving_sweep_config["fields"]["source_tiff_dir"] = tiff_dir
         # self.create_image_specific_soax_params_config["fields"]["original_tiff_dir"] = tiff_dir
 
     def startPixelSizeSelect(self):
@@ -1295,6 +1609,7 @@ class SoaxSetupApp(npyscreen.NPSAppManaged):
         do_create_soax_params,
         do_create_image_specific_soax_params,
         do_run_soax,
+        do_successive_halving_sweep,
         do_snakes_to_json,
         do_join_sectioned_snakes,
         ):
@@ -1304,6 +1619,7 @@ class SoaxSetupApp(npyscreen.NPSAppManaged):
         self.do_create_soax_params = do_create_soax_params
         self.do_create_image_specific_soax_params = do_create_image_specific_soax_params
         self.do_run_soax = do_run_soax
+        self.do_successive_halving_sweep = do_successive_halving_sweep
         self.do_snakes_to_json = do_snakes_to_json
         self.do_join_sectioned_snakes = do_join_sectioned_snakes
 
@@ -1325,6 +1641,8 @@ class SoaxSetupApp(npyscreen.NPSAppManaged):
             self.menu_functions.append(self.startSoaxParamsSetupPage3)
         if self.do_run_soax:
             self.menu_functions.append(self.startSoaxRunSetup)
+        if self.do_successive_halving_sweep:
+            self.menu_functions.append(self.startSuccessiveHalvingSweepSetup)
         if self.do_snakes_to_json:
             self.menu_functions.append(self.startSnakesToJsonSetup)
         if self.do_join_sectioned_snakes:
@@ -1442,6 +1760,8 @@ class SoaxSetupApp(npyscreen.NPSAppManaged):
         self.setSoaxInputTiffDir(fields["target_sectioned_tiff_dir"])
         self.soax_run_config["fields"]["use_sectioned_images"] = "true"
         self.soax_run_config["fields"]["use_image_specific_params"] = "true"
+        self.successive_halving_sweep_config["fields"]["use_sectioned_images"] = "true"
+        self.successive_halving_sweep_config["fields"]["use_image_specific_params"] = "true"
         self.create_image_specific_soax_params_config["fields"]["set_intensity_scaling_for_each_image"] = "true"
 
         self.image_being_split = True
@@ -1459,6 +1779,7 @@ class SoaxSetupApp(npyscreen.NPSAppManaged):
     def createNormalSoaxParamsSetupDone(self, fields):
         self.create_normal_soax_params_config["fields"] = fields
         self.soax_run_config["fields"]["param_files_dir"] = fields["params_save_dir"]
+        self.successive_halving_sweep_config["fields"]["param_files_dir"] = fields["params_save_dir"]
         self.goToNextMenu()
 
     def startCreateImageSpecificSoaxParamsSetup(self):
@@ -1476,6 +1797,7 @@ class SoaxSetupApp(npyscreen.NPSAppManaged):
             self.soax_params_page1_config["fields"]["intensity_scaling"] = None
 
         self.soax_run_config["fields"]["param_files_dir"] = fields["params_save_dir"]
+        self.successive_halving_sweep_config["fields"]["param_files_dir"] = fields["params_save_dir"]
 
         self.goToNextMenu()
 
@@ -1497,6 +1819,16 @@ class SoaxSetupApp(npyscreen.NPSAppManaged):
 
         self.goToNextMenu()
 
+    def startSuccessiveHalvingSweepSetup(self):
+        self.addForm('SUCCESSIVE_HALVING_SWEEP_SETUP', SuccessiveHalvingSweepSetupForm, name="Adaptive Parameter Sweep Setup")
+        self.getForm('SUCCESSIVE_HALVING_SWEEP_SETUP').configure(self.successive_halving_sweep_config, self.make_dirs)
+        self.setNextForm('SUCCESSIVE_HALVING_SWEEP_SETUP')
+
+    def successiveHalvingSweepSetupDone(self, fields):
+        self.successive_halving_sweep_config["fields"] = fields
+
+        self.goToNextMenu()
+
     def startSnakesToJsonSetup(self):
         if self.pixel_spacing_xyz is not None:
             spacing_string = ",".join([str(dim) for dim in self.pixel_spacing_xyz])
@@ -2,6 +2,9 @@ import sys
 import os
 import numpy as np
 
+from .snakeset import SnakeSet
+from .snakegraph import SnakeGraph
+
 def has_one_of_extensions(filename, file_extensions):
     for file_extension in file_extensions:
         if filename.lower().endswith(file_extension.lower()):
@@ -53,6 +56,34 @@ def find_files_or_folders_at_depth(source_dir_path, depth, file_extension=None,
             folders_and_files.extend(sub_folders_and_files)
         return folders_and_files
 
+def count_snakes(snake_file):
+    # get past starting params, same as extract_snakes
+    for i in range(30):
+        snake_file.readline()
+
+    snake_count = 0
+    in_snake = False
+    for line in snake_file:
+        split_line = line.split()
+        #reached junction point section
+        if len(split_line) == 3:
+            break
+        # open/closed #1 #0 line between snakes
+        if len(split_line) == 1:
+            in_snake = False
+        elif len(split_line) > 1 and not in_snake:
+            snake_count += 1
+            in_snake = True
+
+    return snake_count
+
+def snake_name_sort_key(snake_name):
+    # Snakes are numbered, so snake 10 comes after snake 9. A snake with no points is named
+    # after its open/closed marker line, those go last.
+    if snake_name.isdigit():
+        return (0, int(snake_name), snake_name)
+    return (1, 0, snake_name)
+
 def extract_snakes(snake_file, logger=None):
     # get past starting params
     count = 0
@@ -82,7 +113,7 @@ def extract_snakes(snake_file, logger=None):
             if len(split_line) == 3:
                 break
 
-            snake_name = line[0]
+            snake_name = split_line[0]
             snake_points = []
 
         if line_idx >= len(lines):
@@ -146,8 +177,146 @@ def extract_snakes(snake_file, logger=None):
     snake_arr = []
 
     # turn dict into array of snakes starting at index zero
-    for key in sorted(snake_dict.keys()):
+    for key in sorted(snake_dict.keys(), key=snake_name_sort_key):
         snake = snake_dict[key]
         snake_arr.append(snake)
 
     return snake_arr
+
+snake_file_header_lines = 30
+# Number of columns of each value after the snake number in a snake point line
+snake_point_field_width = 12
+snake_point_fields = 5
+
+def read_snake_point_arrays(snake_file, logger=None, chunk_lines=16384, with_junctions=False):
+    """ Reads the same snakes as extract_snakes, but decodes all the point lines at once
+    with numpy instead of line by line.
+
+    Returns (points, snake_offsets). points is an N x 5 float64 array with x, y, z, fg and bg
+    of every point, and the points of snake i are points[snake_offsets[i]:snake_offsets[i + 1]].
+    Snakes are in the same order as extract_snakes gives them.
+
+    With with_junctions, returns (points, snake_offsets, junction_positions), with the J x 3
+    float64 x, y, z of every line of the junction section that follows the snakes.
+    """
+    for i in range(snake_file_header_lines):
+        snake_file.readline()
+
+    text = snake_file.read()
+    if isinstance(text, str):
+        text = text.encode("utf-8")
+    buf = np.frombuffer(text, dtype=np.uint8)
+    buf_len = len(buf)
+
+    newline_pos = np.flatnonzero(buf == ord("\n"))
+    line_starts = np.concatenate([[0], newline_pos + 1])
+    line_ends = np.concatenate([newline_pos, [buf_len]])
+    # No line after the last newline, same as readlines
+    if line_starts[-1] == buf_len:
+        line_starts = line_starts[:-1]
+        line_ends = line_ends[:-1]
+    line_count = len(line_starts)
+    if logger is not None:
+        logger.log("Number of lines in snake file: {}".format(line_count))
+
+    # Whitespace separated fields, like str.split(). Every ASCII whitespace character is at
+    # or below the space character.
+    nonspace = buf > ord(" ")
+    field_start_mask = nonspace.copy()
+    field_start_mask[1:] &= ~nonspace[:-1]
+    field_end_mask = nonspace.copy()
+    field_end_mask[:-1] &= ~nonspace[1:]
+    field_starts = np.flatnonzero(field_start_mask)
+    field_ends = np.concatenate([np.flatnonzero(field_end_mask) + 1, [buf_len]])
+    first_field_idxs = np.searchsorted(field_starts, line_starts)
+    field_counts = np.searchsorted(field_starts, line_ends) - first_field_idxs
+
+    # Snakes end at the first line of the junction section, which has three values
+    junction_lines = np.flatnonzero(field_counts == 3)
+    end_line = junction_lines[0] if len(junction_lines) > 0 else line_count
+
+    # Every snake starts on the line after an open/closed marker line, and ends before the
+    # next marker. Marker lines right after each other give snakes with no points.
+    marker_lines = np.flatnonzero(field_counts[:end_line] == 1)
+    snake_start_lines = np.concatenate([[0], marker_lines + 1])
+    snake_start_lines = snake_start_lines[snake_start_lines < end_line]
+    marker_and_end_lines = np.concatenate([marker_lines, [end_line]])
+    snake_end_lines = marker_and_end_lines[np.searchsorted(marker_and_end_lines, snake_start_lines)]
+
+    snake_names = []
+    for start_line in snake_start_lines:
+        first_field = text[line_starts[start_line]:line_ends[start_line]].split(None, 1)
+        if len(first_field) == 0:
+            raise ValueError("Snake starts with a blank line in snake file")
+        snake_names.append(first_field[0].decode("utf-8"))
+
+    # Like extract_snakes, the values start 12 columns after the first space in the line
+    point_lines = np.flatnonzero(field_counts[:end_line] != 1)
+    point_line_starts = line_starts[point_lines]
+    snake_number_widths = field_ends[first_field_idxs[point_lines]] - point_line_starts
+    snake_number_widths[buf[np.minimum(point_line_starts, buf_len - 1)] == ord(" ")] = 0
+    value_starts = point_line_starts + snake_number_widths + snake_point_field_width
+    point_line_ends = line_ends[point_lines]
+
+    # Decode the fixed width values of every point line. Columns past the end of a line are
+    # read as spaces.
+    values_width = snake_point_field_width * snake_point_fields
+    padded_buf = np.concatenate([buf, np.full(values_width, ord(" "), dtype=np.uint8)])
+    column_offsets = np.arange(values_width)
+    point_values = np.empty((len(point_lines), snake_point_fields), dtype=np.float64)
+    for chunk_start in range(0, len(point_lines), chunk_lines):
+        chunk_value_starts = value_starts[chunk_start:chunk_start + chunk_lines]
+        chars = padded_buf[chunk_value_starts[:, None] + column_offsets]
+        short_rows = np.flatnonzero(point_line_ends[chunk_start:chunk_start + chunk_lines] < chunk_value_starts + values_width)
+        for row in short_rows:
+            line_end = point_line_ends[chunk_start + row]
+            chars[row, max(line_end - chunk_value_starts[row], 0):] = ord(" ")
+        point_values[chunk_start:chunk_start + chunk_lines] = chars.view("S{}".format(snake_point_field_width)).astype(np.float64)
+
+    if with_junctions:
+        junction_lines = end_line + np.flatnonzero(field_counts[end_line:] == 3)
+        junction_positions = np.array(
+            [text[line_starts[line_idx]:line_ends[line_idx]].split() for line_idx in junction_lines],
+            dtype=np.float64,
+        ).reshape(-1, 3)
+
+    # Point lines of each snake are contiguous in point_values
+    snake_point_counts = snake_end_lines - snake_start_lines
+    file_offsets = np.concatenate([[0], np.cumsum(snake_point_counts)]).astype(np.int64)
+
+    # Like extract_snakes, a later snake with the same number replaces an earlier one
+    snake_idx_by_name = {}
+    for snake_idx, snake_name in enumerate(snake_names):
+        snake_idx_by_name[snake_name] = snake_idx
+    ordered_snake_idxs = [snake_idx_by_name[snake_name] for snake_name in sorted(snake_idx_by_name, key=snake_name_sort_key)]
+
+    if ordered_snake_idxs != list(range(len(snake_names))):
+        ordered_counts = snake_point_counts[ordered_snake_idxs]
+        point_idxs = np.concatenate([np.arange(file_offsets[i], file_offsets[i + 1]) for i in ordered_snake_idxs] + [np.zeros(0, dtype=np.int64)])
+        point_values = point_values[point_idxs]
+        file_offsets = np.concatenate([[0], np.cumsum(ordered_counts)]).astype(np.int64)
+
+    if with_junctions:
+        return point_values, file_offsets, junction_positions
+    return point_values, file_offsets
+
+def extract_snakes_vectorized(snake_file, logger=None):
+    """ Same output as extract_snakes, parsed with read_snake_point_arrays """
+    point_values, snake_offsets = read_snake_point_arrays(snake_file, logger=logger)
+    rows = point_values.tolist()
+    return [
+        [{"pos": row[0:3], "fg": row[3], "bg": row[4]} for row in rows[snake_offsets[i]:snake_offsets[i + 1]]]
+        for i in range(len(snake_offsets) - 1)
+    ]
+
+def extract_snake_set(snake_file, logger=None):
+    """ Reads the snakes in a SOAX snake file into a SnakeSet """
+    point_values, snake_offsets = read_snake_point_arrays(snake_file, logger=logger)
+    return SnakeSet.from_point_arrays(point_values, snake_offsets)
+
+def extract_snake_set_and_graph(snake_file, logger=None, junction_tolerance_pixels=1.0):
+    """ Reads the snakes in a SOAX snake file into a SnakeSet, and its junction section into a
+    SnakeGraph of which snakes meet at each junction """
+    point_values, snake_offsets, junction_positions = read_snake_point_arrays(snake_file, logger=logger, with_junctions=True)
+    snakes = SnakeSet.from_point_arrays(point_values, snake_offsets)
+    return snakes, SnakeGraph.from_junctions(snakes, junction_positions, junction_tolerance_pixels)
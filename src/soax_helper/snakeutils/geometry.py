@@ -0,0 +1,47 @@
+""" Coordinate transforms on whole SnakeSets at once. Each function works on the N x 3
+positions array of every point instead of on one point at a time, and returns a new
+SnakeSet.
+"""
+import numpy as np
+
+def clip_to_box(snakes, lower_xyz, upper_xyz):
+    """ Limits the x, y, z of every point to lower_xyz and upper_xyz """
+    return snakes.with_positions(np.clip(snakes.positions, lower_xyz, upper_xyz))
+
+def translate(snakes, offset_xyz):
+    """ Moves every point by offset_xyz. The sum is done in float64 before being stored
+    in the SnakeSet's float32 """
+    return snakes.with_positions(snakes.positions.astype(np.float64) + np.asarray(offset_xyz, dtype=np.float64))
+
+def scale_to_um(snakes, pixel_spacing_um_xyz):
+    """ Converts point positions from pixels to micrometers """
+    return snakes.with_positions(snakes.positions.astype(np.float64) * np.asarray(pixel_spacing_um_xyz, dtype=np.float64))
+
+def snake_bboxes(snakes):
+    """ Returns (lower, upper), the S x 3 arrays of the smallest and largest x, y, z of each
+    snake. Snakes with no points have a lower of inf and upper of -inf, so they are in no box """
+    lower = np.full((len(snakes), 3), np.inf, dtype=np.float32)
+    upper = np.full((len(snakes), 3), -np.inf, dtype=np.float32)
+    nonempty = snakes.snake_lengths() > 0
+    if nonempty.any():
+        starts = snakes.offsets[:-1][nonempty]
+        lower[nonempty] = np.minimum.reduceat(snakes.positions, starts, axis=0)
+        upper[nonempty] = np.maximum.reduceat(snakes.positions, starts, axis=0)
+    return lower, upper
+
+def snakes_in_box_mask(snakes, lower_xyz, upper_xyz, contained=False):
+    """ Boolean array of which snakes have a point inside the box, or with contained, have
+    every point inside the box. Box edges count as inside """
+    lower_xyz = np.asarray(lower_xyz, dtype=np.float64)
+    upper_xyz = np.asarray(upper_xyz, dtype=np.float64)
+    point_inside = np.all((snakes.positions >= lower_xyz) & (snakes.positions <= upper_xyz), axis=1)
+
+    inside_counts = np.bincount(snakes.snake_idx_of_points()[point_inside], minlength=len(snakes))
+    if contained:
+        return (inside_counts == snakes.snake_lengths()) & (snakes.snake_lengths() > 0)
+    return inside_counts > 0
+
+def filter_snakes_in_box(snakes, lower_xyz, upper_xyz, contained=False):
+    """ New SnakeSet of the whole snakes that pass through the box, or with contained, that
+    lie entirely inside it """
+    return snakes.select(np.flatnonzero(snakes_in_box_mask(snakes, lower_xyz, upper_xyz, contained)))
@@ -0,0 +1,247 @@
+import os
+import json
+import math
+import time
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from PIL import Image
+
+def iter_tiff_pages(tiff_fp):
+    """ Yields the pages of a TIFF as 2D arrays one at a time, so the whole stack is never in memory """
+    with Image.open(tiff_fp) as pil_img:
+        frames = getattr(pil_img, "n_frames", 1)
+        for frame_idx in range(frames):
+            pil_img.seek(frame_idx)
+            yield np.array(pil_img)
+
+def file_fingerprint(fp, sample_bytes=2**20):
+    """ Identifies a file by its size, modification time and a hash of its first and last
+    sample_bytes, without reading the whole file """
+    stat = os.stat(fp)
+    hasher = hashlib.sha256()
+    with open(fp, "rb") as f:
+        hasher.update(f.read(sample_bytes))
+        if stat.st_size > sample_bytes:
+            f.seek(max(sample_bytes, stat.st_size - sample_bytes))
+            hasher.update(f.read(sample_bytes))
+    return "{}-{}-{}".format(stat.st_size, stat.st_mtime_ns, hasher.hexdigest()[:16])
+
+class StreamingHistogram:
+    """ Voxel count, min and max of an image, built one page at a time. 8 and 16 bit images are
+    also counted into a fixed array with a bin for every possible value, so their percentiles
+    are exact without reading the image again. Other types only keep the min and max, their
+    percentiles are found by refine_percentile.
+    """
+    def __init__(self):
+        self.bin_counts = None
+        self.bin_offset = 0
+        self.min = None
+        self.max = None
+        self.voxels = 0
+
+    def add(self, page):
+        page = np.asarray(page)
+        self.voxels += page.size
+        if page.size == 0:
+            return
+
+        if page.dtype == np.bool_:
+            page = page.astype(np.uint8)
+
+        page_min = page.min().item()
+        page_max = page.max().item()
+        self.min = page_min if self.min is None else min(self.min, page_min)
+        self.max = page_max if self.max is None else max(self.max, page_max)
+
+        if page.dtype.kind in "ui" and page.dtype.itemsize <= 2:
+            if self.bin_counts is None:
+                type_info = np.iinfo(page.dtype)
+                self.bin_offset = int(type_info.min)
+                self.bin_counts = np.zeros(int(type_info.max) - int(type_info.min) + 1, dtype=np.int64)
+            flat = page.ravel()
+            if self.bin_offset != 0:
+                flat = flat.astype(np.int32) - self.bin_offset
+            self.bin_counts += np.bincount(flat, minlength=len(self.bin_counts))
+
+    def percentile(self, percentile):
+        """ Exact percentile from the bins, or None if the image's type isn't binned """
+        if self.bin_counts is None:
+            return None
+        nonzero_bins = np.nonzero(self.bin_counts)[0]
+        return histogram_percentile(nonzero_bins + self.bin_offset, self.bin_counts[nonzero_bins], percentile)
+
+def histogram_percentile(values, counts, percentile):
+    """ Smallest value that at least percentile % of the voxels are less than or equal to.
+    This is exact, and the same as numpy's percentile with method='inverted_cdf' """
+    cumulative_counts = np.cumsum(counts)
+    total = int(cumulative_counts[-1])
+    rank = min(max(int(math.ceil(percentile / 100 * total)), 1), total)
+    return np.asarray(values)[np.searchsorted(cumulative_counts, rank)].item()
+
+def refine_percentile(tiff_fp, percentile, voxels, min_val, max_val, bins=4096, exact_limit=2**20):
+    """ Exact percentile of a TIFF of any type, with the same meaning as histogram_percentile.
+
+    Each pass over the image counts the voxels below the range that holds the percentile and
+    puts the ones inside it into bins, and the range is narrowed to the bin the percentile
+    falls in. Once few enough voxels are left in the range, their distinct values are counted
+    exactly. Memory stays at bins counts plus exact_limit values however big the image is.
+    Voxels are compared as float64, which holds float32 and 32 bit integers exactly.
+    """
+    rank = min(max(int(math.ceil(percentile / 100 * voxels)), 1), voxels)
+    lower = min_val
+    upper = max_val
+    candidate_count = voxels
+
+    while lower < upper:
+        edges = np.linspace(lower, upper, bins + 1)
+        if candidate_count <= exact_limit or not np.all(np.diff(edges) > 0):
+            break
+
+        below_count = 0
+        bin_counts = np.zeros(bins, dtype=np.int64)
+        for page in iter_tiff_pages(tiff_fp):
+            flat = page.ravel().astype(np.float64)
+            below_count += int(np.count_nonzero(flat < lower))
+            bin_counts += np.histogram(flat[(flat >= lower) & (flat <= upper)], bins=edges)[0]
+
+        bin_idx = int(np.searchsorted(np.cumsum(bin_counts), rank - below_count))
+        lower = edges[bin_idx].item()
+        upper = edges[bin_idx + 1].item()
+        candidate_count = int(bin_counts[bin_idx])
+
+    if not lower < upper:
+        return lower
+
+    # Few voxels, or so few distinct values that the range can't be split, are left
+    below_count = 0
+    page_values = []
+    page_counts = []
+    for page in iter_tiff_pages(tiff_fp):
+        page_dtype = page.dtype
+        flat = page.ravel().astype(np.float64)
+        below_count += int(np.count_nonzero(flat < lower))
+        values, counts = np.unique(flat[(flat >= lower) & (flat <= upper)], return_counts=True)
+        page_values.append(values)
+        page_counts.append(counts)
+
+    values, value_idxs = np.unique(np.concatenate(page_values), return_inverse=True)
+    counts = np.bincount(value_idxs, weights=np.concatenate(page_counts)).astype(np.int64)
+    value = values[np.searchsorted(np.cumsum(counts), rank - below_count)]
+    return np.asarray(value).astype(page_dtype).item()
+
+def percentile_key(percentile):
+    # Percentiles are JSON object keys in the stats and the cache
+    return repr(float(percentile))
+
+def compute_image_intensity_stats(tiff_fp, percentiles=()):
+    """ Reads a TIFF page by page, and returns its voxel count, min, max and the requested
+    percentiles. Only the min and max need one pass for images that aren't 8 or 16 bit,
+    their percentiles take a few more """
+    histogram = StreamingHistogram()
+    for page in iter_tiff_pages(tiff_fp):
+        histogram.add(page)
+
+    if histogram.voxels == 0:
+        raise Exception("TIFF {} has no pixels".format(tiff_fp))
+
+    percentile_values = {}
+    for percentile in percentiles:
+        value = histogram.percentile(percentile)
+        if value is None:
+            value = refine_percentile(tiff_fp, percentile, histogram.voxels, histogram.min, histogram.max)
+        percentile_values[percentile_key(percentile)] = value
+
+    return {
+        "voxels": histogram.voxels,
+        "min": histogram.min,
+        "max": histogram.max,
+        "percentiles": percentile_values,
+    }
+
+def intensity_stats_percentile(stats, percentile):
+    return stats["percentiles"][percentile_key(percentile)]
+
+def default_intensity_stats_cache_path():
+    """ Entries are keyed by file fingerprint rather than path, so one cache in the user's
+    cache folder serves every image folder without writing into them """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "soax_helper", "intensity_stats_cache.json")
+
+class IntensityStatsCache:
+    """ JSON file of image intensity stats keyed by file fingerprint, so images that haven't
+    changed aren't read again the next time parameters are made for them. Only the voxel
+    count, min, max and percentiles that were asked for are kept, so entries stay small """
+    def __init__(self, cache_fp):
+        self.cache_fp = cache_fp
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.isfile(cache_fp):
+            try:
+                with open(cache_fp, "r") as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                # A broken cache only costs a re-read of the images
+                self.entries = {}
+
+    def get(self, fingerprint, percentiles=()):
+        """ Cached stats, or None if they aren't cached or are missing one of the percentiles """
+        with self.lock:
+            stats = self.entries.get(fingerprint)
+        if stats is None or "percentiles" not in stats:
+            return None
+        if any(percentile_key(percentile) not in stats["percentiles"] for percentile in percentiles):
+            return None
+        return stats
+
+    def put(self, fingerprint, stats):
+        with self.lock:
+            # Keep percentiles cached for other sweeps
+            old_stats = self.entries.get(fingerprint)
+            if old_stats is not None and "percentiles" in old_stats:
+                stats = dict(stats, percentiles=dict(old_stats["percentiles"], **stats["percentiles"]))
+            self.entries[fingerprint] = stats
+
+    def save(self):
+        with self.lock:
+            cache_dir = os.path.dirname(self.cache_fp)
+            if cache_dir != "":
+                os.makedirs(cache_dir, exist_ok=True)
+            tmp_fp = self.cache_fp + ".tmp"
+            with open(tmp_fp, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_fp, self.cache_fp)
+
+def find_image_intensity_stats(tiff_fps, workers, logger, cache_fp=None, percentiles=()):
+    """ Returns {tiff path: intensity stats} for every TIFF, reading the images in parallel
+    with workers threads. Images already in the cache at cache_fp with all of the
+    percentiles aren't read.
+    """
+    cache = None if cache_fp is None else IntensityStatsCache(cache_fp)
+
+    def image_stats(tiff_fp):
+        fingerprint = file_fingerprint(tiff_fp)
+        if cache is not None:
+            stats = cache.get(fingerprint, percentiles)
+            if stats is not None:
+                logger.log("Using cached intensity stats for {}".format(tiff_fp))
+                return tiff_fp, stats
+
+        start = time.time()
+        stats = compute_image_intensity_stats(tiff_fp, percentiles)
+        logger.log("Read intensity stats of {} in {:.1f}s".format(tiff_fp, time.time() - start))
+        if cache is not None:
+            cache.put(fingerprint, stats)
+        return tiff_fp, stats
+
+    with ThreadPool(workers) as pool:
+        stats_by_fp = dict(pool.map(image_stats, tiff_fps))
+
+    if cache is not None:
+        try:
+            cache.save()
+        except OSError as e:
+            logger.warn("Could not save intensity stats cache {}: {}".format(cache_fp, repr(e)))
+
+    return stats_by_fp
@@ -1,3 +1,8 @@
+import os
+import json
+import decimal
+import hashlib
+
 param_filename_tags = {
     "intensity_scaling": "intscaling",
     "gaussian_std": "gstd",
@@ -107,4 +112,120 @@ damp-z	{damp_z}
         damp_z=("true" if damp_z else "false"),
         maximum_foreground=maximum_foreground,
         )
-    return params
\ No newline at end of file
+    return params
+
+def normalize_params_text(params_text):
+    """ Returns params text with formatting that doesn't change how SOAX reads it removed:
+    blank lines, whitespace, the order of the lines, and the formatting of numbers
+    (ex. '0.010' and '0.01', or '2' and '2.0').
+    """
+    normalized_lines = []
+    for line in params_text.splitlines():
+        split_line = line.split()
+        if len(split_line) == 0:
+            continue
+        param_key = split_line[0]
+        param_vals = []
+        for val in split_line[1:]:
+            try:
+                param_vals.append(str(decimal.Decimal(val).normalize()))
+            except decimal.InvalidOperation:
+                param_vals.append(val.lower())
+        normalized_lines.append(param_key + "\t" + " ".join(param_vals))
+
+    normalized_lines.sort()
+
+    return "\n".join(normalized_lines) + "\n"
+
+def params_text_hash(params_text):
+    return hashlib.sha256(normalize_params_text(params_text).encode()).hexdigest()
+
+def params_file_hash(params_fp):
+    with open(params_fp, "r") as f:
+        return params_text_hash(f.read())
+
+# Written next to generated parameter files, one JSON line per parameter set with its ID
+# (the parameter file name without .txt), the value of every parameter and the parameter
+# file text. Tools can look parameter sets up in it instead of listing and parsing filenames,
+# and run_soax can run the parameter sets in it without any parameter files.
+param_manifest_filename = "params_manifest.jsonl"
+
+def param_manifest_record(params_filename, param_values, params_text):
+    return {
+        "id": os.path.splitext(params_filename)[0],
+        "file": params_filename,
+        "values": {key: str(val) if isinstance(val, decimal.Decimal) else val for key, val in param_values.items()},
+        "params_hash": params_text_hash(params_text),
+        "params_text": params_text,
+    }
+
+def param_manifest_path(params_dir):
+    return os.path.join(params_dir, param_manifest_filename)
+
+class ParamSetStore:
+    """ Reads a parameter manifest. Only the position of each record in the file is kept in
+    memory, records are read from the file when they're looked up by ID.
+    """
+    def __init__(self, manifest_fp):
+        self.manifest_fp = manifest_fp
+        self.ids = []
+        self.record_offsets = {}
+        self.param_hashes = {}
+        self.varied_param_names = []
+
+        first_values = None
+        varied_param_names = set()
+        with open(manifest_fp, "rb") as f:
+            offset = 0
+            for line in f:
+                line_length = len(line)
+                if line.strip() != b"":
+                    record = json.loads(line)
+                    param_id = record["id"]
+                    if param_id in self.record_offsets:
+                        raise Exception("Parameter set ID {} is in {} more than once".format(param_id, manifest_fp))
+                    self.ids.append(param_id)
+                    self.record_offsets[param_id] = (offset, line_length)
+                    self.param_hashes[param_id] = record["params_hash"]
+
+                    if first_values is None:
+                        first_values = record["values"]
+                    for param_name, val in record["values"].items():
+                        if first_values.get(param_name) != val:
+                            varied_param_names.add(param_name)
+                offset += line_length
+
+        # Varied parameters in the same order as in parameter file names
+        self.varied_param_names = [param_name for param_name in param_filename_tags if param_name in varied_param_names]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, param_id):
+        return param_id in self.record_offsets
+
+    def get(self, param_id):
+        offset, length = self.record_offsets[param_id]
+        with open(self.manifest_fp, "rb") as f:
+            f.seek(offset)
+            return json.loads(f.read(length))
+
+    def values(self, param_id):
+        return self.get(param_id)["values"]
+
+    def params_text(self, param_id):
+        return self.get(param_id)["params_text"]
+
+    def params_hash(self, param_id):
+        return self.param_hashes[param_id]
+
+    def write_params_file(self, param_id, params_fp):
+        with open(params_fp, "w") as f:
+            f.write(self.params_text(param_id))
+
+def open_param_store(params_dir):
+    """ Returns ParamSetStore for the manifest in params_dir, or None if there is no manifest """
+    manifest_fp = param_manifest_path(params_dir)
+    if not os.path.isfile(manifest_fp):
+        return None
+    return ParamSetStore(manifest_fp)
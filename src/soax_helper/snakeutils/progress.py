@@ -0,0 +1,159 @@
+import os
+import json
+import time
+import threading
+from collections import deque
+import tqdm
+
+def format_duration(seconds):
+    if seconds is None:
+        return "unknown"
+    seconds = int(seconds)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours > 0:
+        return "{}h{:02d}m".format(hours, minutes)
+    return "{}m{:02d}s".format(minutes, seconds)
+
+class ProgressTracker:
+    """ Shows live progress of a step made of many jobs: a progress bar when running in
+    a terminal, periodic log lines, and optionally a JSON progress file that is rewritten
+    every update_interval_s seconds so headless runs can be monitored.
+
+    The jobs per minute rate and the ETA are calculated from the last rate_window
+    finished jobs, so they follow changes in speed during long runs.
+    """
+    def __init__(
+        self,
+        step_name,
+        total,
+        logger,
+        progress_fp=None,
+        group_totals=None,
+        update_interval_s=60,
+        rate_window=100,
+    ):
+        self.step_name = step_name
+        self.total = total
+        self.logger = logger
+        self.progress_fp = progress_fp
+        self.update_interval_s = update_interval_s
+
+        self.done = 0
+        self.failed = 0
+        self.groups = {}
+        if group_totals is not None:
+            for group_name, group_total in group_totals.items():
+                self.groups[group_name] = {"done": 0, "failed": 0, "total": group_total}
+
+        self.start_time = time.time()
+        self.last_update_time = self.start_time
+        self.finish_times = deque(maxlen=rate_window)
+        self.lock = threading.Lock()
+
+        # disable=None turns off the bar when not running in a terminal
+        self.bar = tqdm.tqdm(
+            total=total,
+            desc=step_name,
+            unit="job",
+            disable=None,
+            bar_format="{desc}: {n_fmt}/{total_fmt} |{bar}| {postfix}",
+        )
+
+        self.write_progress_file()
+
+    def jobs_per_minute(self):
+        if len(self.finish_times) >= 2 and self.finish_times[-1] > self.finish_times[0]:
+            return 60 * (len(self.finish_times) - 1) / (self.finish_times[-1] - self.finish_times[0])
+        elapsed = time.time() - self.start_time
+        if self.done > 0 and elapsed > 0:
+            return 60 * self.done / elapsed
+        return None
+
+    def eta_seconds(self):
+        rate = self.jobs_per_minute()
+        if rate is None or rate == 0:
+            return None
+        return 60 * (self.total - self.done) / rate
+
+    def job_done(self, group_name=None, failed=False):
+        with self.lock:
+            now = time.time()
+            self.done += 1
+            self.finish_times.append(now)
+            if failed:
+                self.failed += 1
+
+            if group_name is not None:
+                if group_name not in self.groups:
+                    self.groups[group_name] = {"done": 0, "failed": 0, "total": None}
+                self.groups[group_name]["done"] += 1
+                if failed:
+                    self.groups[group_name]["failed"] += 1
+
+            rate = self.jobs_per_minute()
+            self.bar.set_postfix_str("{} jobs/min, ETA {}, {} failed".format(
+                "-" if rate is None else "{:.1f}".format(rate),
+                format_duration(self.eta_seconds()),
+                self.failed,
+            ), refresh=False)
+            self.bar.update(1)
+
+            if now - self.last_update_time >= self.update_interval_s:
+                self.last_update_time = now
+                self.log_progress()
+                self.write_progress_file()
+
+    def progress_info(self):
+        return {
+            "step": self.step_name,
+            "done": self.done,
+            "total": self.total,
+            "failed": self.failed,
+            "jobs_per_minute": self.jobs_per_minute(),
+            "eta_seconds": self.eta_seconds(),
+            "elapsed_seconds": time.time() - self.start_time,
+            "updated_at": time.time(),
+            "groups": self.groups,
+        }
+
+    def log_progress(self):
+        rate = self.jobs_per_minute()
+        self.logger.log("{} progress: {}/{} jobs done ({} failed), {} jobs/min, ETA {}".format(
+            self.step_name,
+            self.done,
+            self.total,
+            self.failed,
+            "-" if rate is None else "{:.1f}".format(rate),
+            format_duration(self.eta_seconds()),
+        ))
+
+    def write_progress_file(self):
+        if self.progress_fp is None:
+            return
+
+        # Write to temporary file and rename, so the progress file is never half written
+        tmp_fp = self.progress_fp + ".tmp"
+        with open(tmp_fp, "w") as f:
+            json.dump(self.progress_info(), f, indent=4)
+        os.replace(tmp_fp, self.progress_fp)
+
+    def close(self):
+        with self.lock:
+            self.bar.close()
+            self.log_progress()
+            self.write_progress_file()
+
+            incomplete_groups = [
+                (group_name, group) for group_name, group in sorted(self.groups.items())
+                if group["failed"] > 0 or (group["total"] is not None and group["done"] < group["total"])
+            ]
+            if len(incomplete_groups) > 0:
+                self.logger.warn("{} groups with failed or unfinished jobs:".format(self.step_name))
+                for group_name, group in incomplete_groups:
+                    self.logger.warn("    {}: {}/{} done, {} failed".format(
+                        group_name,
+                        group["done"],
+                        "?" if group["total"] is None else group["total"],
+                        group["failed"],
+                    ))
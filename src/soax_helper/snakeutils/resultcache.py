@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+
+from .params import params_file_hash
+
+def file_content_hash(fp, chunk_size=2**20):
+    hasher = hashlib.sha256()
+    with open(fp, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if len(chunk) == 0:
+                break
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+class SnakeResultCache:
+    """ Directory of batch_soax snake files from earlier runs, so runs that share images and
+    parameters with an earlier run (from any config) don't have to run batch_soax again.
+
+    Results are stored by a key made from the hash of the image bytes, the hash of the
+    normalized parameter text and the hash of the batch_soax executable, so a rebuilt
+    batch_soax doesn't reuse results from the old one.
+
+    Each entry is a snake file and a small JSON file describing where it came from. Entries
+    are touched when they are used, so prune can delete the least recently used entries
+    first when the cache gets too big.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.entries_dir = os.path.join(cache_dir, "entries")
+        os.makedirs(self.entries_dir, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        # Images are hashed once per (path, size, modification time), since most images
+        # are run with many parameter files
+        self.file_hashes = {}
+
+    def cached_file_hash(self, fp):
+        stat = os.stat(fp)
+        hash_key = (os.path.abspath(fp), stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            if hash_key in self.file_hashes:
+                return self.file_hashes[hash_key]
+        file_hash = file_content_hash(fp)
+        with self.lock:
+            self.file_hashes[hash_key] = file_hash
+        return file_hash
+
+    def result_key(self, batch_soax_path, tiff_fp, params_fp):
+        key_parts = [
+            self.cached_file_hash(batch_soax_path),
+            self.cached_file_hash(tiff_fp),
+            params_file_hash(params_fp),
+        ]
+        return hashlib.sha256("\n".join(key_parts).encode()).hexdigest()
+
+    def entry_paths(self, key):
+        entry_dir = os.path.join(self.entries_dir, key[:2])
+        return os.path.join(entry_dir, key + ".txt"), os.path.join(entry_dir, key + ".json")
+
+    def get(self, key, target_fp):
+        """ Copies cached snake file for key to target_fp. Returns True if the key was in the cache """
+        entry_snakes_fp, entry_info_fp = self.entry_paths(key)
+        try:
+            shutil.copyfile(entry_snakes_fp, target_fp)
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return False
+
+        # Modification time of the entry is used as its last use time for eviction
+        try:
+            os.utime(entry_snakes_fp)
+        except OSError:
+            pass
+
+        with self.lock:
+            self.hits += 1
+        return True
+
+    def put(self, key, snakes_fp, info):
+        entry_snakes_fp, entry_info_fp = self.entry_paths(key)
+        os.makedirs(os.path.dirname(entry_snakes_fp), exist_ok=True)
+
+        # Copy to temporary files and rename, so other runs never see a half written entry
+        tmp_suffix = ".tmp{}_{}".format(os.getpid(), threading.get_ident())
+        with open(entry_info_fp + tmp_suffix, "w") as f:
+            json.dump({**info, "key": key, "stored_at": time.time()}, f, indent=4)
+        os.replace(entry_info_fp + tmp_suffix, entry_info_fp)
+        shutil.copyfile(snakes_fp, entry_snakes_fp + tmp_suffix)
+        os.replace(entry_snakes_fp + tmp_suffix, entry_snakes_fp)
+
+        with self.lock:
+            self.stores += 1
+
+    def list_entries(self):
+        """ Returns list of (last use time, size in bytes, snake file path, info file path), oldest first """
+        entries = []
+        for prefix_dirname in os.listdir(self.entries_dir):
+            prefix_dirpath = os.path.join(self.entries_dir, prefix_dirname)
+            if not os.path.isdir(prefix_dirpath):
+                continue
+            for filename in os.listdir(prefix_dirpath):
+                if not filename.endswith(".txt"):
+                    continue
+                entry_snakes_fp = os.path.join(prefix_dirpath, filename)
+                entry_info_fp = os.path.splitext(entry_snakes_fp)[0] + ".json"
+                try:
+                    stat = os.stat(entry_snakes_fp)
+                except FileNotFoundError:
+                    continue
+                size = stat.st_size
+                if os.path.isfile(entry_info_fp):
+                    size += os.path.getsize(entry_info_fp)
+                entries.append((stat.st_mtime, size, entry_snakes_fp, entry_info_fp))
+        entries.sort()
+        return entries
+
+    def prune(self, max_size_bytes):
+        """ Deletes least recently used entries until the cache is at most max_size_bytes.
+        Returns (entries removed, bytes removed)
+        """
+        with self.lock:
+            entries = self.list_entries()
+            total_size = sum(size for last_used, size, entry_snakes_fp, entry_info_fp in entries)
+
+            removed_count = 0
+            removed_bytes = 0
+            for last_used, size, entry_snakes_fp, entry_info_fp in entries:
+                if total_size <= max_size_bytes:
+                    break
+                for fp in [entry_snakes_fp, entry_info_fp]:
+                    try:
+                        os.remove(fp)
+                    except FileNotFoundError:
+                        pass
+                total_size -= size
+                removed_count += 1
+                removed_bytes += size
+
+            return removed_count, removed_bytes
+
+    def stats(self):
+        entries = self.list_entries()
+        return {
+            "cache_dir": self.cache_dir,
+            "entries": len(entries),
+            "size_bytes": sum(size for last_used, size, entry_snakes_fp, entry_info_fp in entries),
+            "oldest_use": entries[0][0] if len(entries) > 0 else None,
+            "newest_use": entries[-1][0] if len(entries) > 0 else None,
+        }
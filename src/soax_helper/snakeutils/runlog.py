@@ -0,0 +1,92 @@
+import os
+import json
+import gzip
+import time
+import threading
+
+def output_tail(output_bytes, line_count):
+    lines = output_bytes.decode(errors="replace").splitlines()
+    if len(lines) <= line_count:
+        return "\n".join(lines), False
+    return "\n".join(lines[-line_count:]), True
+
+class RunLogWriter:
+    """ Keeps the output of every batch_soax job of a run in one compressed file, instead of
+    a folder of log files per job.
+
+    Each job's output is appended as a separate gzip member, so the whole file can still be
+    read with zcat, and an index file next to it has one JSON line per job with the offset
+    and length of its member so the output of one job can be read without decompressing
+    the rest. Jobs run together in one batch_soax process share a member, each of them has
+    its own index line pointing at it. Failed jobs keep their full output, jobs that succeeded only keep the last
+    success_tail_lines lines of stdout and stderr.
+    """
+    def __init__(self, log_fp, success_tail_lines=20):
+        self.log_fp = log_fp
+        self.index_fp = run_log_index_path(log_fp)
+        self.success_tail_lines = success_tail_lines
+        self.lock = threading.Lock()
+        # Both files are new, so the index only lists jobs of this run
+        self.log_file = open(log_fp, "xb")
+        self.index_file = open(self.index_fp, "x")
+
+    def job_id(self, logging_dir):
+        # Jobs are named after their log folder, relative to the folder of the run log
+        return os.path.relpath(logging_dir, os.path.dirname(os.path.abspath(self.log_fp)))
+
+    def write(self, job_ids, info, stdout_bytes, stderr_bytes, keep_full_output):
+        """ Saves the output of a batch_soax process that ran the jobs in job_ids """
+        if keep_full_output:
+            stdout_text = stdout_bytes.decode(errors="replace").rstrip("\n")
+            stderr_text = stderr_bytes.decode(errors="replace").rstrip("\n")
+            truncated = False
+        else:
+            stdout_text, stdout_truncated = output_tail(stdout_bytes, self.success_tail_lines)
+            stderr_text, stderr_truncated = output_tail(stderr_bytes, self.success_tail_lines)
+            truncated = stdout_truncated or stderr_truncated
+
+        text = "==== {} ====\n".format(", ".join(job_ids))
+        for key, val in info.items():
+            text += "{}: {}\n".format(key, val)
+        text += "---- stdout{} ----\n{}\n".format(" (last lines)" if truncated else "", stdout_text)
+        text += "---- stderr{} ----\n{}\n".format(" (last lines)" if truncated else "", stderr_text)
+        compressed = gzip.compress(text.encode())
+
+        with self.lock:
+            offset = self.log_file.tell()
+            self.log_file.write(compressed)
+            self.log_file.flush()
+            written_at = time.time()
+            for job_id in job_ids:
+                self.index_file.write(json.dumps({
+                    **info,
+                    "job": job_id,
+                    "group_size": len(job_ids),
+                    "offset": offset,
+                    "length": len(compressed),
+                    "truncated": truncated,
+                    "written_at": written_at,
+                }) + "\n")
+            self.index_file.flush()
+
+    def close(self):
+        with self.lock:
+            self.log_file.close()
+            self.index_file.close()
+
+def run_log_index_path(log_fp):
+    return log_fp + ".index.jsonl"
+
+def load_run_log_index(log_fp):
+    entries = []
+    with open(run_log_index_path(log_fp), "r") as f:
+        for line in f:
+            if line.strip() != "":
+                entries.append(json.loads(line))
+    return entries
+
+def read_run_log_entry(log_fp, index_entry):
+    with open(log_fp, "rb") as f:
+        f.seek(index_entry["offset"])
+        compressed = f.read(index_entry["length"])
+    return gzip.decompress(compressed).decode()
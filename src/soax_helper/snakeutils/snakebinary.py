@@ -0,0 +1,162 @@
+""" Binary snake files, with the same snakes and metadata as JSON snake files, that can be
+memory-mapped instead of parsed.
+
+Layout (all numbers little-endian):
+    8 bytes    magic b"SOAXSNK1"
+    8 bytes    uint64 length of the header
+    header     UTF-8 JSON, padded with spaces so the first array starts at a multiple of 64 bytes:
+               {
+                   "version": 1,
+                   "metadata": {"offset_pixels_xyz": ..., "dims_pixels_xyz": ..., "pixel_spacing_um_xyz": ...},
+                   "snake_count": S,
+                   "point_count": N,
+                   "arrays": {name: {"offset": byte offset in file, "dtype": numpy dtype string, "shape": [...]}, ...}
+               }
+    arrays     raw C-order arrays, each starting at a multiple of 64 bytes:
+               positions  float32 N x 3
+               fg         float32 N
+               bg         float32 N
+               offsets    int64   S + 1, the points of snake i are offsets[i]:offsets[i + 1]
+               and if the file has a junction graph (see SnakeGraph):
+               junction_positions      float32 J x 3
+               junction_snake_offsets  int64   J + 1
+               junction_snake_idxs     int64   M
+               junction_snake_ends     int8    M
+"""
+import os
+import json
+import struct
+import numpy as np
+
+from .snakeset import SnakeSet
+from .snakegraph import SnakeGraph
+
+binary_snakes_magic = b"SOAXSNK1"
+binary_snakes_version = 1
+binary_snakes_extension = ".snakes"
+binary_snakes_alignment = 64
+
+binary_snake_arrays = [
+    ("positions", "<f4"),
+    ("fg", "<f4"),
+    ("bg", "<f4"),
+    ("offsets", "<i8"),
+]
+
+binary_graph_arrays = [
+    ("junction_positions", "<f4"),
+    ("junction_snake_offsets", "<i8"),
+    ("junction_snake_idxs", "<i8"),
+    ("junction_snake_ends", "<i1"),
+]
+
+def aligned(offset):
+    return (offset + binary_snakes_alignment - 1) // binary_snakes_alignment * binary_snakes_alignment
+
+def binary_snakes_header(snakes, metadata, graph=None):
+    arrays = {
+        "positions": snakes.positions,
+        "fg": snakes.fg,
+        "bg": snakes.bg,
+        "offsets": snakes.offsets,
+    }
+    array_types = list(binary_snake_arrays)
+    if graph is not None:
+        for name, dtype in binary_graph_arrays:
+            arrays[name] = getattr(graph, name)
+        array_types += binary_graph_arrays
+    array_infos = {
+        name: {"offset": 0, "dtype": dtype, "shape": list(arrays[name].shape)}
+        for name, dtype in array_types
+    }
+    header = {
+        "version": binary_snakes_version,
+        "metadata": metadata,
+        "snake_count": len(snakes),
+        "point_count": snakes.point_count,
+        "arrays": array_infos,
+    }
+
+    # Array offsets depend on the header length, and the header length on the offsets, so
+    # the offsets are given room for the largest value they could have
+    placeholder_header = json.dumps(header)
+    header_room = len(placeholder_header.encode("utf-8")) + 20 * len(array_types)
+    array_offset = aligned(len(binary_snakes_magic) + 8 + header_room)
+    for name, dtype in array_types:
+        array_infos[name]["offset"] = array_offset
+        array_offset = aligned(array_offset + arrays[name].nbytes)
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    first_array_offset = array_infos[binary_snake_arrays[0][0]]["offset"]
+    header_bytes += b" " * (first_array_offset - len(binary_snakes_magic) - 8 - len(header_bytes))
+
+    return header_bytes, arrays, array_infos
+
+def save_binary_snakes(fp, snakes, offset_pixels_xyz, dims_pixels_xyz, pixel_spacing_um_xyz, graph=None):
+    """ Same arguments as save_json_snakes """
+    if not fp.lower().endswith(binary_snakes_extension):
+        raise Exception("Binary snake filename '{}' should end in '{}'".format(fp, binary_snakes_extension))
+
+    metadata = {
+        "offset_pixels_xyz": offset_pixels_xyz,
+        "dims_pixels_xyz": dims_pixels_xyz,
+        "pixel_spacing_um_xyz": pixel_spacing_um_xyz,
+    }
+    header_bytes, arrays, array_infos = binary_snakes_header(snakes, metadata, graph)
+
+    # Write to temporary file and rename, so readers never map a half written file
+    tmp_fp = fp + ".tmp"
+    with open(tmp_fp, "wb") as f:
+        f.write(binary_snakes_magic)
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for name, array_info in array_infos.items():
+            f.write(b"\0" * (array_info["offset"] - f.tell()))
+            f.write(np.ascontiguousarray(arrays[name], dtype=array_info["dtype"]).tobytes())
+    os.replace(tmp_fp, fp)
+
+def read_binary_snakes_header(fp):
+    with open(fp, "rb") as f:
+        magic = f.read(len(binary_snakes_magic))
+        if magic != binary_snakes_magic:
+            raise Exception("{} is not a binary snake file".format(fp))
+        header_length, = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_length).decode("utf-8"))
+
+    if header["version"] > binary_snakes_version:
+        raise Exception("Binary snake file {} is version {}, newer than this reader (version {})".format(fp, header["version"], binary_snakes_version))
+
+    return header
+
+def load_binary_snakes(fp, mmap=True, with_graph=False):
+    """ Returns (SnakeSet, metadata) from a binary snake file. With mmap the arrays are
+    memory-mapped read only, so only the parts that are used are read from disk. With
+    with_graph, returns (SnakeSet, metadata, SnakeGraph), the graph is None if the file has
+    no junctions """
+    if not fp.lower().endswith(binary_snakes_extension):
+        raise Exception("Binary snake filename '{}' should end in '{}'".format(fp, binary_snakes_extension))
+
+    header = read_binary_snakes_header(fp)
+    array_types = list(binary_snake_arrays)
+    has_graph = all(name in header["arrays"] for name, dtype in binary_graph_arrays)
+    if with_graph and has_graph:
+        array_types += binary_graph_arrays
+    arrays = {}
+    with open(fp, "rb") as f:
+        for name, dtype in array_types:
+            array_info = header["arrays"][name]
+            shape = tuple(array_info["shape"])
+            count = int(np.prod(shape))
+            if mmap and count > 0:
+                arrays[name] = np.memmap(fp, dtype=array_info["dtype"], mode="r", offset=array_info["offset"], shape=shape)
+            else:
+                f.seek(array_info["offset"])
+                arrays[name] = np.fromfile(f, dtype=array_info["dtype"], count=count).reshape(shape)
+
+    snakes = SnakeSet(arrays["positions"], arrays["fg"], arrays["bg"], arrays["offsets"])
+    if with_graph:
+        graph = None
+        if has_graph:
+            graph = SnakeGraph(*[arrays[name] for name, dtype in binary_graph_arrays])
+        return snakes, header["metadata"], graph
+    return snakes, header["metadata"]
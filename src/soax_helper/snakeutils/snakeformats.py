@@ -0,0 +1,42 @@
+import os
+
+from .snakejson import load_json_snakes, save_json_snakes
+from .snakebinary import load_binary_snakes, save_binary_snakes, binary_snakes_extension
+from .snakeindex import SnakeIndex, snake_index_path
+
+# Output format name -> file extension of snake files in that format
+snake_output_formats = {
+    "json": ".json",
+    "binary": binary_snakes_extension,
+}
+
+def snake_format_of_file(fp):
+    ext = os.path.splitext(fp)[1].lower()
+    for format_name, format_ext in snake_output_formats.items():
+        if ext == format_ext:
+            return format_name
+    raise Exception("Snake file '{}' is not one of the snake formats {}".format(fp, ", ".join(snake_output_formats.values())))
+
+def snake_filename_with_format(filename, output_format):
+    if output_format not in snake_output_formats:
+        raise Exception("Unknown snake output format '{}', expected one of {}".format(output_format, list(snake_output_formats.keys())))
+    return os.path.splitext(filename)[0] + snake_output_formats[output_format]
+
+def load_snakes(fp, with_graph=False):
+    """ Returns (SnakeSet, metadata) from a JSON or binary snake file, or with with_graph
+    (SnakeSet, metadata, SnakeGraph or None) """
+    if snake_format_of_file(fp) == "binary":
+        return load_binary_snakes(fp, with_graph=with_graph)
+    return load_json_snakes(fp, with_graph=with_graph)
+
+def save_snakes(fp, snakes, offset_pixels_xyz, dims_pixels_xyz, pixel_spacing_um_xyz, graph=None, write_index=True):
+    """ Saves snakes as JSON or binary depending on the extension of fp, arguments are the same as save_json_snakes.
+    With write_index, a SnakeIndex is saved next to the file, see snakeindex """
+    if snake_format_of_file(fp) == "binary":
+        save_binary_snakes(fp, snakes, offset_pixels_xyz, dims_pixels_xyz, pixel_spacing_um_xyz, graph)
+        if write_index:
+            SnakeIndex.from_snakes(snakes).save(fp)
+    else:
+        byte_starts, byte_ends = save_json_snakes(fp, snakes, offset_pixels_xyz, dims_pixels_xyz, pixel_spacing_um_xyz, graph)
+        if write_index:
+            SnakeIndex.from_snakes(snakes, byte_starts, byte_ends).save(fp)
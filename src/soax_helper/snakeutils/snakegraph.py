@@ -0,0 +1,185 @@
+import itertools
+import numpy as np
+
+from .snakeset import float32_to_short_float64
+
+def csr_from_pairs(row_idxs, col_idxs, row_count):
+    """ Returns (offsets, cols) with the cols of row i in cols[offsets[i]:offsets[i + 1]],
+    sorted in each row """
+    order = np.lexsort((col_idxs, row_idxs))
+    counts = np.bincount(row_idxs, minlength=row_count)
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    return offsets, np.asarray(col_idxs, dtype=np.int64)[order]
+
+def match_points_within(query_positions, target_positions, tolerance):
+    """ Returns (query idxs, target idxs) of every pair of points no further apart than
+    tolerance. Points are hashed into a grid of tolerance sized cells, so only points in
+    neighbouring cells are compared """
+    query_positions = np.asarray(query_positions, dtype=np.float64).reshape(-1, 3)
+    target_positions = np.asarray(target_positions, dtype=np.float64).reshape(-1, 3)
+    if len(query_positions) == 0 or len(target_positions) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    query_cells = np.floor(query_positions / tolerance).astype(np.int64)
+    target_cells = np.floor(target_positions / tolerance).astype(np.int64)
+    cell_min = np.minimum(query_cells.min(axis=0), target_cells.min(axis=0)) - 1
+    cell_span = np.maximum(query_cells.max(axis=0), target_cells.max(axis=0)) - cell_min + 2
+
+    def cell_keys(cells):
+        cells = cells - cell_min
+        return (cells[:, 0] * cell_span[1] + cells[:, 1]) * cell_span[2] + cells[:, 2]
+
+    target_order = np.argsort(cell_keys(target_cells), kind="stable")
+    sorted_target_keys = cell_keys(target_cells)[target_order]
+
+    query_matches = []
+    target_matches = []
+    for neighbour_offset in itertools.product([-1, 0, 1], repeat=3):
+        neighbour_keys = cell_keys(query_cells + neighbour_offset)
+        lows = np.searchsorted(sorted_target_keys, neighbour_keys, side="left")
+        highs = np.searchsorted(sorted_target_keys, neighbour_keys, side="right")
+        counts = highs - lows
+        query_idxs = np.repeat(np.arange(len(query_positions)), counts)
+        # Position of each candidate within its query's run of candidates
+        run_positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        target_idxs = target_order[np.repeat(lows, counts) + run_positions]
+        distances = np.linalg.norm(query_positions[query_idxs] - target_positions[target_idxs], axis=1)
+        close = distances <= tolerance
+        query_matches.append(query_idxs[close])
+        target_matches.append(target_idxs[close])
+
+    return np.concatenate(query_matches), np.concatenate(target_matches)
+
+class SnakeGraph:
+    """ Network of the junctions between snakes, stored as arrays.
+
+    junction_positions    - J x 3 array of x, y, z of every junction
+    junction_snake_offsets,
+    junction_snake_idxs   - CSR lists of the snakes at each junction, the snakes at junction j
+                            are junction_snake_idxs[junction_snake_offsets[j]:junction_snake_offsets[j + 1]]
+    junction_snake_ends   - for each entry of junction_snake_idxs, 0 if the snake starts at the
+                            junction and 1 if it ends there
+
+    SOAX snake files list junction positions but not which snakes meet there. from_junctions
+    finds them from the snake ends that are at a junction. Snake to junction and snake to
+    snake adjacency are built from the junction lists when they are first used.
+    """
+    def __init__(self, junction_positions, junction_snake_offsets, junction_snake_idxs, junction_snake_ends):
+        self.junction_positions = np.ascontiguousarray(junction_positions, dtype=np.float32).reshape(-1, 3)
+        self.junction_snake_offsets = np.ascontiguousarray(junction_snake_offsets, dtype=np.int64).reshape(-1)
+        self.junction_snake_idxs = np.ascontiguousarray(junction_snake_idxs, dtype=np.int64).reshape(-1)
+        self.junction_snake_ends = np.ascontiguousarray(junction_snake_ends, dtype=np.int8).reshape(-1)
+
+        if len(self.junction_snake_offsets) != len(self.junction_positions) + 1:
+            raise Exception("SnakeGraph has {} junctions but {} junction snake offsets".format(len(self.junction_positions), len(self.junction_snake_offsets)))
+        if self.junction_snake_offsets[-1] != len(self.junction_snake_idxs) or len(self.junction_snake_ends) != len(self.junction_snake_idxs):
+            raise Exception("SnakeGraph junction snake offsets, snake indices and snake ends don't match")
+
+        self._snake_junctions = None
+        self._snake_neighbours = None
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros((0, 3)), [0], [], [])
+
+    @classmethod
+    def from_junctions(cls, snakes, junction_positions, tolerance_pixels=1.0):
+        """ Graph of junction_positions with each junction joined to the snakes that have their
+        first or last point within tolerance_pixels of it """
+        junction_positions = np.asarray(junction_positions, dtype=np.float64).reshape(-1, 3)
+        nonempty_snake_idxs = np.flatnonzero(snakes.snake_lengths() > 0)
+        first_points = snakes.offsets[nonempty_snake_idxs]
+        last_points = snakes.offsets[nonempty_snake_idxs + 1] - 1
+        # A snake with one point has it as both ends, it is only joined once
+        multi_point = last_points != first_points
+        end_snake_idxs = np.concatenate([nonempty_snake_idxs, nonempty_snake_idxs[multi_point]])
+        end_point_idxs = np.concatenate([first_points, last_points[multi_point]])
+        end_kinds = np.concatenate([np.zeros(len(nonempty_snake_idxs), dtype=np.int8), np.ones(multi_point.sum(), dtype=np.int8)])
+
+        junction_idxs, end_idxs = match_points_within(junction_positions, snakes.positions[end_point_idxs], tolerance_pixels)
+        order = np.lexsort((end_kinds[end_idxs], end_snake_idxs[end_idxs], junction_idxs))
+        junction_idxs = junction_idxs[order]
+        end_idxs = end_idxs[order]
+        counts = np.bincount(junction_idxs, minlength=len(junction_positions))
+
+        return cls(
+            junction_positions,
+            np.concatenate([[0], np.cumsum(counts)]),
+            end_snake_idxs[end_idxs],
+            end_kinds[end_idxs],
+        )
+
+    @classmethod
+    def concatenate(cls, graphs, snake_counts):
+        """ Joins the graphs of SnakeSets that are concatenated, snake_counts are the number of
+        snakes in each SnakeSet """
+        graphs = list(graphs)
+        if len(graphs) == 0:
+            return cls.empty()
+        snake_starts = np.concatenate([[0], np.cumsum(snake_counts, dtype=np.int64)])
+        entry_starts = np.concatenate([[0], np.cumsum([len(graph.junction_snake_idxs) for graph in graphs], dtype=np.int64)])
+        return cls(
+            np.concatenate([graph.junction_positions for graph in graphs]),
+            np.concatenate([[0]] + [graph.junction_snake_offsets[1:] + entry_start for graph, entry_start in zip(graphs, entry_starts)]),
+            np.concatenate([graph.junction_snake_idxs + snake_start for graph, snake_start in zip(graphs, snake_starts)]),
+            np.concatenate([graph.junction_snake_ends for graph in graphs]),
+        )
+
+    def __len__(self):
+        return len(self.junction_positions)
+
+    def with_junction_positions(self, junction_positions):
+        """ New SnakeGraph with the same connections, but different junction positions """
+        return SnakeGraph(junction_positions, self.junction_snake_offsets, self.junction_snake_idxs, self.junction_snake_ends)
+
+    def snake_count(self):
+        """ Smallest number of snakes the graph can belong to """
+        return int(self.junction_snake_idxs.max()) + 1 if len(self.junction_snake_idxs) > 0 else 0
+
+    def snakes_at_junction(self, junction_idx):
+        return self.junction_snake_idxs[self.junction_snake_offsets[junction_idx]:self.junction_snake_offsets[junction_idx + 1]]
+
+    def snake_junction_csr(self, snake_count):
+        """ (offsets, junction idxs) of the junctions each of snake_count snakes is joined to """
+        if self._snake_junctions is None or len(self._snake_junctions[0]) != snake_count + 1:
+            entry_junction_idxs = np.repeat(np.arange(len(self), dtype=np.int64), np.diff(self.junction_snake_offsets))
+            self._snake_junctions = csr_from_pairs(self.junction_snake_idxs, entry_junction_idxs, snake_count)
+        return self._snake_junctions
+
+    def junctions_of_snake(self, snake_idx, snake_count):
+        offsets, junction_idxs = self.snake_junction_csr(snake_count)
+        return junction_idxs[offsets[snake_idx]:offsets[snake_idx + 1]]
+
+    def snake_adjacency_csr(self, snake_count):
+        """ (offsets, snake idxs) of the other snakes each snake shares a junction with """
+        if self._snake_neighbours is None or len(self._snake_neighbours[0]) != snake_count + 1:
+            degrees = np.diff(self.junction_snake_offsets)
+            entry_junction_idxs = np.repeat(np.arange(len(self), dtype=np.int64), degrees)
+            # Every pair of entries at the same junction
+            pair_counts = degrees[entry_junction_idxs]
+            first_entries = np.repeat(np.arange(len(self.junction_snake_idxs), dtype=np.int64), pair_counts)
+            run_positions = np.arange(pair_counts.sum()) - np.repeat(np.cumsum(pair_counts) - pair_counts, pair_counts)
+            second_entries = self.junction_snake_offsets[entry_junction_idxs[first_entries]] + run_positions
+
+            first_snakes = self.junction_snake_idxs[first_entries]
+            second_snakes = self.junction_snake_idxs[second_entries]
+            different = first_snakes != second_snakes
+            pair_keys = np.unique(first_snakes[different] * max(snake_count, 1) + second_snakes[different])
+            self._snake_neighbours = csr_from_pairs(pair_keys // max(snake_count, 1), pair_keys % max(snake_count, 1), snake_count)
+        return self._snake_neighbours
+
+    def neighbour_snakes(self, snake_idx, snake_count):
+        offsets, snake_idxs = self.snake_adjacency_csr(snake_count)
+        return snake_idxs[offsets[snake_idx]:offsets[snake_idx + 1]]
+
+    def to_json_dict(self):
+        return {
+            "positions": float32_to_short_float64(self.junction_positions).tolist(),
+            "snake_offsets": self.junction_snake_offsets.tolist(),
+            "snake_idxs": self.junction_snake_idxs.tolist(),
+            "snake_ends": self.junction_snake_ends.tolist(),
+        }
+
+    @classmethod
+    def from_json_dict(cls, data):
+        return cls(data["positions"], data["snake_offsets"], data["snake_idxs"], data["snake_ends"])
@@ -0,0 +1,172 @@
+""" Index files saved next to snake files, so single snakes or the snakes in a region can be
+loaded without reading the whole snake file.
+
+The index of "snakes.json" is "snakes.json.index.npz", with arrays
+    point_offsets         - S + 1, the points of snake i are point_offsets[i]:point_offsets[i + 1]
+                            of the file's SnakeSet
+    byte_starts,
+    byte_ends             - S, where each snake's list of points is in a JSON snake file.
+                            Empty for binary snake files, which are memory-mapped instead
+    bbox_lower,
+    bbox_upper            - S x 3, smallest and largest x, y, z of each snake
+    arc_lengths           - S, length of each snake in pixels
+    snake_file_size,
+    snake_file_mtime_ns   - size and modification time of the snake file when it was indexed
+An index whose snake file has changed since is rebuilt when it is opened.
+"""
+import os
+import json
+import numpy as np
+
+from .snakeset import SnakeSet
+from .geometry import snake_bboxes, snakes_in_box_mask
+from .snakejson import iter_json_snake_dicts_with_offsets
+from .snakebinary import load_binary_snakes, binary_snakes_extension
+
+snake_index_suffix = ".index.npz"
+
+def snake_index_path(snake_fp):
+    return snake_fp + snake_index_suffix
+
+def snake_arc_lengths(snakes):
+    if snakes.point_count == 0:
+        return np.zeros(len(snakes))
+    segment_lengths = np.linalg.norm(np.diff(snakes.positions.astype(np.float64), axis=0), axis=1)
+    # Leave out the segments between the last point of a snake and the first point of the next
+    snake_idx_of_points = snakes.snake_idx_of_points()
+    same_snake = np.diff(snake_idx_of_points) == 0
+    return np.bincount(snake_idx_of_points[:-1][same_snake], weights=segment_lengths[same_snake], minlength=len(snakes))
+
+class SnakeIndex:
+    def __init__(self, point_offsets, byte_starts, byte_ends, bbox_lower, bbox_upper, arc_lengths, snake_file_size=-1, snake_file_mtime_ns=-1):
+        self.point_offsets = np.asarray(point_offsets, dtype=np.int64)
+        self.byte_starts = np.asarray(byte_starts, dtype=np.int64)
+        self.byte_ends = np.asarray(byte_ends, dtype=np.int64)
+        self.bbox_lower = np.asarray(bbox_lower, dtype=np.float32).reshape(-1, 3)
+        self.bbox_upper = np.asarray(bbox_upper, dtype=np.float32).reshape(-1, 3)
+        self.arc_lengths = np.asarray(arc_lengths, dtype=np.float64)
+        self.snake_file_size = int(snake_file_size)
+        self.snake_file_mtime_ns = int(snake_file_mtime_ns)
+
+    @classmethod
+    def from_snakes(cls, snakes, byte_starts=None, byte_ends=None):
+        bbox_lower, bbox_upper = snake_bboxes(snakes)
+        return cls(
+            snakes.offsets,
+            np.zeros(0) if byte_starts is None else byte_starts,
+            np.zeros(0) if byte_ends is None else byte_ends,
+            bbox_lower,
+            bbox_upper,
+            snake_arc_lengths(snakes),
+        )
+
+    def __len__(self):
+        return len(self.point_offsets) - 1
+
+    def point_counts(self):
+        return np.diff(self.point_offsets)
+
+    def snakes_with_bbox_in_box(self, lower_xyz, upper_xyz):
+        """ Indices of the snakes whose bounding box overlaps the box """
+        overlaps = np.all((self.bbox_upper >= np.asarray(lower_xyz)) & (self.bbox_lower <= np.asarray(upper_xyz)), axis=1)
+        return np.flatnonzero(overlaps)
+
+    def matches_file(self, snake_fp):
+        stat = os.stat(snake_fp)
+        return stat.st_size == self.snake_file_size and stat.st_mtime_ns == self.snake_file_mtime_ns
+
+    def save(self, snake_fp):
+        """ Saves the index next to snake_fp, recording the snake file as it is now """
+        stat = os.stat(snake_fp)
+        self.snake_file_size = stat.st_size
+        self.snake_file_mtime_ns = stat.st_mtime_ns
+        index_fp = snake_index_path(snake_fp)
+        # np.savez adds .npz to names that don't end with it, so the temporary name does
+        tmp_fp = index_fp[:-len(".npz")] + ".tmp.npz"
+        np.savez(
+            tmp_fp,
+            point_offsets=self.point_offsets,
+            byte_starts=self.byte_starts,
+            byte_ends=self.byte_ends,
+            bbox_lower=self.bbox_lower,
+            bbox_upper=self.bbox_upper,
+            arc_lengths=self.arc_lengths,
+            snake_file_size=np.int64(self.snake_file_size),
+            snake_file_mtime_ns=np.int64(self.snake_file_mtime_ns),
+        )
+        os.replace(tmp_fp, index_fp)
+
+    @classmethod
+    def load(cls, snake_fp):
+        """ Index saved next to snake_fp, or None if there is none or it is out of date """
+        index_fp = snake_index_path(snake_fp)
+        if not os.path.isfile(index_fp):
+            return None
+        try:
+            with np.load(index_fp) as arrays:
+                index = cls(**{name: arrays[name] for name in arrays.files})
+        except (ValueError, KeyError, TypeError, OSError):
+            return None
+        if not index.matches_file(snake_fp):
+            return None
+        return index
+
+def is_binary_snake_file(snake_fp):
+    return snake_fp.lower().endswith(binary_snakes_extension)
+
+def build_snake_index(snake_fp):
+    """ Indexes a snake file by reading all of it once """
+    if is_binary_snake_file(snake_fp):
+        snakes, __ = load_binary_snakes(snake_fp)
+        return SnakeIndex.from_snakes(snakes)
+
+    byte_starts = []
+    byte_ends = []
+    snake_sets = []
+    batch_snakes = []
+    for start, end, snake_dicts in iter_json_snake_dicts_with_offsets(snake_fp):
+        byte_starts.append(start)
+        byte_ends.append(end)
+        batch_snakes.append(snake_dicts)
+        if len(batch_snakes) >= 4096:
+            snake_sets.append(SnakeSet.from_dicts(batch_snakes))
+            batch_snakes = []
+    snake_sets.append(SnakeSet.from_dicts(batch_snakes))
+    return SnakeIndex.from_snakes(SnakeSet.concatenate(snake_sets), byte_starts, byte_ends)
+
+def open_snake_index(snake_fp, save_if_rebuilt=True):
+    """ Index of a snake file, built and saved next to it if it is missing or out of date """
+    index = SnakeIndex.load(snake_fp)
+    if index is None:
+        index = build_snake_index(snake_fp)
+        if save_if_rebuilt:
+            index.save(snake_fp)
+    return index
+
+def load_snakes_by_idxs(snake_fp, snake_idxs, index=None):
+    """ SnakeSet of only the snakes at snake_idxs, in that order. JSON snake files are only
+    read where those snakes are, binary snake files are memory-mapped """
+    snake_idxs = np.asarray(snake_idxs, dtype=np.int64).reshape(-1)
+    if is_binary_snake_file(snake_fp):
+        snakes, __ = load_binary_snakes(snake_fp)
+        return snakes.select(snake_idxs)
+
+    if index is None:
+        index = open_snake_index(snake_fp)
+    snake_list = []
+    with open(snake_fp, "rb") as f:
+        for snake_idx in snake_idxs:
+            f.seek(index.byte_starts[snake_idx])
+            snake_list.append(json.loads(f.read(index.byte_ends[snake_idx] - index.byte_starts[snake_idx])))
+    return SnakeSet.from_dicts(snake_list)
+
+def load_snakes_in_box(snake_fp, lower_xyz, upper_xyz, contained=False, index=None):
+    """ Returns (SnakeSet, snake idxs) of the snakes with a point inside the box, or with
+    contained, with every point inside it. Only snakes whose bounding box overlaps the box
+    are loaded """
+    if index is None:
+        index = open_snake_index(snake_fp)
+    candidate_idxs = index.snakes_with_bbox_in_box(lower_xyz, upper_xyz)
+    candidates = load_snakes_by_idxs(snake_fp, candidate_idxs, index)
+    inside = snakes_in_box_mask(candidates, lower_xyz, upper_xyz, contained)
+    return candidates.select(np.flatnonzero(inside)), candidate_idxs[inside]
@@ -1,41 +1,237 @@
 import json
+import numpy as np
 
-def load_json_snakes(fp):
+from .snakeset import SnakeSet
+from .snakegraph import SnakeGraph
+
+def check_json_snakes_filename(fp):
     if not fp.lower().endswith(".json"):
         raise Exception("Json snake filename '{}' should end in '.json'".format(fp))
 
+class JsonStreamReader:
+    """ Reads JSON values one at a time from a text file, keeping only the part of the file
+    that hasn't been decoded yet in memory """
+    def __init__(self, f, chunk_chars=2**20):
+        self.f = f
+        self.chunk_chars = chunk_chars
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        # Number of characters of the file before the buffer
+        self.buffer_offset = 0
+        self.eof = False
+
+    def read_more(self, min_chars):
+        if self.eof:
+            return False
+        # Drop what has been decoded already, so the buffer doesn't grow with the file
+        self.buffer_offset += self.pos
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        chunk = self.f.read(max(self.chunk_chars, min_chars))
+        if chunk == "":
+            self.eof = True
+            return False
+        self.buffer += chunk
+        return True
+
+    def peek(self):
+        """ Next character that isn't whitespace, or None at the end of the file """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\n\r":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.read_more(0):
+                return None
+
+    def offset(self):
+        """ Number of characters of the file before the next value """
+        self.peek()
+        return self.buffer_offset + self.pos
+
+    def expect(self, chars):
+        char = self.peek()
+        if char is None or char not in chars:
+            raise ValueError("Expected one of '{}' in JSON, found {}".format(chars, repr(char)))
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                val, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                # Value is cut off at the end of the buffer
+                if self.read_more(len(self.buffer)):
+                    continue
+                raise
+            # A number at the end of the buffer could continue in the next chunk
+            if end == len(self.buffer) and not self.eof and self.read_more(0):
+                continue
+            self.pos = end
+            return val
+
+def iter_json_object_items(f, streamed_keys, with_offsets=False):
+    """ Yields (key, value) for each item of the JSON object in text file f. The values of
+    keys in streamed_keys are lists, which are given as iterators over their elements
+    instead of being decoded whole. Each streamed iterator must be used up before the next
+    item is read. with_offsets is passed on to iter_json_list_elements """
+    reader = JsonStreamReader(f)
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+    while True:
+        key = reader.value()
+        reader.expect(":")
+        if key in streamed_keys:
+            yield key, iter_json_list_elements(reader, with_offsets)
+        else:
+            yield key, reader.value()
+        if reader.expect(",}") == "}":
+            return
+
+def iter_json_list_elements(reader, with_offsets=False):
+    """ With with_offsets, yields (start, end, element) with the character offsets of each
+    element in the file """
+    reader.expect("[")
+    if reader.peek() == "]":
+        reader.pos += 1
+        return
+    while True:
+        if with_offsets:
+            start = reader.offset()
+            element = reader.value()
+            yield start, reader.buffer_offset + reader.pos, element
+        else:
+            yield reader.value()
+        if reader.expect(",]") == "]":
+            return
+
+def iter_json_snake_dicts(fp):
+    """ Yields the snakes of a JSON snake file one at a time, each as a list of
+    {"pos": [x,y,z], "fg": fg, "bg": bg} point dicts, without reading the whole file """
+    check_json_snakes_filename(fp)
+
     with open(fp, "r") as f:
-        data = json.load(f)
-    snake_list = data["snakes"]
-    metadata = data["metadata"]
+        for key, val in iter_json_object_items(f, ["snakes"]):
+            if key == "snakes":
+                for snake_dicts in val:
+                    yield snake_dicts
+
+def iter_json_snake_dicts_with_offsets(fp):
+    """ Yields (byte start, byte end, snake point dicts) of every snake of a JSON snake file.
+    json.dumps only writes ASCII, so character offsets are byte offsets """
+    check_json_snakes_filename(fp)
+
+    # newline="" so line endings aren't translated and offsets match the file
+    with open(fp, "r", newline="") as f:
+        for key, val in iter_json_object_items(f, ["snakes"], with_offsets=True):
+            if key == "snakes":
+                for start, end, snake_dicts in val:
+                    yield start, end, snake_dicts
+
+def iter_json_snakes(fp):
+    """ Yields the snakes of a JSON snake file one at a time as SnakeViews """
+    for snake_dicts in iter_json_snake_dicts(fp):
+        yield SnakeSet.from_dicts([snake_dicts])[0]
 
-    return snake_list, metadata
+def load_json_snakes_metadata(fp):
+    """ Returns the metadata of a JSON snake file. Snakes before the metadata in the file are
+    skipped over without being kept, files written by save_json_snakes have it first """
+    check_json_snakes_filename(fp)
 
-def save_json_snakes(fp, snake_list, offset_pixels_xyz, dims_pixels_xyz, pixel_spacing_um_xyz):
+    with open(fp, "r") as f:
+        for key, val in iter_json_object_items(f, ["snakes"]):
+            if key == "metadata":
+                return val
+            if key == "snakes":
+                for snake_dicts in val:
+                    pass
+
+    raise Exception("Json snake file {} has no metadata".format(fp))
+
+def load_json_snakes(fp, batch_points=2**16, with_graph=False):
+    """ Returns (SnakeSet, metadata) from a JSON snake file. Snakes are read one at a time and
+    put into arrays batch_points points at a time, so the whole file is never held as Python
+    objects. With with_graph, returns (SnakeSet, metadata, SnakeGraph), the graph is None if
+    the file has no junctions """
+    check_json_snakes_filename(fp)
+
+    snake_sets = []
+    batch_snakes = []
+    batch_point_count = 0
+    metadata = None
+    graph = None
+    with open(fp, "r") as f:
+        for key, val in iter_json_object_items(f, ["snakes"]):
+            if key == "metadata":
+                metadata = val
+            elif key == "junctions":
+                graph = SnakeGraph.from_json_dict(val)
+            elif key == "snakes":
+                for snake_dicts in val:
+                    batch_snakes.append(snake_dicts)
+                    batch_point_count += len(snake_dicts)
+                    if batch_point_count >= batch_points:
+                        snake_sets.append(SnakeSet.from_dicts(batch_snakes))
+                        batch_snakes = []
+                        batch_point_count = 0
+    if len(batch_snakes) > 0:
+        snake_sets.append(SnakeSet.from_dicts(batch_snakes))
+
+    if metadata is None:
+        raise Exception("Json snake file {} has no metadata".format(fp))
+
+    if with_graph:
+        return SnakeSet.concatenate(snake_sets), metadata, graph
+    return SnakeSet.concatenate(snake_sets), metadata
+
+def save_json_snakes(fp, snakes, offset_pixels_xyz, dims_pixels_xyz, pixel_spacing_um_xyz, graph=None):
     """ Arguments:
     fp                    - filepath to save json file
-    snake_list            - list of snake points [{"pos": [x,y,z], "fg": ...}, {"pos": [x,y,z], ...}, ...]
+    snakes                - SnakeSet, saved as lists of snake points [{"pos": [x,y,z], "fg": ...}, {"pos": [x,y,z], ...}, ...]
     offset_pixels_xyz     - [x,y,z] if this is a section of all snakes, this says where the box actually
                             starts within the TIFF image. If the snake coordinate system has its origin
                             at the origin of the original image coordinates, then offset should be [0,0,0]
     dims_pixels_xyz       - [xsize,ysize,zsize], the pixel dimensions of the 3D image region that
                             these snakes are made for.
     pixel_spacing_um_xyz  - [dx,dy,dz], the micrometer spacing between pixels in x,y and z
+    graph                 - optional SnakeGraph of the junctions between the snakes, saved after
+                            the snakes as "junctions": {"positions": ..., "snake_offsets": ..., ...}
+
+    Snakes are written one at a time. The file is byte for byte the same as
+    json.dumps({"metadata": {...}, "snakes": [...]}), with "junctions" last if there is a graph
+
+    Returns (byte starts, byte ends) of each snake's point list in the file
     """
 
-    if not fp.lower().endswith(".json"):
-        raise Exception("Json snake filename '{}' should end in '.json'".format(fp))
+    check_json_snakes_filename(fp)
 
-    data = {
-        "metadata": {
-            "offset_pixels_xyz": offset_pixels_xyz,
-            "dims_pixels_xyz": dims_pixels_xyz,
-            "pixel_spacing_um_xyz": pixel_spacing_um_xyz,
-        },
-        "snakes": snake_list,
+    metadata = {
+        "offset_pixels_xyz": offset_pixels_xyz,
+        "dims_pixels_xyz": dims_pixels_xyz,
+        "pixel_spacing_um_xyz": pixel_spacing_um_xyz,
     }
 
-    json_str = json.dumps(data)
+    snake_byte_starts = np.zeros(len(snakes), dtype=np.int64)
+    snake_byte_ends = np.zeros(len(snakes), dtype=np.int64)
+    with open(fp, 'w', newline="") as f:
+        # Everything written is ASCII, so the string lengths are byte counts
+        byte_count = f.write('{"metadata": ')
+        byte_count += f.write(json.dumps(metadata))
+        byte_count += f.write(', "snakes": [')
+        for snake_idx, snake_dicts in enumerate(snakes.iter_dicts()):
+            if snake_idx > 0:
+                byte_count += f.write(", ")
+            snake_byte_starts[snake_idx] = byte_count
+            byte_count += f.write(json.dumps(snake_dicts))
+            snake_byte_ends[snake_idx] = byte_count
+        f.write("]")
+        if graph is not None:
+            f.write(', "junctions": ')
+            f.write(json.dumps(graph.to_json_dict()))
+        f.write("}")
 
-    with open(fp, 'w') as f:
-        f.write(json_str)
\ No newline at end of file
+    return snake_byte_starts, snake_byte_ends
@@ -0,0 +1,177 @@
+import numpy as np
+
+def float32_to_short_float64(values):
+    """ Converts float32 values to the float64 values of their shortest decimal form, so
+    41.7002 read into float32 is saved in JSON as 41.7002 and not 41.70019912719727.
+    Values read from SOAX snake files have 6 significant digits, and are given back exactly.
+    """
+    values = np.asarray(values, dtype=np.float32)
+    shape = values.shape
+    values = values.reshape(-1)
+    wide_values = values.astype(np.float64)
+    short_values = wide_values.copy()
+
+    finite_nonzero = np.isfinite(wide_values) & (wide_values != 0)
+    exponents = np.zeros(values.shape, dtype=np.int64)
+    exponents[finite_nonzero] = np.floor(np.log10(np.abs(wide_values[finite_nonzero]))).astype(np.int64)
+
+    # 9 significant digits are always enough to get the same float32 back
+    unresolved = finite_nonzero.copy()
+    for digits in range(6, 10):
+        if not unresolved.any():
+            break
+        decimal_places = digits - 1 - exponents[unresolved]
+        mantissas = np.round(wide_values[unresolved] * 10.0 ** decimal_places)
+        # Dividing the integer mantissa by an exact power of ten rounds once, to the float64
+        # closest to the decimal
+        candidates = np.where(
+            decimal_places >= 0,
+            mantissas / 10.0 ** np.abs(decimal_places),
+            mantissas * 10.0 ** np.abs(decimal_places),
+        )
+        matches = candidates.astype(np.float32) == values[unresolved]
+        unresolved_idxs = np.flatnonzero(unresolved)
+        short_values[unresolved_idxs[matches]] = candidates[matches]
+        unresolved[unresolved_idxs[matches]] = False
+
+    return short_values.reshape(shape)
+
+class SnakeView:
+    """ One snake of a SnakeSet. The arrays are views into the SnakeSet's arrays """
+    def __init__(self, positions, fg, bg):
+        self.positions = positions
+        self.fg = fg
+        self.bg = bg
+
+    def __len__(self):
+        return len(self.positions)
+
+    def iter_dicts(self, batch_points=2**16):
+        """ Same as SnakeSet.iter_dicts, yields the list of point dicts of the one snake """
+        yield self.to_dicts()
+
+    def to_dicts(self):
+        return SnakeSet(self.positions, self.fg, self.bg, [0, len(self.positions)]).to_dicts()[0]
+
+class SnakeSet:
+    """ Snakes stored as flat float32 arrays of all their points instead of lists of point dicts.
+
+    positions - N x 3 array of x, y, z of every point
+    fg, bg    - length N arrays of the foreground and background intensity of every point
+    offsets   - length (number of snakes + 1) array, the points of snake i are
+                offsets[i]:offsets[i + 1]
+
+    Iterating over a SnakeSet gives a SnakeView of each snake. to_dicts and from_dicts convert
+    to and from the list of snakes of {"pos": [x, y, z], "fg": fg, "bg": bg} points that is
+    saved in JSON snake files.
+    """
+    def __init__(self, positions, fg, bg, offsets):
+        self.positions = np.ascontiguousarray(positions, dtype=np.float32).reshape(-1, 3)
+        self.fg = np.ascontiguousarray(fg, dtype=np.float32).reshape(-1)
+        self.bg = np.ascontiguousarray(bg, dtype=np.float32).reshape(-1)
+        self.offsets = np.ascontiguousarray(offsets, dtype=np.int64).reshape(-1)
+
+        point_count = len(self.positions)
+        if len(self.fg) != point_count or len(self.bg) != point_count:
+            raise Exception("SnakeSet has {} positions but {} fg and {} bg values".format(point_count, len(self.fg), len(self.bg)))
+        if len(self.offsets) == 0 or self.offsets[0] != 0 or self.offsets[-1] != point_count or np.any(np.diff(self.offsets) < 0):
+            raise Exception("SnakeSet offsets must go from 0 to the number of points ({}) without decreasing".format(point_count))
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros((0, 3)), np.zeros(0), np.zeros(0), [0])
+
+    @classmethod
+    def from_point_arrays(cls, point_values, offsets):
+        """ From the N x 5 (x, y, z, fg, bg) array and offsets that read_snake_point_arrays returns """
+        point_values = np.asarray(point_values).reshape(-1, 5)
+        return cls(point_values[:, 0:3], point_values[:, 3], point_values[:, 4], offsets)
+
+    @classmethod
+    def from_dicts(cls, snake_list):
+        lengths = [len(snake) for snake in snake_list]
+        offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+        points = [pt for snake in snake_list for pt in snake]
+        positions = np.array([pt["pos"] for pt in points], dtype=np.float32).reshape(-1, 3)
+        fg = np.array([pt["fg"] for pt in points], dtype=np.float32)
+        bg = np.array([pt["bg"] for pt in points], dtype=np.float32)
+        return cls(positions, fg, bg, offsets)
+
+    @classmethod
+    def concatenate(cls, snake_sets):
+        snake_sets = list(snake_sets)
+        if len(snake_sets) == 0:
+            return cls.empty()
+        point_counts = np.array([snake_set.point_count for snake_set in snake_sets], dtype=np.int64)
+        point_starts = np.concatenate([[0], np.cumsum(point_counts)])
+        offsets = np.concatenate([[0]] + [snake_set.offsets[1:] + point_start for snake_set, point_start in zip(snake_sets, point_starts)])
+        return cls(
+            np.concatenate([snake_set.positions for snake_set in snake_sets]),
+            np.concatenate([snake_set.fg for snake_set in snake_sets]),
+            np.concatenate([snake_set.bg for snake_set in snake_sets]),
+            offsets,
+        )
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def point_count(self):
+        return len(self.positions)
+
+    def snake_lengths(self):
+        """ Number of points in each snake """
+        return np.diff(self.offsets)
+
+    def snake_idx_of_points(self):
+        """ Index of the snake each point belongs to """
+        return np.repeat(np.arange(len(self), dtype=np.int64), self.snake_lengths())
+
+    def __getitem__(self, snake_idx):
+        if snake_idx < 0:
+            snake_idx += len(self)
+        if snake_idx < 0 or snake_idx >= len(self):
+            raise IndexError("Snake index {} out of range for {} snakes".format(snake_idx, len(self)))
+        start, end = self.offsets[snake_idx], self.offsets[snake_idx + 1]
+        return SnakeView(self.positions[start:end], self.fg[start:end], self.bg[start:end])
+
+    def __iter__(self):
+        for snake_idx in range(len(self)):
+            yield self[snake_idx]
+
+    def select(self, snake_idxs):
+        """ New SnakeSet with only the snakes at snake_idxs, in that order """
+        snake_idxs = np.asarray(snake_idxs, dtype=np.int64).reshape(-1)
+        lengths = self.snake_lengths()[snake_idxs]
+        offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+        point_idxs = np.arange(offsets[-1], dtype=np.int64) + np.repeat(self.offsets[snake_idxs] - offsets[:-1], lengths)
+        return SnakeSet(self.positions[point_idxs], self.fg[point_idxs], self.bg[point_idxs], offsets)
+
+    def with_positions(self, positions):
+        """ New SnakeSet with the same snakes and intensities, but different point positions """
+        return SnakeSet(positions, self.fg, self.bg, self.offsets)
+
+    def iter_dicts(self, batch_points=2**16):
+        """ Yields each snake as a list of point dicts, like to_dicts, but only converts about
+        batch_points points at a time """
+        offsets = self.offsets
+        snake_idx = 0
+        while snake_idx < len(self):
+            start = offsets[snake_idx]
+            end_idx = int(np.searchsorted(offsets, start + batch_points, side="right")) - 1
+            end_idx = min(max(end_idx, snake_idx + 1), len(self))
+            end = offsets[end_idx]
+            batch = SnakeSet(self.positions[start:end], self.fg[start:end], self.bg[start:end], offsets[snake_idx:end_idx + 1] - start)
+            for snake_dicts in batch.to_dicts():
+                yield snake_dicts
+            snake_idx = end_idx
+
+    def to_dicts(self):
+        positions = float32_to_short_float64(self.positions).tolist()
+        fg = float32_to_short_float64(self.fg).tolist()
+        bg = float32_to_short_float64(self.bg).tolist()
+        offsets = self.offsets.tolist()
+        return [
+            [{"pos": positions[pt_idx], "fg": fg[pt_idx], "bg": bg[pt_idx]} for pt_idx in range(offsets[i], offsets[i + 1])]
+            for i in range(len(offsets) - 1)
+        ]
@@ -0,0 +1,264 @@
+""" Uniform grid over the segments of a SnakeSet, for finding the snakes near a point or in a
+box without going through every point.
+
+Positions are in micrometers, scaled from pixels by the snake file's pixel spacing. Every
+segment between two points of a snake (or the single point of a one point snake) is put in
+every grid cell its bounding box overlaps. Queries look up the cells around the query and
+then check the exact distance to, or intersection with, the segments found there.
+
+The index of "snakes.json" is saved as "snakes.json.spatial.npz", and like a SnakeIndex is
+rebuilt when the snake file has changed.
+"""
+import os
+import numpy as np
+
+spatial_index_suffix = ".spatial.npz"
+
+def spatial_index_path(snake_fp):
+    return snake_fp + spatial_index_suffix
+
+def snake_segments(snakes, pixel_spacing_um_xyz):
+    """ Returns (segment starts, segment ends, snake idx of each segment) in micrometers """
+    positions_um = snakes.positions.astype(np.float64) * np.asarray(pixel_spacing_um_xyz, dtype=np.float64)
+    snake_idx_of_points = snakes.snake_idx_of_points()
+    segment_starts = np.flatnonzero(np.diff(snake_idx_of_points) == 0)
+    # One point snakes have no segments, they get one of zero length
+    single_point_snakes = np.flatnonzero(snakes.snake_lengths() == 1)
+    single_points = snakes.offsets[single_point_snakes]
+
+    start_idxs = np.concatenate([segment_starts, single_points])
+    end_idxs = np.concatenate([segment_starts + 1, single_points])
+    order = np.argsort(start_idxs, kind="stable")
+    start_idxs = start_idxs[order]
+    end_idxs = end_idxs[order]
+    return positions_um[start_idxs], positions_um[end_idxs], snake_idx_of_points[start_idxs]
+
+def point_segment_distances(point, starts, ends):
+    directions = ends - starts
+    lengths_squared = np.einsum("ij,ij->i", directions, directions)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        along = np.einsum("ij,ij->i", point - starts, directions) / lengths_squared
+    along = np.clip(np.nan_to_num(along, nan=0.0, posinf=0.0, neginf=0.0), 0, 1)
+    closest = starts + along[:, None] * directions
+    return np.linalg.norm(closest - point, axis=1)
+
+def segments_intersect_box(starts, ends, lower, upper):
+    """ Boolean array of which segments pass through the box, by clipping each segment to the
+    box one axis at a time """
+    directions = ends - starts
+    t_min = np.zeros(len(starts))
+    t_max = np.ones(len(starts))
+    for axis in range(3):
+        moving = directions[:, axis] != 0
+        # Segments that don't move along this axis have to be within the box's range of it
+        still_outside = ~moving & ((starts[:, axis] < lower[axis]) | (starts[:, axis] > upper[axis]))
+        t_max[still_outside] = -1
+        with np.errstate(invalid="ignore", divide="ignore"):
+            t_lower = (lower[axis] - starts[:, axis]) / directions[:, axis]
+            t_upper = (upper[axis] - starts[:, axis]) / directions[:, axis]
+        t_min[moving] = np.maximum(t_min[moving], np.minimum(t_lower, t_upper)[moving])
+        t_max[moving] = np.minimum(t_max[moving], np.maximum(t_lower, t_upper)[moving])
+    return t_min <= t_max
+
+class SnakeSpatialIndex:
+    def __init__(self, segment_starts, segment_ends, segment_snake_idxs, snake_count, cell_size_um, grid_origin, grid_dims, cell_keys, cell_offsets, cell_segment_idxs, snake_file_size=-1, snake_file_mtime_ns=-1):
+        self.segment_starts = np.asarray(segment_starts, dtype=np.float64).reshape(-1, 3)
+        self.segment_ends = np.asarray(segment_ends, dtype=np.float64).reshape(-1, 3)
+        self.segment_snake_idxs = np.asarray(segment_snake_idxs, dtype=np.int64)
+        self.snake_count = int(snake_count)
+        self.cell_size_um = float(cell_size_um)
+        self.grid_origin = np.asarray(grid_origin, dtype=np.float64)
+        self.grid_dims = np.asarray(grid_dims, dtype=np.int64)
+        # Sorted keys of the cells that have segments, the segments of cell_keys[i] are
+        # cell_segment_idxs[cell_offsets[i]:cell_offsets[i + 1]]
+        self.cell_keys = np.asarray(cell_keys, dtype=np.int64)
+        self.cell_offsets = np.asarray(cell_offsets, dtype=np.int64)
+        self.cell_segment_idxs = np.asarray(cell_segment_idxs, dtype=np.int64)
+        self.snake_file_size = int(snake_file_size)
+        self.snake_file_mtime_ns = int(snake_file_mtime_ns)
+
+    @classmethod
+    def from_snakes(cls, snakes, pixel_spacing_um_xyz, cell_size_um=None):
+        """ With no cell_size_um, cells are twice the median segment size """
+        starts, ends, segment_snake_idxs = snake_segments(snakes, pixel_spacing_um_xyz)
+        lower = np.minimum(starts, ends)
+        upper = np.maximum(starts, ends)
+
+        if cell_size_um is None:
+            segment_sizes = (upper - lower).max(axis=1) if len(starts) > 0 else np.zeros(0)
+            cell_size_um = 2 * float(np.median(segment_sizes)) if len(segment_sizes) > 0 else 1.0
+            if cell_size_um <= 0:
+                cell_size_um = 1.0
+        if cell_size_um <= 0:
+            raise Exception("Spatial index cell size must be positive, got {}".format(cell_size_um))
+
+        grid_origin = lower.min(axis=0) if len(starts) > 0 else np.zeros(3)
+        lower_cells = np.floor((lower - grid_origin) / cell_size_um).astype(np.int64)
+        upper_cells = np.floor((upper - grid_origin) / cell_size_um).astype(np.int64)
+        grid_dims = upper_cells.max(axis=0) + 1 if len(starts) > 0 else np.ones(3, dtype=np.int64)
+
+        # Every cell each segment's bounding box covers
+        cell_spans = upper_cells - lower_cells + 1
+        cell_counts = cell_spans.prod(axis=1)
+        entry_segment_idxs = np.repeat(np.arange(len(starts), dtype=np.int64), cell_counts)
+        local_idxs = np.arange(cell_counts.sum(), dtype=np.int64) - np.repeat(np.cumsum(cell_counts) - cell_counts, cell_counts)
+        entry_spans = cell_spans[entry_segment_idxs]
+        entry_cells = lower_cells[entry_segment_idxs] + np.stack([
+            local_idxs // (entry_spans[:, 1] * entry_spans[:, 2]),
+            local_idxs // entry_spans[:, 2] % entry_spans[:, 1],
+            local_idxs % entry_spans[:, 2],
+        ], axis=1)
+        entry_keys = (entry_cells[:, 0] * grid_dims[1] + entry_cells[:, 1]) * grid_dims[2] + entry_cells[:, 2]
+
+        order = np.argsort(entry_keys, kind="stable")
+        cell_keys, cell_counts = np.unique(entry_keys[order], return_counts=True)
+
+        return cls(
+            starts,
+            ends,
+            segment_snake_idxs,
+            len(snakes),
+            cell_size_um,
+            grid_origin,
+            grid_dims,
+            cell_keys,
+            np.concatenate([[0], np.cumsum(cell_counts)]),
+            entry_segment_idxs[order],
+        )
+
+    def segments_near_box(self, lower_um, upper_um):
+        """ Indices of the segments in the grid cells that the box overlaps """
+        lower_cells = np.floor((np.asarray(lower_um, dtype=np.float64) - self.grid_origin) / self.cell_size_um).astype(np.int64)
+        upper_cells = np.floor((np.asarray(upper_um, dtype=np.float64) - self.grid_origin) / self.cell_size_um).astype(np.int64)
+        lower_cells = np.maximum(lower_cells, 0)
+        upper_cells = np.minimum(upper_cells, self.grid_dims - 1)
+        if np.any(upper_cells < lower_cells) or len(self.cell_keys) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        query_cell_count = int(np.prod(upper_cells - lower_cells + 1))
+        if query_cell_count <= len(self.cell_keys):
+            # Look up each cell of the box
+            ranges = [np.arange(lower_cells[axis], upper_cells[axis] + 1) for axis in range(3)]
+            grid_x, grid_y, grid_z = np.meshgrid(*ranges, indexing="ij")
+            query_keys = ((grid_x * self.grid_dims[1] + grid_y) * self.grid_dims[2] + grid_z).reshape(-1)
+            cell_idxs = np.searchsorted(self.cell_keys, query_keys)
+            cell_idxs = cell_idxs[(cell_idxs < len(self.cell_keys))]
+            cell_idxs = cell_idxs[np.isin(self.cell_keys[cell_idxs], query_keys)]
+        else:
+            # The box covers more cells than have segments, go through those cells instead
+            cell_coords = np.stack([
+                self.cell_keys // (self.grid_dims[1] * self.grid_dims[2]),
+                self.cell_keys // self.grid_dims[2] % self.grid_dims[1],
+                self.cell_keys % self.grid_dims[2],
+            ], axis=1)
+            cell_idxs = np.flatnonzero(np.all((cell_coords >= lower_cells) & (cell_coords <= upper_cells), axis=1))
+
+        counts = self.cell_offsets[cell_idxs + 1] - self.cell_offsets[cell_idxs]
+        entry_idxs = np.repeat(self.cell_offsets[cell_idxs] - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+        return np.unique(self.cell_segment_idxs[entry_idxs])
+
+    def snakes_in_box(self, lower_um, upper_um):
+        """ Sorted indices of the snakes that pass through the box """
+        lower_um = np.asarray(lower_um, dtype=np.float64)
+        upper_um = np.asarray(upper_um, dtype=np.float64)
+        segment_idxs = self.segments_near_box(lower_um, upper_um)
+        inside = segments_intersect_box(self.segment_starts[segment_idxs], self.segment_ends[segment_idxs], lower_um, upper_um)
+        return np.unique(self.segment_snake_idxs[segment_idxs[inside]])
+
+    def snakes_within_radius(self, point_um, radius_um):
+        """ Returns (snake idxs, distances), the snakes that pass within radius_um of the
+        point sorted by index, and how close each comes """
+        point_um = np.asarray(point_um, dtype=np.float64)
+        segment_idxs = self.segments_near_box(point_um - radius_um, point_um + radius_um)
+        distances = point_segment_distances(point_um, self.segment_starts[segment_idxs], self.segment_ends[segment_idxs])
+        close = distances <= radius_um
+        return self.closest_per_snake(self.segment_snake_idxs[segment_idxs[close]], distances[close])
+
+    def nearest_snake(self, point_um):
+        """ Returns (snake idx, distance) of the snake closest to the point, or (-1, inf) if
+        there are no snakes. The search box grows until it holds a segment closer than its
+        own size, so only cells near the point are looked at """
+        point_um = np.asarray(point_um, dtype=np.float64)
+        if len(self.segment_starts) == 0:
+            return -1, np.inf
+
+        grid_upper = self.grid_origin + self.grid_dims * self.cell_size_um
+        # Far enough from the point to cover every cell
+        max_radius = np.linalg.norm(np.maximum(np.abs(point_um - self.grid_origin), np.abs(point_um - grid_upper)))
+        radius = self.cell_size_um
+        while True:
+            segment_idxs = self.segments_near_box(point_um - radius, point_um + radius)
+            if len(segment_idxs) > 0:
+                distances = point_segment_distances(point_um, self.segment_starts[segment_idxs], self.segment_ends[segment_idxs])
+                closest = np.argmin(distances)
+                # A closer segment outside the box would be more than radius away
+                if distances[closest] <= radius or radius >= max_radius:
+                    return int(self.segment_snake_idxs[segment_idxs[closest]]), float(distances[closest])
+            radius *= 2
+
+    def closest_per_snake(self, snake_idxs, distances):
+        order = np.lexsort((distances, snake_idxs))
+        snake_idxs = snake_idxs[order]
+        distances = distances[order]
+        first = np.concatenate([[True], snake_idxs[1:] != snake_idxs[:-1]]) if len(snake_idxs) > 0 else np.zeros(0, dtype=bool)
+        return snake_idxs[first], distances[first]
+
+    def matches_file(self, snake_fp):
+        stat = os.stat(snake_fp)
+        return stat.st_size == self.snake_file_size and stat.st_mtime_ns == self.snake_file_mtime_ns
+
+    def save(self, snake_fp):
+        """ Saves the index next to snake_fp, recording the snake file as it is now """
+        stat = os.stat(snake_fp)
+        self.snake_file_size = stat.st_size
+        self.snake_file_mtime_ns = stat.st_mtime_ns
+        index_fp = spatial_index_path(snake_fp)
+        # np.savez adds .npz to names that don't end with it, so the temporary name does
+        tmp_fp = index_fp[:-len(".npz")] + ".tmp.npz"
+        np.savez(
+            tmp_fp,
+            segment_starts=self.segment_starts,
+            segment_ends=self.segment_ends,
+            segment_snake_idxs=self.segment_snake_idxs,
+            snake_count=np.int64(self.snake_count),
+            cell_size_um=np.float64(self.cell_size_um),
+            grid_origin=self.grid_origin,
+            grid_dims=self.grid_dims,
+            cell_keys=self.cell_keys,
+            cell_offsets=self.cell_offsets,
+            cell_segment_idxs=self.cell_segment_idxs,
+            snake_file_size=np.int64(self.snake_file_size),
+            snake_file_mtime_ns=np.int64(self.snake_file_mtime_ns),
+        )
+        os.replace(tmp_fp, index_fp)
+
+    @classmethod
+    def load(cls, snake_fp):
+        """ Spatial index saved next to snake_fp, or None if there is none or it is out of date """
+        index_fp = spatial_index_path(snake_fp)
+        if not os.path.isfile(index_fp):
+            return None
+        try:
+            with np.load(index_fp) as arrays:
+                index = cls(**{name: arrays[name] for name in arrays.files})
+        except (ValueError, KeyError, TypeError, OSError):
+            return None
+        if not index.matches_file(snake_fp):
+            return None
+        return index
+
+def open_spatial_index(snake_fp, cell_size_um=None, save_if_rebuilt=True):
+    """ Spatial index of a JSON or binary snake file, built from the file and saved next to it
+    if it is missing or out of date """
+    # Imported here, snakeformats imports the modules that write snake files
+    from .snakeformats import load_snakes
+
+    index = SnakeSpatialIndex.load(snake_fp)
+    if index is not None and (cell_size_um is None or cell_size_um == index.cell_size_um):
+        return index
+
+    snakes, metadata = load_snakes(snake_fp)
+    index = SnakeSpatialIndex.from_snakes(snakes, metadata["pixel_spacing_um_xyz"], cell_size_um)
+    if save_if_rebuilt:
+        index.save(snake_fp)
+    return index
@@ -0,0 +1,170 @@
+import os
+import sys
+import json
+import shutil
+import subprocess
+import threading
+import numpy as np
+
+def exit_code_from_wait_status(wait_status):
+    # Same convention as subprocess: negative number if process was killed by a signal
+    if os.WIFSIGNALED(wait_status):
+        return -os.WTERMSIG(wait_status)
+    return os.WEXITSTATUS(wait_status)
+
+def peak_rss_bytes_from_rusage(rusage):
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+    if sys.platform == "darwin":
+        return rusage.ru_maxrss
+    return rusage.ru_maxrss * 1024
+
+def start_command(command_args, stdout, stderr, env, cpu_affinity):
+    # Commands are started from worker threads, where a preexec_fn can deadlock the child
+    # before exec. taskset sets the affinity and then execs the command in the same process,
+    # so threads started by the command inherit it and wait4 still sees the command itself
+    taskset_path = None
+    if cpu_affinity is not None:
+        taskset_path = shutil.which("taskset")
+        if taskset_path is not None:
+            # Same error as Popen would give, instead of taskset failing to run it
+            if shutil.which(command_args[0]) is None:
+                raise FileNotFoundError("No such command: '{}'".format(command_args[0]))
+            cpu_list = ",".join(str(cpu) for cpu in sorted(cpu_affinity))
+            command_args = [taskset_path, "-c", cpu_list] + list(command_args)
+
+    process = subprocess.Popen(command_args, stdout=stdout, stderr=stderr, env=env)
+
+    if cpu_affinity is not None and taskset_path is None:
+        # Without taskset the affinity is set once the process has started, threads it
+        # started before then aren't pinned
+        try:
+            os.sched_setaffinity(process.pid, cpu_affinity)
+        except OSError:
+            # The process already exited
+            pass
+
+    return process
+
+def wait_with_rusage(process):
+    if not hasattr(os, "wait4"):
+        return process.wait(), None
+
+    __, wait_status, rusage = os.wait4(process.pid, 0)
+    exit_code = exit_code_from_wait_status(wait_status)
+    # The process was reaped by wait4, so Popen shouldn't try to wait for it again
+    process.returncode = exit_code
+
+    resource_usage = {
+        "user_time_s": rusage.ru_utime,
+        "system_time_s": rusage.ru_stime,
+        "peak_rss_bytes": peak_rss_bytes_from_rusage(rusage),
+    }
+
+    return exit_code, resource_usage
+
+def run_command_with_rusage(command_args, stdout, stderr, env=None, cpu_affinity=None):
+    """ Runs command and waits for it to finish, returns (exit_code, resource_usage)
+
+    resource_usage is a dict with user_time_s, system_time_s and peak_rss_bytes of the
+    process, or None if os.wait4 is not available on this platform.
+
+    If cpu_affinity is a list of CPUs, the process (and every thread it starts) is only
+    allowed to run on those CPUs.
+    """
+    process = start_command(command_args, stdout, stderr, env, cpu_affinity)
+    return wait_with_rusage(process)
+
+def run_command_capturing_output(command_args, env=None, cpu_affinity=None):
+    """ Same as run_command_with_rusage, but keeps stdout and stderr in memory instead of
+    writing them to files. Returns (exit_code, resource_usage, stdout_bytes, stderr_bytes)
+    """
+    process = start_command(command_args, subprocess.PIPE, subprocess.PIPE, env, cpu_affinity)
+
+    # Both pipes are read at the same time, so the process never blocks on a full pipe
+    outputs = {}
+    def read_pipe(name, pipe):
+        outputs[name] = pipe.read()
+        pipe.close()
+    readers = [
+        threading.Thread(target=read_pipe, args=("stdout", process.stdout)),
+        threading.Thread(target=read_pipe, args=("stderr", process.stderr)),
+    ]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+
+    exit_code, resource_usage = wait_with_rusage(process)
+
+    return exit_code, resource_usage, outputs["stdout"], outputs["stderr"]
+
+class TelemetryWriter:
+    """ Writes one JSON record per line to a new file, can be shared between worker threads """
+    def __init__(self, fp):
+        self.fp = fp
+        self.lock = threading.Lock()
+        # "x" so a file from another run is never added to
+        self.file = open(fp, "x")
+
+    def write(self, record):
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def load_telemetry_records(fp):
+    records = []
+    with open(fp, "r") as f:
+        for line in f:
+            if line.strip() != "":
+                records.append(json.loads(line))
+    return records
+
+def _percentile_str(values, percentile, fmt):
+    if len(values) == 0:
+        return "-"
+    return fmt.format(np.percentile(values, percentile))
+
+def telemetry_summary_rows(records, group_key):
+    records_by_group = {}
+    for record in records:
+        records_by_group.setdefault(record[group_key], []).append(record)
+
+    rows = []
+    for group_name in sorted(records_by_group.keys()):
+        group_records = records_by_group[group_name]
+        runtimes = [rec["wall_time_s"] for rec in group_records]
+        peak_rss_mb = [rec["peak_rss_bytes"] / 2**20 for rec in group_records if rec["peak_rss_bytes"] is not None]
+        failed = len([rec for rec in group_records if rec["exit_code"] != 0])
+
+        rows.append([
+            group_name,
+            str(len(group_records)),
+            str(failed),
+            _percentile_str(runtimes, 50, "{:.1f}"),
+            _percentile_str(runtimes, 95, "{:.1f}"),
+            _percentile_str(peak_rss_mb, 50, "{:.0f}"),
+            _percentile_str(peak_rss_mb, 95, "{:.0f}"),
+        ])
+
+    return rows
+
+def log_telemetry_summary(records, logger):
+    header = ["jobs", "failed", "p50 s", "p95 s", "p50 MB", "p95 MB"]
+
+    for group_key, group_title in [("param_name", "parameter set"), ("image_name", "image")]:
+        rows = telemetry_summary_rows(records, group_key)
+        if len(rows) == 0:
+            continue
+
+        name_width = max(len(group_title), max(len(row[0]) for row in rows))
+        row_template = "{:<" + str(name_width) + "}" + "".join(["  {:>8}"] * len(header))
+
+        logger.log("batch_soax runtime and peak memory by {}:".format(group_title))
+        logger.log(row_template.format(group_title, *header))
+        for row in rows:
+            logger.log(row_template.format(*row))
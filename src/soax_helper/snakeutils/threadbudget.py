@@ -0,0 +1,54 @@
+import os
+import queue
+
+# Environment variables that limit how many threads ITK (which batch_soax uses) and
+# OpenMP start. By default both start one thread per core.
+thread_count_env_vars = [
+    "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS",
+    "OMP_NUM_THREADS",
+    "OMP_THREAD_LIMIT",
+]
+
+def available_cpus():
+    """ CPUs this process is allowed to run on, which can be fewer than os.cpu_count()
+    in a batch job or container """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+def partition_cpus(cpus, parts):
+    """ Splits cpus into parts contiguous sets, as even in size as possible. If there are
+    fewer cpus than parts, some sets share a CPU so every set has at least one.
+    """
+    if len(cpus) < parts:
+        return [[cpus[part_idx % len(cpus)]] for part_idx in range(parts)]
+
+    cpu_sets = []
+    start_idx = 0
+    for part_idx in range(parts):
+        part_size = len(cpus) // parts + (1 if part_idx < len(cpus) % parts else 0)
+        cpu_sets.append(cpus[start_idx:start_idx + part_size])
+        start_idx += part_size
+    return cpu_sets
+
+def thread_limit_env(thread_count, base_env=None):
+    env = dict(os.environ if base_env is None else base_env)
+    for var_name in thread_count_env_vars:
+        env[var_name] = str(thread_count)
+    return env
+
+class CpuSlots:
+    """ Hands out the CPU sets of a partition to running jobs, so jobs that run at the
+    same time never get the same CPU set. acquire blocks until a set is free.
+    """
+    def __init__(self, cpu_sets):
+        self.cpu_sets = cpu_sets
+        self.free_sets = queue.Queue()
+        for cpu_set in cpu_sets:
+            self.free_sets.put(cpu_set)
+
+    def acquire(self):
+        return self.free_sets.get()
+
+    def release(self, cpu_set):
+        self.free_sets.put(cpu_set)
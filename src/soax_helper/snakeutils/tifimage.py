@@ -18,6 +18,14 @@ def get_single_tiff_info(tiff_path):
 
     return shape, stack_height, dtype
 
+def get_tiff_voxel_count(tiff_path):
+    # Only reads the TIFF headers, pixel data isn't decoded
+    with Image.open(tiff_path) as pil_img:
+        width, height = pil_img.size
+        frames = getattr(pil_img, "n_frames", 1)
+
+    return width * height * frames
+
 # numpy arr should have (height,width,depth)
 def save_3d_tif(fp,numpy_arr):
     # tifffile takes (depth,height,width)
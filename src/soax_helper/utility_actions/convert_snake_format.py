@@ -0,0 +1,56 @@
+import os
+
+from ..snakeutils.snakeformats import load_snakes, save_snakes, snake_output_formats, snake_format_of_file, snake_filename_with_format
+
+def convert_snake_file_format(source_fp, target_fp):
+    snakes, metadata, graph = load_snakes(source_fp, with_graph=True)
+    save_snakes(
+        target_fp,
+        snakes,
+        metadata["offset_pixels_xyz"],
+        metadata["dims_pixels_xyz"],
+        metadata["pixel_spacing_um_xyz"],
+        graph,
+    )
+
+def convert_snake_format(source, target, output_format, logger):
+    """ Converts a JSON or binary snake file, or every snake file in a directory tree, to
+    output_format. Directories are converted into a target directory with the same layout.
+    """
+    if output_format not in snake_output_formats:
+        logger.FAIL("Unknown snake output format '{}', expected one of {}".format(output_format, list(snake_output_formats.keys())))
+
+    if os.path.isfile(source):
+        if os.path.isdir(target):
+            target = os.path.join(target, snake_filename_with_format(os.path.basename(source), output_format))
+        logger.log("Converting {} to {}".format(source, target))
+        convert_snake_file_format(source, target)
+        return
+
+    if not os.path.isdir(source):
+        logger.FAIL("Snake source {} is not a file or directory".format(source))
+
+    converted_count = 0
+    for dirpath, dirnames, filenames in os.walk(source):
+        dirnames.sort()
+        # Hidden files, like the convert_snakes_to_json manifest, aren't snake files
+        snake_filenames = sorted(fn for fn in filenames if not fn.startswith(".") and os.path.splitext(fn)[1].lower() in snake_output_formats.values())
+        # Files already in the output format are left alone
+        snake_filenames = [fn for fn in snake_filenames if snake_format_of_file(fn) != output_format]
+        if len(snake_filenames) == 0:
+            continue
+
+        target_dirpath = os.path.join(target, os.path.relpath(dirpath, source))
+        if not os.path.isdir(target_dirpath):
+            if os.path.exists(target_dirpath):
+                logger.FAIL("Cannot save converted snakes to {}, this exists but is not a directory".format(target_dirpath))
+            os.makedirs(target_dirpath)
+
+        for snake_fn in snake_filenames:
+            source_fp = os.path.join(dirpath, snake_fn)
+            target_fp = os.path.join(target_dirpath, snake_filename_with_format(snake_fn, output_format))
+            logger.log("Converting {} to {}".format(source_fp, target_fp))
+            convert_snake_file_format(source_fp, target_fp)
+            converted_count += 1
+
+    logger.log("Converted {} snake files to {}".format(converted_count, output_format))
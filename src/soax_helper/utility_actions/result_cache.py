@@ -0,0 +1,30 @@
+import os
+import time
+
+from ..snakeutils.resultcache import SnakeResultCache
+
+def format_time(timestamp):
+    if timestamp is None:
+        return "-"
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+
+def open_existing_cache(cache_dir, logger):
+    if not os.path.isdir(os.path.join(cache_dir, "entries")):
+        logger.FAIL("{} is not a snake result cache directory".format(cache_dir))
+    return SnakeResultCache(cache_dir)
+
+def result_cache_stats(cache_dir, logger):
+    stats = open_existing_cache(cache_dir, logger).stats()
+
+    logger.log("Snake result cache {}".format(cache_dir))
+    logger.log("    {} results, {:.1f} MB".format(stats["entries"], stats["size_bytes"] / 2**20))
+    logger.log("    least recently used: {}".format(format_time(stats["oldest_use"])))
+    logger.log("    most recently used: {}".format(format_time(stats["newest_use"])))
+
+def prune_result_cache(cache_dir, max_gb, logger):
+    cache = open_existing_cache(cache_dir, logger)
+    max_size_bytes = 0 if max_gb is None else int(max_gb * 2**30)
+
+    removed_count, removed_bytes = cache.prune(max_size_bytes)
+    logger.log("Removed {} results ({:.1f} MB) from {}".format(removed_count, removed_bytes / 2**20, cache_dir))
+    result_cache_stats(cache_dir, logger)
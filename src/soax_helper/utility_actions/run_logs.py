@@ -0,0 +1,29 @@
+import os
+
+from ..snakeutils.runlog import load_run_log_index, read_run_log_entry, run_log_index_path
+
+def show_run_log(log_fp, job_id, failed_only, logger):
+    if not os.path.isfile(log_fp) or not os.path.isfile(run_log_index_path(log_fp)):
+        logger.FAIL("{} is not a run log with an index file".format(log_fp))
+
+    index_entries = load_run_log_index(log_fp)
+
+    if job_id is None:
+        if failed_only:
+            index_entries = [entry for entry in index_entries if entry["exit_code"] != 0]
+        logger.log("{} jobs in {}:".format(len(index_entries), log_fp))
+        for entry in index_entries:
+            logger.log("    {}  exit code {}  {:.1f}s{}".format(
+                entry["job"],
+                entry["exit_code"],
+                entry["runtime_s"],
+                "  (output truncated)" if entry["truncated"] else "",
+            ))
+        return
+
+    matching_entries = [entry for entry in index_entries if entry["job"] == os.path.normpath(job_id)]
+    if len(matching_entries) == 0:
+        logger.FAIL("No job {} in {}, run without a job to list the jobs".format(job_id, log_fp))
+
+    for entry in matching_entries:
+        logger.log(read_run_log_entry(log_fp, entry))
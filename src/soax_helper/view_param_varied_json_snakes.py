@@ -3,6 +3,7 @@ import tkinter.ttk as ttk
 import numpy as np
 import argparse
 import os
+from decimal import Decimal, InvalidOperation
 from PIL import Image
 from mpl_toolkits.mplot3d import Axes3D
 from matplotlib.backends.backend_tkagg import (
@@ -11,8 +12,8 @@ from matplotlib.figure import Figure
 
 from .snakeutils.files import find_files_or_folders_at_depth
 from .snakeutils.tifimage import open_tiff_as_np_arr
-from .snakeutils.params import param_filename_tags
-from .snakeutils.snakejson import load_json_snakes
+from .snakeutils.params import param_filename_tags, ParamSetStore
+from .snakeutils.snakeformats import load_snakes, snake_output_formats
 
 param_names_by_tags = {v: k for k, v in param_filename_tags.items()}
 
@@ -53,6 +54,25 @@ def parse_param_folder_name(folder_name):
 
     return param_values
 
+def param_value_sort_key(param_val):
+    """ Parameter values are kept as the strings from folder names or the manifest. Numbers
+    sort by value, anything else after them as text """
+    try:
+        number = Decimal(param_val)
+    except InvalidOperation:
+        return (1, Decimal(0), param_val)
+    if not number.is_finite():
+        return (1, Decimal(0), param_val)
+    return (0, number, param_val)
+
+def lookup_param_folder_values(folder_name, param_store):
+    """ Same as parse_param_folder_name, but looks the values up in a parameter manifest by
+    the folder name (the parameter set ID) """
+    if folder_name not in param_store:
+        raise Exception("Parameter set {} is not in {}".format(folder_name, param_store.manifest_fp))
+    values = param_store.values(folder_name)
+    return [(param_name, values[param_name]) for param_name in param_store.varied_param_names]
+
 def make_gui(
     root_folder,
     param_ranges,
@@ -79,13 +99,9 @@ def make_gui(
         if img_arr is not None:
             ax.imshow(img_arr[:,:,0], cmap='gray')
         for snake in snakes:
-            X = []
-            Y = []
-            Z = []
-            for pt in snake:
-                X.append(pt["pos"][0])
-                Y.append(pt["pos"][1])
-                Z.append(pt["pos"][2])
+            X = snake.positions[:,0]
+            Y = snake.positions[:,1]
+            Z = snake.positions[:,2]
             if flatten:
                 ax.plot(X,Y, 'b')
             else:
@@ -121,7 +137,7 @@ def make_gui(
         print("Showing {}".format(json_path))
         root.wm_title(json_path)
 
-        snakes, metadata = load_json_snakes(json_path)
+        snakes, metadata = load_snakes(json_path)
         if images_dir is None:
             img_arr = None
         else:
@@ -176,13 +192,14 @@ if __name__ == "__main__":
     parser.add_argument("jsons_dir")
     parser.add_argument('--flatten',default=False,action='store_true',help="Plot in 2D")
     parser.add_argument('--images', default=None, help='Folder with source images to show')
+    parser.add_argument('--params-manifest', default=None, help='params_manifest.jsonl to look parameter values up in, instead of parsing them from folder names')
     # parser.add_argument('--background',default=None,help="TIFF to graph in background")
 
     args = parser.parse_args()
 
-    jsons_folders_files = find_files_or_folders_at_depth(args.jsons_dir, 1, file_extension=".json")
+    jsons_folders_files = find_files_or_folders_at_depth(args.jsons_dir, 1, file_extensions=list(snake_output_formats.values()))
     # Assume image json filenames are same for all folders
-    image_json_names = [fn for folder,fn in find_files_or_folders_at_depth(jsons_folders_files[0][0], 0, file_extension=".json")]
+    image_json_names = [fn for folder,fn in find_files_or_folders_at_depth(jsons_folders_files[0][0], 0, file_extensions=list(snake_output_formats.values()))]
 
     # print(jsons_folders_files)
     # varied_params = {}
@@ -190,7 +207,13 @@ if __name__ == "__main__":
     if len(jsons_folders_files) == 0:
         raise Exception("Could not find any json files in subdirectories in {}".format(args.jsons_dir))
 
-    first_param_vals = parse_param_folder_name(os.path.split(jsons_folders_files[0][0])[1])
+    if args.params_manifest is not None:
+        param_store = ParamSetStore(args.params_manifest)
+        param_folder_values = lambda folder_name: lookup_param_folder_values(folder_name, param_store)
+    else:
+        param_folder_values = parse_param_folder_name
+
+    first_param_vals = param_folder_values(os.path.split(jsons_folders_files[0][0])[1])
 
     param_ranges = [(param_name, []) for param_name, param_val in first_param_vals]
     # For param selection menu, defaults are the values in the first param folder name
@@ -201,14 +224,14 @@ if __name__ == "__main__":
     for (folder_path, image_json_name) in jsons_folders_files:
         __, param_folder = os.path.split(folder_path)
         # print(param_folder)
-        folder_param_vals = parse_param_folder_name(param_folder)
+        folder_param_vals = param_folder_values(param_folder)
         param_vals_by_foldername[param_folder] = folder_param_vals
         for i, (param_name, param_val) in enumerate(folder_param_vals):
             if param_val not in param_ranges[i][1]:
                 param_ranges[i][1].append(param_val)
 
-    # Sort parameter values alphanumerically
-    param_ranges = [(param_name, sorted(p_range)) for (param_name, p_range) in param_ranges]
+    # Sort parameter values by number, so "10" comes after "9"
+    param_ranges = [(param_name, sorted(p_range, key=param_value_sort_key)) for (param_name, p_range) in param_ranges]
 
     print(param_ranges)
     print(param_defaults)
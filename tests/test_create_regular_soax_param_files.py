@@ -0,0 +1,27 @@
+import pytest
+
+from soax_helper.snakeutils.logger import ConsoleLogger
+from soax_helper.snakeutils.params import param_filename_tags
+from soax_helper.actions.create_regular_soax_param_files import create_range, range_length, check_param_file_count
+
+@pytest.mark.parametrize("start,stop,step", [
+    ("0", "1", "0.1"),
+    ("0.01", "0.1", "0.03"),
+    ("1", "1", "0"),
+    ("5", "2", "1"),
+    ("0", "10", "3"),
+    ("0", "9", "3"),
+])
+def test_range_length_matches_create_range(start, stop, step):
+    assert range_length(start, stop, step) == len(create_range(start, stop, step))
+
+def fixed_param_settings():
+    return {param_name: {"start": "1", "stop": "1", "step": "0"} for param_name in param_filename_tags}
+
+@pytest.mark.parametrize("sample_count", [None, 0, -3, 2.5])
+def test_sampling_needs_positive_sample_count(sample_count):
+    with pytest.raises(Exception, match="positive whole number of samples"):
+        check_param_file_count(fixed_param_settings(), "random", sample_count, 10, ConsoleLogger())
+
+def test_sampled_file_count_is_sample_count_times_copies():
+    assert check_param_file_count(fixed_param_settings(), "latin_hypercube", 4, None, ConsoleLogger(), copies=3) == 12
@@ -0,0 +1,60 @@
+import io
+
+import pytest
+
+from soax_helper.snakeutils.files import extract_snakes, extract_snakes_vectorized
+
+def snake_file_lines(snakes, junctions=(), snake_numbers=None):
+    """ Lines of a SOAX snake file. Each snake is a list of (x, y, z, fg, bg), an empty list
+    gives a snake with no points """
+    lines = ["image\timage.tif", "dimensions\t100\t100\t10", "s\tp\tx\ty\tz\tfg_int\tbg_int"]
+    lines += [""] * (29 - len(lines))
+    if snake_numbers is None:
+        snake_numbers = range(len(snakes))
+    for snake_number, points in zip(snake_numbers, snakes):
+        lines.append("#1")
+        for point_idx, (x, y, z, fg, bg) in enumerate(points):
+            lines.append("{}{:12d}{:12.6g}{:12.6g}{:12.6g}{:12.6g}{:12.6g}".format(snake_number, point_idx, x, y, z, fg, bg))
+    for x, y, z in junctions:
+        lines.append("{:12.6g}{:12.6g}{:12.6g}".format(x, y, z))
+    return lines
+
+def make_snakes(snake_count, points_per_snake=3):
+    return [
+        [(snake_idx + 0.5, point_idx * 1.25, 2.0, 100.0 + snake_idx, 10.5) for point_idx in range(points_per_snake)]
+        for snake_idx in range(snake_count)
+    ]
+
+def read_both(text, newline):
+    extracted = extract_snakes(io.StringIO(text, newline=newline))
+    vectorized = extract_snakes_vectorized(io.StringIO(text, newline=newline))
+    return extracted, vectorized
+
+# Expected snake counts are after repeated snake numbers replace earlier snakes. Snakes with
+# no points are named after their marker line, so two of them count as one
+snake_file_cases = {
+    "more_than_ten_snakes": (snake_file_lines(make_snakes(23), junctions=[(1.0, 2.0, 3.0)]), 23),
+    "empty_snakes": (snake_file_lines(make_snakes(4)[:2] + [[], []] + make_snakes(4)[2:], junctions=[(1.0, 2.0, 3.0)]), 5),
+    "repeated_snake_numbers": (snake_file_lines(make_snakes(5), snake_numbers=[0, 1, 3, 3, 12]), 4),
+    "no_junctions": (snake_file_lines(make_snakes(12)), 12),
+}
+
+@pytest.mark.parametrize("case", sorted(snake_file_cases))
+@pytest.mark.parametrize("line_ending", ["\n", "\r\n"])
+@pytest.mark.parametrize("final_newline", [True, False])
+@pytest.mark.parametrize("newline", [None, ""])
+def test_vectorized_reader_matches_extract_snakes(case, line_ending, final_newline, newline):
+    lines, snake_count = snake_file_cases[case]
+    text = line_ending.join(lines) + (line_ending if final_newline else "")
+
+    extracted, vectorized = read_both(text, newline)
+
+    assert len(extracted) == snake_count
+    assert vectorized == extracted
+
+def test_snakes_numbered_past_nine_are_all_kept():
+    lines = snake_file_lines(make_snakes(11))
+    extracted, vectorized = read_both("\n".join(lines) + "\n", None)
+
+    assert [snake[0]["pos"][0] for snake in extracted] == [snake_idx + 0.5 for snake_idx in range(11)]
+    assert vectorized == extracted
@@ -0,0 +1,16 @@
+from soax_helper.snakeutils.snakeset import SnakeSet
+
+def make_snakes():
+    return SnakeSet.from_dicts([
+        [{"pos": [1.0, 2.0, 3.0], "fg": 0.5, "bg": 0.25}, {"pos": [1.5, 2.0, 3.0], "fg": 0.75, "bg": 0.25}],
+        [{"pos": [4.0, 5.0, 6.0], "fg": 1.0, "bg": 0.0}],
+    ])
+
+def test_snake_set_iter_dicts_matches_to_dicts():
+    snakes = make_snakes()
+    assert list(snakes.iter_dicts(batch_points=1)) == snakes.to_dicts()
+
+def test_snake_view_iter_dicts_yields_its_snake():
+    snakes = make_snakes()
+    for snake_idx, snake_dicts in enumerate(snakes.to_dicts()):
+        assert list(snakes[snake_idx].iter_dicts()) == [snake_dicts]
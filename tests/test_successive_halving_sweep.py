@@ -0,0 +1,15 @@
+from soax_helper.actions.successive_halving_sweep import halving_keep_count
+
+def test_keep_count_cuts_by_keep_fraction():
+    assert halving_keep_count(16, 0.5, 1) == 8
+    assert halving_keep_count(9, 0.5, 1) == 5
+
+def test_keep_count_keeps_final_param_count():
+    assert halving_keep_count(10, 0.1, 3) == 3
+
+def test_keep_count_drops_one_when_fraction_rounds_up_to_all():
+    assert halving_keep_count(5, 0.99, 1) == 4
+    assert halving_keep_count(2, 0.99, 1) == 1
+
+def test_keep_count_never_below_final_param_count():
+    assert halving_keep_count(4, 0.99, 3) == 3